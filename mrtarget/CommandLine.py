@@ -9,6 +9,7 @@ import itertools
 
 from mrtarget.modules.Evidences import process_evidences_pipeline
 from mrtarget.common.connection import new_es_client
+from mrtarget.common.esutil import BulkLoadOptions, LoadProfile
 from mrtarget.modules.Association import ScoringProcess
 from mrtarget.modules.DataDrivenRelation import DataDrivenRelationProcess
 from mrtarget.modules.ECO import EcoProcess
@@ -56,147 +57,186 @@ def main():
     #es clients can't be pased around to multiple processs!
     es = new_es_client(args.elasticseach_nodes)
 
+    #how all the stages load their indexes
+    es_load = BulkLoadOptions(args.elasticsearch_keep_versions, 
+        args.elasticsearch_merge_segments, args.elasticsearch_replicas,
+        args.elasticsearch_finalise_timeout, args.elasticsearch_defer_finalise,
+        dict((index.name, LoadProfile.from_config(index.load)) 
+            for index in es_config.values() if index.load),
+        args.elasticsearch_finalise_status)
+
+    #the qc reads the indexes back from elasticsearch
+    if args.elasticsearch_folder and not args.skip_qc:
+        logger.warning("skipping qc when writing to %s", args.elasticsearch_folder)
+        args.skip_qc = True
+
     #create something to accumulate qc metrics into over various steps
     qc_metrics = QCMetrics()
 
 
-    if args.rea:
-        process = ReactomeProcess(args.elasticseach_nodes, es_config.rea.name, 
-            es_config.rea.mapping, es_config.rea.setting,
-            data_config.reactome_pathway_data, data_config.reactome_pathway_relation,
-            args.rea_workers_writer, args.rea_queue_write)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.rea.name))
-
-    if args.gen:
-        process = GeneManager(args.elasticseach_nodes, es_config.gen.name, 
-            es_config.gen.mapping, es_config.gen.setting, 
-            args.gen_plugin_places, data_config.gene_data_plugin_names,
-            data_config, es_config,
-            args.gen_workers_writer, args.gen_queue_write )
-        if not args.qc_only:
-            process.merge_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.gen.name))     
-
-    if args.efo:
-        process = EfoProcess(args.elasticseach_nodes, es_config.efo.name, 
-            es_config.efo.mapping, es_config.efo.setting, 
-            data_config.ontology_efo, data_config.ontology_hpo, 
-            data_config.ontology_mp, data_config.disease_phenotype,
-            args.efo_workers_writer, args.efo_queue_write)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.efo.name))
-    if args.eco:
-        process = EcoProcess(args.elasticseach_nodes, es_config.eco.name, 
-            es_config.eco.mapping, es_config.eco.setting,
-            data_config.ontology_eco, data_config.ontology_so,
-            args.eco_workers_writer, args.eco_queue_write)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.eco.name))
-
-    if args.val:
-        process_evidences_pipeline(data_config.input_file, args.val_first_n,
-            args.elasticseach_nodes, es_config.val_right.name, es_config.val_wrong.name, 
-            es_config.val_right.mapping, es_config.val_wrong.mapping, 
-            es_config.val_right.setting, es_config.val_wrong.setting, 
-            es_config.gen.name, es_config.eco.name, es_config.efo.name,
-            args.dry_run,
-            args.val_append_data,
-            args.val_workers_validator, args.val_queue_validator,
-            args.val_workers_writer, args.val_queue_validator_writer,
-            args.val_cache_target, args.val_cache_target_u2e, args.val_cache_target_contains,
-            args.val_cache_eco, args.val_cache_efo, args.val_cache_efo_contains,
-            data_config.eco_scores, data_config.schema,
-            data_config.excluded_biotypes, data_config.datasources_to_datatypes)
-
-        #TODO qc
-
-    if args.hpa:
-        process = HPAProcess(args.elasticseach_nodes, es_config.hpa.name, 
-                es_config.hpa.mapping, es_config.hpa.setting,
-                data_config.tissue_translation_map, data_config.tissue_curation_map,
-                data_config.hpa_normal_tissue, data_config.hpa_rna_level, 
-                data_config.hpa_rna_value, data_config.hpa_rna_zscore,
-                args.hpa_workers_writer, args.hpa_queue_write)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.hpa.name))     
-
-    if args.assoc:
-        process = ScoringProcess(args.elasticseach_nodes, es_config.asc.name, 
-                es_config.asc.mapping, es_config.asc.setting,
-                es_config.gen.name, es_config.val_right.name, es_config.hpa.name, es_config.efo.name,
-                args.as_workers_writer, args.as_workers_production, args.as_workers_score, 
-                args.as_queue_score, args.as_queue_production, args.as_queue_write,
-                args.as_cache_hpa, args.as_cache_efo, args.as_cache_target, 
-                data_config.scoring_weights, data_config.is_direct_do_not_propagate,
-                data_config.datasources_to_datatypes)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.asc.name))
-        
-    if args.ddr:
-        process = DataDrivenRelationProcess(args.elasticseach_nodes, 
-                es_config.ddr.name, 
-                es_config.ddr.mapping, es_config.ddr.setting,
-                es_config.efo.name, es_config.gen.name, es_config.asc.name, 
-                args.ddr_workers_production,
-                args.ddr_workers_score,
-                args.ddr_workers_write,
-                args.ddr_queue_production_score,
-                args.ddr_queue_score_result,
-                args.ddr_queue_write,
-                data_config.ddr["score-threshold"],
-                data_config.ddr["evidence-count"])
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        #TODO qc
-
-    if args.sea:
-        process = SearchObjectProcess(args.elasticseach_nodes, 
-                es_config.sea.name,  
-                es_config.sea.mapping, es_config.sea.setting, 
-                es_config.gen.name, es_config.efo.name, es_config.val_right.name,
-                es_config.asc.name, 
-                args.sea_workers_writer, 
-                args.sea_queue_write, 
-                data_config.chembl_target, 
-                data_config.chembl_mechanism, 
-                data_config.chembl_component, 
-                data_config.chembl_protein, 
-                data_config.chembl_molecule)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        #TODO qc
-
-    if args.drg:
-        process = DrugProcess(args.elasticseach_nodes, es_config.drg.name, 
-                es_config.drg.mapping, es_config.drg.setting,
-                es_config.gen.name, es_config.efo.name,
-                args.drg_workers_writer, args.drg_queue_write, 
-                args.drg_cache_efo, args.drg_cache_efo_contains,
-                args.drg_cache_target, args.drg_cache_target_u2e, args.drg_cache_target_contains,
-                data_config.chembl_target, 
-                data_config.chembl_mechanism, 
-                data_config.chembl_component, 
-                data_config.chembl_protein, 
-                data_config.chembl_molecule,
-                data_config.chembl_indication,
-                data_config.adverse_events,
-                data_config.drugbank)
-        if not args.qc_only:
-            process.process_all(args.dry_run)
-        if not args.skip_qc:
-            qc_metrics.update(process.qc(es, es_config.drg.name))
+    #the indexes left to the end of the run are merged even if a stage fails,
+    #not to leave them without replicas
+    try:
+        if args.rea:
+            process = ReactomeProcess(args.elasticseach_nodes, es_config.rea.name, 
+                es_config.rea.mapping, es_config.rea.setting,
+                data_config.reactome_pathway_data, data_config.reactome_pathway_relation,
+                args.rea_workers_writer, args.rea_queue_write, args.elasticsearch_folder,
+                args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.rea.name, args.qc_workers_scan))
+
+        if args.gen:
+            process = GeneManager(args.elasticseach_nodes, es_config.gen.name, 
+                es_config.gen.mapping, es_config.gen.setting, 
+                args.gen_plugin_places, data_config.gene_data_plugin_names,
+                data_config, es_config,
+                args.gen_workers_writer, args.gen_queue_write, args.elasticsearch_folder,
+                args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.merge_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.gen.name, args.qc_workers_scan))     
+
+        if args.efo:
+            process = EfoProcess(args.elasticseach_nodes, es_config.efo.name, 
+                es_config.efo.mapping, es_config.efo.setting, 
+                data_config.ontology_efo, data_config.ontology_hpo, 
+                data_config.ontology_mp, data_config.disease_phenotype,
+                args.efo_workers_writer, args.efo_queue_write, args.elasticsearch_folder,
+                args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.efo.name, args.qc_workers_scan))
+        if args.eco:
+            process = EcoProcess(args.elasticseach_nodes, es_config.eco.name, 
+                es_config.eco.mapping, es_config.eco.setting,
+                data_config.ontology_eco, data_config.ontology_so,
+                args.eco_workers_writer, args.eco_queue_write, args.elasticsearch_folder,
+                args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.eco.name, args.qc_workers_scan))
+
+        if args.val:
+            process_evidences_pipeline(data_config.input_file, args.val_first_n,
+                args.elasticseach_nodes, es_config.val_right.name, es_config.val_wrong.name, 
+                es_config.val_right.mapping, es_config.val_wrong.mapping, 
+                es_config.val_right.setting, es_config.val_wrong.setting, 
+                es_config.gen.name, es_config.eco.name, es_config.efo.name,
+                args.dry_run,
+                args.val_append_data,
+                args.val_workers_validator, args.val_queue_validator,
+                args.val_workers_writer, args.val_queue_validator_writer,
+                args.val_cache_target, args.val_cache_target_u2e, args.val_cache_target_contains,
+                args.val_cache_eco, args.val_cache_efo, args.val_cache_efo_contains,
+                data_config.eco_scores, data_config.schema,
+                data_config.excluded_biotypes, data_config.datasources_to_datatypes,
+                args.val_preload_lookups, args.val_lookup_snapshot,
+                args.val_batch_size, args.lookup_cache_dir, args.val_json_backend,
+                args.val_schema_cache_dir, args.val_split_size,
+                args.val_incremental_manifest, args.val_partition_by_datasource,
+                args.val_invalid_dir, args.val_invalid_lines_per_file, args.val_invalid_compression,
+                args.elasticsearch_folder, args.val_scoring_columns, args.elasticsearch_bulk_bytes,
+                es_load)
+
+            #TODO qc
+
+        if args.hpa:
+            process = HPAProcess(args.elasticseach_nodes, es_config.hpa.name, 
+                    es_config.hpa.mapping, es_config.hpa.setting,
+                    data_config.tissue_translation_map, data_config.tissue_curation_map,
+                    data_config.hpa_normal_tissue, data_config.hpa_rna_level, 
+                    data_config.hpa_rna_value, data_config.hpa_rna_zscore,
+                    args.hpa_workers_writer, args.hpa_queue_write, args.elasticsearch_folder,
+                    args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.hpa.name, args.qc_workers_scan))     
+
+        if args.assoc:
+            process = ScoringProcess(args.elasticseach_nodes, es_config.asc.name, 
+                    es_config.asc.mapping, es_config.asc.setting,
+                    es_config.gen.name, es_config.val_right.name, es_config.hpa.name, es_config.efo.name,
+                    args.as_workers_writer, args.as_workers_production, args.as_workers_score, 
+                    args.as_queue_score, args.as_queue_production, args.as_queue_write,
+                    args.as_cache_hpa, args.as_cache_efo, args.as_cache_target, 
+                    data_config.scoring_weights, data_config.is_direct_do_not_propagate,
+                    data_config.datasources_to_datatypes, args.as_lookup_snapshot,
+                    args.lookup_cache_dir, args.as_single_pass, args.as_workers_scan,
+                    args.as_propagate_in_memory, args.elasticsearch_folder, 
+                    args.as_evidence_columns, args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.asc.name, args.qc_workers_scan))
+
+        if args.ddr:
+            process = DataDrivenRelationProcess(args.elasticseach_nodes, 
+                    es_config.ddr.name, 
+                    es_config.ddr.mapping, es_config.ddr.setting,
+                    es_config.efo.name, es_config.gen.name, es_config.asc.name, 
+                    args.ddr_workers_production,
+                    args.ddr_workers_score,
+                    args.ddr_workers_write,
+                    args.ddr_queue_production_score,
+                    args.ddr_queue_score_result,
+                    args.ddr_queue_write,
+                    data_config.ddr["score-threshold"],
+                    data_config.ddr["evidence-count"],
+                    args.ddr_workers_scan, args.elasticsearch_folder, args.elasticsearch_bulk_bytes,
+                    es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            #TODO qc
+
+        if args.sea:
+            process = SearchObjectProcess(args.elasticseach_nodes, 
+                    es_config.sea.name,  
+                    es_config.sea.mapping, es_config.sea.setting, 
+                    es_config.gen.name, es_config.efo.name, es_config.val_right.name,
+                    es_config.asc.name, 
+                    args.sea_workers_writer, 
+                    args.sea_queue_write, 
+                    data_config.chembl_target, 
+                    data_config.chembl_mechanism, 
+                    data_config.chembl_component, 
+                    data_config.chembl_protein, 
+                    data_config.chembl_molecule,
+                    args.sea_workers_scan, args.elasticsearch_folder, args.elasticsearch_bulk_bytes,
+                    es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            #TODO qc
+
+        if args.drg:
+            process = DrugProcess(args.elasticseach_nodes, es_config.drg.name, 
+                    es_config.drg.mapping, es_config.drg.setting,
+                    es_config.gen.name, es_config.efo.name,
+                    args.drg_workers_writer, args.drg_queue_write, 
+                    args.drg_cache_efo, args.drg_cache_efo_contains,
+                    args.drg_cache_target, args.drg_cache_target_u2e, args.drg_cache_target_contains,
+                    data_config.chembl_target, 
+                    data_config.chembl_mechanism, 
+                    data_config.chembl_component, 
+                    data_config.chembl_protein, 
+                    data_config.chembl_molecule,
+                    data_config.chembl_indication,
+                    data_config.adverse_events,
+                    data_config.drugbank,
+                    args.lookup_cache_dir, args.elasticsearch_folder, 
+                    args.elasticsearch_bulk_bytes, es_load)
+            if not args.qc_only:
+                process.process_all(args.dry_run)
+            if not args.skip_qc:
+                qc_metrics.update(process.qc(es, es_config.drg.name, args.qc_workers_scan))
+    finally:
+        es_load.finalise_deferred()
 
     if args.qc_in:
         #handle reading in previous qc from filename provided, and adding comparitive metrics
@@ -3,6 +3,8 @@ import yaml
 import configargparse
 import addict
 import mrtarget.common.connection
+from mrtarget.common.DataStructure import JSON_BACKENDS
+from mrtarget.common.IO import RotatingLineWriter
 from opentargets_urlzsource import URLZSource
 
 def setup_ops_parser():
@@ -34,6 +36,8 @@ def setup_ops_parser():
         env_var="QC_ONLY", action="store_true", default=False)
     p.add("--skip-qc", help="do not run the qc for this stage",
         env_var="SKIP_QC", action="store_true", default=False)
+    p.add("--qc-workers-scan", help="# of threads for reading slices of an index in parallel for qc",
+        env_var="QC_WORKERS_SCAN", action='store', default=1, type=int)
 
     # elasticsearch
     p.add("--elasticseach-nodes", help="elasticsearch host(s)",
@@ -42,8 +46,26 @@ def setup_ops_parser():
         # To handle a default that is *only* used if *nothing* is specified, we have
         # to do it ourselves later. Otherwise the "default" is always present and
         # values are appended to it.
-    p.add("--elasticsearch-folder", help="write to files instead of a live elasticsearch server",
-        action='store') #this only applies to --val at the moment
+    p.add("--elasticsearch-folder", help="write to files instead of a live elasticsearch server, as compressed bulk requests in a folder per index, and read the indexes in it from there in the following stages",
+        env_var="ELASTICSEARCH_FOLDER", action='store')
+    p.add("--elasticsearch-bulk-bytes", help="maximum size in bytes of the bulk requests the stages write with, smaller requests are sent again less often when elasticsearch is busy",
+        env_var="ELASTICSEARCH_BULK_BYTES", action='store', default=10*1024*1024, type=int)
+    p.add("--elasticsearch-keep-versions", help="build each index as a new version while the previous one is still served behind an alias of its name, then move the alias and keep this many versions (0 replaces each index in place)",
+        env_var="ELASTICSEARCH_KEEP_VERSIONS", action='store', default=0, type=int)
+    p.add("--elasticsearch-merge-segments", help="number of segments to force merge each loaded index down to, 0 to not merge",
+        env_var="ELASTICSEARCH_MERGE_SEGMENTS", action='store', default=1, type=int)
+    p.add("--elasticsearch-replicas", help="number of replicas to give each loaded index once merged, by default its own setting",
+        env_var="ELASTICSEARCH_REPLICAS", action='store', type=int)
+    p.add("--elasticsearch-finalise-timeout", help="seconds to wait for the loaded indexes to merge and be replicated before carrying on without",
+        env_var="ELASTICSEARCH_FINALISE_TIMEOUT", action='store', default=3600, type=int)
+    p.add("--elasticsearch-finalise-status", help="health to wait for the loaded indexes to reach once replicated, by default green if the cluster has the data nodes to hold the replicas and yellow if not",
+        env_var="ELASTICSEARCH_FINALISE_STATUS", action='store', choices=["green", "yellow"])
+    p.add("--elasticsearch-defer-finalise", help="merge and replicate the loaded indexes all at once at the end of the run instead of after each stage",
+        env_var="ELASTICSEARCH_DEFER_FINALISE", action='store_true', default=False)
+
+    # lookups
+    p.add("--lookup-cache-dir", help="directory to keep snapshots of the target, disease, eco and hpa lookups in, reused by later stages and runs until the index is rebuilt",
+        env_var="LOOKUP_CACHE_DIR", action='store')
 
     # process handling
     #note this is the number of workers for each parallel operation
@@ -95,18 +117,42 @@ def setup_ops_parser():
         env_var="VAL_WORKERS_WRITER", action='store', default=4, type=int)
     p.add("--val-queue-validator-writer", help="size of validation writer queue (in chunks)",
         env_var="VAL_QUEUE_VALIDATOR_WRITER", action='store', default=8, type=int)
-    p.add("--val-cache-eco", help="size of validation cache for eco (bytes)",
-        env_var="VAL_CACHE_ECO", action='store', default=128, type=int)
-    p.add("--val-cache-efo", help="size of validation cache for diseases (bytes)",
-        env_var="VAL_CACHE_EFO", action='store', default=1024*512, type=int)
-    p.add("--val-cache-efo-contains", help="size of validation cache for disease existing (bytes)",
+    p.add("--val-cache-eco", help="size of validation cache for eco (bytes, deep size of the cached values)",
+        env_var="VAL_CACHE_ECO", action='store', default=1024*64, type=int)
+    p.add("--val-cache-efo", help="size of validation cache for diseases (bytes, deep size of the cached values)",
+        env_var="VAL_CACHE_EFO", action='store', default=1024*1024*16, type=int)
+    p.add("--val-cache-efo-contains", help="size of validation cache for disease existing (bytes, deep size of the cached values)",
         env_var="VAL_CACHE_EFO_CONTAINS", action='store', default=1024*32, type=int)
-    p.add("--val-cache-target", help="size of validation cache for target (bytes)",
-        env_var="VAL_CACHE_TARGET", action='store', default=1024*1024, type=int)
-    p.add("--val-cache-target-u2e", help="size of validation cache for target uniprot to ensembl (bytes)",
+    p.add("--val-cache-target", help="size of validation cache for target (bytes, deep size of the cached values)",
+        env_var="VAL_CACHE_TARGET", action='store', default=1024*1024*32, type=int)
+    p.add("--val-cache-target-u2e", help="size of validation cache for target uniprot to ensembl (bytes, deep size of the cached values)",
         env_var="VAL_CACHE_TARGET_U2E", action='store', default=1024*256, type=int)
-    p.add("--val-cache-target-contains", help="size of validation cache for target existing (bytes)",
+    p.add("--val-cache-target-contains", help="size of validation cache for target existing (bytes, deep size of the cached values)",
         env_var="VAL_CACHE_TARGET_CONTAINS", action='store', default=1024*64, type=int)
+    p.add("--val-preload-lookups", help="load all target, disease and eco ids into each validator at start instead of querying per evidence",
+        env_var="VAL_PRELOAD_LOOKUPS", action='store_true', default=False)
+    p.add("--val-lookup-snapshot", help="build a memory-mapped snapshot of the target, disease and eco lookups once and share it between validators",
+        env_var="VAL_LOOKUP_SNAPSHOT", action='store_true', default=False)
+    p.add("--val-batch-size", help="# of evidence lines each validator handles at a time, looking them up together and returning them as one bulk request (1 disables batching)",
+        env_var="VAL_BATCH_SIZE", action='store', default=1, type=int)
+    p.add("--val-json-backend", help="json library for decoding and encoding evidence, auto uses orjson when installed",
+        env_var="VAL_JSON_BACKEND", action='store', default='simplejson', choices=JSON_BACKENDS)
+    p.add("--val-split-size", help="bytes of input each validator reads itself at a time, plain files are split in ranges of this size and compressed files are read whole (0 reads all the input in the main process)",
+        env_var="VAL_SPLIT_SIZE", action='store', default=0, type=int)
+    p.add("--val-schema-cache-dir", help="directory to keep the compiled per datasource schema validators in, reused by later runs of the same schema",
+        env_var="VAL_SCHEMA_CACHE_DIR", action='store')
+    p.add("--val-incremental-manifest", help="sqlite file of the lines loaded by previous --val runs, only new or changed lines are validated and the documents of removed lines deleted (implies --val-append-data)",
+        env_var="VAL_INCREMENTAL_MANIFEST", action='store')
+    p.add("--val-partition-by-datasource", help="write the valid evidence of each datasource to its own index behind the alias of the valid evidence index, replacing only the datasources in the input",
+        env_var="VAL_PARTITION_BY_DATASOURCE", action='store_true', default=False)
+    p.add("--val-invalid-dir", help="directory to write the invalid evidence to, as compressed json lines files with a summary of their counts, instead of the invalid evidence index",
+        env_var="VAL_INVALID_DIR", action='store')
+    p.add("--val-invalid-lines-per-file", help="number of invalid evidence in each file of --val-invalid-dir",
+        env_var="VAL_INVALID_LINES_PER_FILE", action='store', default=1000000, type=int)
+    p.add("--val-invalid-compression", help="compression of the files of --val-invalid-dir, zstd needs the zstandard package",
+        env_var="VAL_INVALID_COMPRESSION", action='store', default='gzip', choices=RotatingLineWriter.COMPRESSIONS)
+    p.add("--val-scoring-columns", help="directory to write the target, diseases, score and datasource of the valid evidence to as memory-mappable columns for --as-evidence-columns",
+        env_var="VAL_SCORING_COLUMNS", action='store')
     p.add("--val-append-data", help="append to existing data instead of replacing existing data from a previous --val run",
         env_var="VAL_APPEND_DATA", action='store_true', default=False)
 
@@ -124,12 +170,22 @@ def setup_ops_parser():
         env_var="AS_QUEUE_SCORE", action='store', default=1000, type=int)
     p.add("--as-queue-write", help="size of association pair writer queue (in chunks)",
         env_var="AS_QUEUE_WRITE", action='store', default=8, type=int)
-    p.add("--as-cache-hpa", help="size of association cache for hpa (bytes)",
-        env_var="AS_CACHE_HPA", action='store', default=1024*4, type=int)
-    p.add("--as-cache-efo", help="size of association cache for efo (bytes)",
-        env_var="AS_CACHE_EFO", action='store', default=1024*1024*4, type=int)
-    p.add("--as-cache-target", help="size of association cache for target (bytes)",
-        env_var="AS_CACHE_TARGET", action='store', default=1024*512, type=int)
+    p.add("--as-cache-hpa", help="size of association cache for hpa (bytes, deep size of the cached values)",
+        env_var="AS_CACHE_HPA", action='store', default=1024*1024, type=int)
+    p.add("--as-cache-efo", help="size of association cache for efo (bytes, deep size of the cached values)",
+        env_var="AS_CACHE_EFO", action='store', default=1024*1024*64, type=int)
+    p.add("--as-cache-target", help="size of association cache for target (bytes, deep size of the cached values)",
+        env_var="AS_CACHE_TARGET", action='store', default=1024*1024*16, type=int)
+    p.add("--as-lookup-snapshot", help="build a memory-mapped snapshot of the target, disease and hpa lookups once and share it between scorers",
+        env_var="AS_LOOKUP_SNAPSHOT", action='store_true', default=False)
+    p.add("--as-single-pass", help="scan the evidence once and group it by target instead of querying the evidence of each target",
+        env_var="AS_SINGLE_PASS", action='store_true', default=False)
+    p.add("--as-workers-scan", help="# of threads for reading slices of the target and evidence indexes in parallel",
+        env_var="AS_WORKERS_SCAN", action='store', default=1, type=int)
+    p.add("--as-propagate-in-memory", help="propagate associations up an in-memory EFO graph instead of the ancestor codes stored in each evidence",
+        env_var="AS_PROPAGATE_IN_MEMORY", action='store_true', default=False)
+    p.add("--as-evidence-columns", help="directory of the columns written by --val-scoring-columns to read the evidence from instead of the evidence index",
+        env_var="AS_EVIDENCE_COLUMNS", action='store')
 
         
     # if 0 use main thread for writing
@@ -138,6 +194,8 @@ def setup_ops_parser():
         env_var="SEA_WORKERS_WRITER", action='store', default=4, type=int)
     p.add("--sea-queue-write", help="size of sea writer queue (in chunks)",
         env_var="SEA_QUEUE_WRITE", action='store', default=8, type=int)
+    p.add("--sea-workers-scan", help="# of threads for reading slices of the target, disease and evidence indexes in parallel",
+        env_var="SEA_WORKERS_SCAN", action='store', default=1, type=int)
 
     p.add("--ddr-workers-production", help="# of procs for relation pair producers",
         env_var="DDR_WORKERS_PRODUCTION", action='store', default=4, type=int)
@@ -153,6 +211,8 @@ def setup_ops_parser():
         env_var="DDR_QUEUE_SCORE_RESULT", action='store', default=1000, type=int)
     p.add("--ddr-queue-write", help="size of relation writer queue (in chunks)",
         env_var="DDR_QUEUE_WRITE", action='store', default=8, type=int)
+    p.add("--ddr-workers-scan", help="# of threads for reading slices of the association index in parallel",
+        env_var="DDR_WORKERS_SCAN", action='store', default=1, type=int)
 
     # if 0 use main thread for writing
     # if >0 use that many threads for writing
@@ -160,15 +220,15 @@ def setup_ops_parser():
         env_var="DRG_WORKERS_WRITER", action='store', default=4, type=int)
     p.add("--drg-queue-write", help="size of drug writer queue (in chunks)",
         env_var="DRG_QUEUE_WRITE", action='store', default=8, type=int)
-    p.add("--drg-cache-efo", help="size of drug cache for diseases (bytes)",
-        env_var="DRG_CACHE_EFO", action='store', default=1024*1024*8, type=int)
-    p.add("--drg-cache-efo-contains", help="size of drug cache for disease existing (bytes)",
+    p.add("--drg-cache-efo", help="size of drug cache for diseases (bytes, deep size of the cached values)",
+        env_var="DRG_CACHE_EFO", action='store', default=1024*1024*64, type=int)
+    p.add("--drg-cache-efo-contains", help="size of drug cache for disease existing (bytes, deep size of the cached values)",
         env_var="DRG_CACHE_EFO_CONTAINS", action='store', default=1024*128, type=int)
-    p.add("--drg-cache-target", help="size of drug cache for target (bytes)",
-        env_var="DRG_CACHE_TARGET", action='store', default=1024*1024*8, type=int)
-    p.add("--drg-cache-target-u2e", help="size of drug cache for target uniprot to ensembl (bytes)",
+    p.add("--drg-cache-target", help="size of drug cache for target (bytes, deep size of the cached values)",
+        env_var="DRG_CACHE_TARGET", action='store', default=1024*1024*64, type=int)
+    p.add("--drg-cache-target-u2e", help="size of drug cache for target uniprot to ensembl (bytes, deep size of the cached values)",
         env_var="DRG_CACHE_TARGET_U2E", action='store', default=1024*1024, type=int)
-    p.add("--drg-cache-target-contains", help="size of drug cache for target existing (bytes)",
+    p.add("--drg-cache-target-contains", help="size of drug cache for target existing (bytes, deep size of the cached values)",
         env_var="DRG_CACHE_TARGET_CONTAINS", action='store', default=1024*256, type=int)
 
     # for debugging
@@ -8,6 +8,11 @@ except ImportError:
 
 from datetime import datetime, date
 
+#optional faster json library
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class PipelineEncoder(json.JSONEncoder):
@@ -83,3 +88,64 @@ class SparseFloatDict(UserDict):
     def __missing__(self, key):
         return 0.
 
+
+
+
+class JSONBackend(object):
+    """
+    The json functions used on the hot paths (e.g. evidence validation), so 
+    that a faster library can be plugged in. The default uses simplejson and 
+    the PipelineEncoder, like JSONSerializable.
+    """
+    name = 'simplejson'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys, cls=PipelineEncoder)
+
+
+def _orjson_default(o):
+    if isinstance(o, set):
+        return list(o)
+    return PipelineEncoder().default(o)
+
+
+class OrjsonBackend(JSONBackend):
+    """
+    orjson backend. It falls back to simplejson for the documents orjson does
+    not handle (e.g. integers over 64 bits, NaN), so both accept the same input.
+    Output is compact (no spaces after separators), which is still the same 
+    json document.
+    """
+    name = 'orjson'
+
+    def loads(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    def dumps(self, obj, sort_keys=False):
+        try:
+            return orjson.dumps(obj, default=_orjson_default,
+                option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super(OrjsonBackend, self).dumps(obj, sort_keys)
+
+
+JSON_BACKENDS = ['simplejson', 'orjson', 'auto']
+
+
+def get_json_backend(name='simplejson'):
+    """return the JSONBackend called name, where auto is the fastest installed"""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'simplejson'
+    if name == 'simplejson':
+        return JSONBackend()
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError("json backend orjson is not installed")
+        return OrjsonBackend()
+    raise ValueError("unknown json backend %s" % name)
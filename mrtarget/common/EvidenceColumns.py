@@ -0,0 +1,189 @@
+"""
+Columnar side-file of the evidence fields the association scoring reads.
+
+The --val stage can write, next to the valid evidence index, a directory of
+numpy arrays with the target, disease, ancestor disease codes, association
+score and datasource of each valid evidence. The ids are dictionary encoded,
+with the strings of each dictionary in a json file, and the rows are sorted
+by target, so the --as stage can memory-map the arrays and take the evidence
+of each target as a slice instead of scanning the evidence index.
+
+The ancestor codes of each row are the slice efo_offsets[i]:efo_offsets[i+1]
+of efo_codes, and the rows of the i-th target the slice
+target_offsets[i]:target_offsets[i+1] of the other arrays.
+"""
+from builtins import object
+import array
+import functools
+import logging
+import os
+import shutil
+
+import numpy as np
+import simplejson as json
+
+
+DICTIONARIES = ["targets", "diseases", "datasources", "efo_codes"]
+ARRAYS = ["target", "disease", "datasource", "score", "efo_offsets", "efo_codes",
+    "target_offsets"]
+
+
+def scoring_fields(evidence):
+    """the (target, disease, efo codes, score, datasource) of an extended
+    evidence dict, the row it is written as"""
+    return (evidence['target']['id'], evidence['disease']['id'],
+        evidence['private']['efo_codes'], evidence['scores']['association_score'],
+        evidence['sourceID'])
+
+
+class _Dictionary(object):
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class EvidenceColumnsWriter(object):
+    """Collects the rows of the valid evidence and writes them sorted by target
+    to directory on close.
+
+    The arrays are written to a temporary directory next to it and moved in
+    place once complete, so a reader never sees a partial side-file.
+    """
+
+    def __init__(self, directory):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.dictionaries = dict((name, _Dictionary()) for name in DICTIONARIES)
+        self.target = array.array('i')
+        self.disease = array.array('i')
+        self.datasource = array.array('i')
+        self.score = array.array('d')
+        self.efo_offsets = array.array('q', [0])
+        self.efo_codes = array.array('i')
+
+    def __len__(self):
+        return len(self.target)
+
+    def add(self, row):
+        target, disease, efo_codes, score, datasource = row
+        self.target.append(self.dictionaries["targets"].code(target))
+        self.disease.append(self.dictionaries["diseases"].code(disease))
+        self.datasource.append(self.dictionaries["datasources"].code(datasource))
+        self.score.append(score)
+        codes = self.dictionaries["efo_codes"]
+        self.efo_codes.extend(codes.code(efo) for efo in efo_codes)
+        self.efo_offsets.append(len(self.efo_codes))
+
+    def arrays(self):
+        """the columns with the rows sorted by target"""
+        target = np.frombuffer(self.target, dtype=np.int32)
+        order = np.argsort(target, kind='stable')
+
+        efo_offsets = np.frombuffer(self.efo_offsets, dtype=np.int64)
+        lengths = np.diff(efo_offsets)[order]
+        sorted_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=sorted_offsets[1:])
+        #position of each sorted code in the unsorted codes
+        positions = np.repeat(efo_offsets[:-1][order] - sorted_offsets[:-1], lengths) \
+            + np.arange(sorted_offsets[-1], dtype=np.int64)
+
+        sorted_target = target[order]
+        #first row of each target, and the end of the last one
+        starts = np.flatnonzero(np.diff(sorted_target)) + 1
+        target_offsets = np.concatenate(([0], starts, [len(order)])).astype(np.int64)
+
+        return {
+            "target": sorted_target,
+            "disease": np.frombuffer(self.disease, dtype=np.int32)[order],
+            "datasource": np.frombuffer(self.datasource, dtype=np.int32)[order],
+            "score": np.frombuffer(self.score, dtype=np.float64)[order],
+            "efo_offsets": sorted_offsets,
+            "efo_codes": np.frombuffer(self.efo_codes, dtype=np.int32)[positions],
+            "target_offsets": target_offsets if len(order) else np.zeros(1, dtype=np.int64),
+        }
+
+    def close(self):
+        parent = os.path.dirname(os.path.abspath(self.directory))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        temporary = "%s.tmp-%d" % (os.path.abspath(self.directory), os.getpid())
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        for name, values in self.arrays().items():
+            np.save(os.path.join(temporary, name + ".npy"), values)
+        for name, dictionary in self.dictionaries.items():
+            with open(os.path.join(temporary, name + ".json"), "w") as f:
+                json.dump(dictionary.values, f)
+
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.rename(temporary, self.directory)
+        self.logger.info("wrote the scoring columns of %d evidence of %d targets to %s",
+            len(self), len(self.dictionaries["targets"].values), self.directory)
+
+
+class EvidenceColumns(object):
+    """The side-file written by EvidenceColumnsWriter, memory-mapped"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in DICTIONARIES:
+            with open(os.path.join(directory, name + ".json")) as f:
+                setattr(self, name, json.load(f))
+        for name in ARRAYS:
+            setattr(self, "_" + name, np.load(os.path.join(directory, name + ".npy"),
+                mmap_mode='r'))
+
+    def __len__(self):
+        return len(self._score)
+
+    @property
+    def target_count(self):
+        return len(self._target_offsets) - 1
+
+    def target_chunks(self, chunk_size):
+        """(start, end) ranges of chunk_size targets covering all of them"""
+        return [(start, min(start + chunk_size, self.target_count))
+            for start in range(0, self.target_count, chunk_size)]
+
+    def target_evidence(self, start, end):
+        """yield the evidence of the targets start to end, as lists of dicts
+        with the fields the association scoring reads"""
+        for i in range(start, end):
+            first, last = self._target_offsets[i], self._target_offsets[i + 1]
+            yield self._rows(first, last)
+
+    def _rows(self, first, last):
+        disease = self._disease[first:last].tolist()
+        datasource = self._datasource[first:last].tolist()
+        score = self._score[first:last].tolist()
+        efo_offsets = (self._efo_offsets[first:last + 1] - self._efo_offsets[first]).tolist()
+        efo_codes = [self.efo_codes[c] for c in
+            self._efo_codes[self._efo_offsets[first]:self._efo_offsets[last]].tolist()]
+        target = self.targets[int(self._target[first])] if last > first else None
+
+        rows = []
+        for j in range(last - first):
+            rows.append({
+                'target': {'id': target},
+                'disease': {'id': self.diseases[disease[j]]},
+                'private': {'efo_codes': efo_codes[efo_offsets[j]:efo_offsets[j + 1]]},
+                'scores': {'association_score': score[j]},
+                'sourceID': self.datasources[datasource[j]],
+            })
+        return rows
+
+
+@functools.lru_cache(maxsize=None)
+def open_evidence_columns(directory):
+    """the EvidenceColumns of directory, opened once in each process"""
+    return EvidenceColumns(directory)
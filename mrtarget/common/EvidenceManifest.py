@@ -0,0 +1,135 @@
+"""
+Manifest of the evidence lines already loaded, for incremental validation.
+
+It is a sqlite file with the fingerprint of each input file, and for each
+line the md5 of its raw bytes and the id and index of the document it was
+written as. A later run skips the files with the same fingerprint and the
+lines with a known hash, and gives back the documents of the lines that are
+not in the input anymore so they can be deleted. The hashes of the lines
+read are kept in a temporary table of the same connection, so the lines no
+longer in the input are found by sqlite and not in memory.
+"""
+from builtins import object
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+
+class EvidenceManifest(object):
+
+    def __init__(self, filename):
+        self.logger = logging.getLogger(__name__)
+        self.filename = filename
+        #lines are read by the main thread and recorded by the thread writing
+        #to elasticsearch, so the connection is used by one of them at a time
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files "
+            "(filename TEXT PRIMARY KEY, fingerprint TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS lines "
+            "(filename TEXT, line_hash BLOB, doc_index TEXT, doc_id TEXT, "
+            "PRIMARY KEY (filename, line_hash))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS lines_doc "
+            "ON lines (doc_index, doc_id)")
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS seen "
+            "(filename TEXT, line_hash BLOB, PRIMARY KEY (filename, line_hash))")
+
+        #filled by plan
+        self.fingerprints = {}
+        self.changed = []
+        #filled while the lines are read and written
+        self.pending = {}
+        self.skipped = 0
+
+    @staticmethod
+    def fingerprint(filename):
+        """size and modification time of a local file, None for remote ones
+        which always have their lines compared"""
+        path = filename[len('file://'):] if filename.startswith('file://') else filename
+        if '://' in path or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        return "%d:%d" % (stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def line_hash(line):
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        return hashlib.md5(line).digest()
+
+    def plan(self, filenames):
+        """return the filenames that have to be read, the ones with a changed
+        fingerprint"""
+        previous = dict(self.connection.execute("SELECT filename, fingerprint FROM files"))
+        for filename in filenames:
+            self.fingerprints[filename] = self.fingerprint(filename)
+            if self.fingerprints[filename] is not None and \
+                    previous.get(filename) == self.fingerprints[filename]:
+                self.logger.info("skipping unchanged file %s", filename)
+                continue
+            self.changed.append(filename)
+        return list(self.changed)
+
+    def filter_lines(self, lines):
+        """yield only the new or changed lines of (filename, (line_n, line))"""
+        for line in lines:
+            filename, (line_n, l) = line
+            line_hash = self.line_hash(l)
+            with self.lock:
+                self.connection.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)",
+                    (filename, line_hash))
+                known = self.connection.execute("SELECT 1 FROM lines "
+                    "WHERE filename = ? AND line_hash = ?", (filename, line_hash)).fetchone()
+            if known:
+                self.skipped += 1
+                continue
+            self.pending[(filename, line_n)] = line_hash
+            yield line
+
+    def record(self, filename, line_n, doc_index, doc_id):
+        """store the document a line read by filter_lines was written as"""
+        line_hash = self.pending.pop((filename, line_n))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO lines VALUES (?, ?, ?, ?)",
+                (filename, line_hash, doc_index, doc_id))
+
+    def removed_documents(self, filenames):
+        """forget the lines not in the input anymore, in the files read this
+        time and in the files that are not part of the input at all, and
+        return the (index, id) of their documents no other line still has"""
+        removed = []
+        not_seen = "FROM lines WHERE filename = ? AND NOT EXISTS (SELECT 1 FROM seen " \
+            "WHERE seen.filename = lines.filename AND seen.line_hash = lines.line_hash)"
+        for filename in self.changed:
+            removed.extend(self.connection.execute("SELECT doc_index, doc_id " + not_seen,
+                (filename,)))
+            self.connection.execute("DELETE " + not_seen, (filename,))
+        for (filename,) in list(self.connection.execute("SELECT filename FROM files")):
+            if filename not in filenames:
+                self.logger.info("forgetting file %s no longer in the input", filename)
+                removed.extend(self.connection.execute("SELECT doc_index, doc_id FROM lines "
+                    "WHERE filename = ?", (filename,)))
+                self.connection.execute("DELETE FROM lines WHERE filename = ?", (filename,))
+                self.connection.execute("DELETE FROM files WHERE filename = ?", (filename,))
+
+        still_used = set()
+        for doc_index, doc_id in set(removed):
+            if self.connection.execute("SELECT 1 FROM lines WHERE doc_index = ? AND doc_id = ?",
+                    (doc_index, doc_id)).fetchone():
+                still_used.add((doc_index, doc_id))
+        #documents with no index were not written to elasticsearch
+        return sorted(d for d in set(removed) - still_used if d[0] is not None)
+
+    def commit(self):
+        """store the fingerprints of the files read, only once all their lines
+        have been written"""
+        for filename, fingerprint in self.fingerprints.items():
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                (filename, fingerprint))
+        self.connection.commit()
+        self.logger.info("skipped %d unchanged lines", self.skipped)
+
+    def close(self):
+        self.connection.close()
@@ -149,6 +149,65 @@ class EvidenceManager(object):
         self.datasources_to_datatypes = datasources_to_datatypes
 
 
+    def prefetch(self, evidences):
+        """take a window of raw evidence dicts and fetch the targets, diseases
+        and evidence codes they refer to with one request per lookup table, so
+        validating, fixing and extending them does not query one id at a time
+
+        ids that are only known after fixing (e.g. uniprot mapped targets) are
+        still looked up individually"""
+        gene_ids = set()
+        efo_ids = set()
+        eco_ids = set()
+        for evidence in evidences:
+            if not isinstance(evidence, dict):
+                continue
+            #evidence is not validated yet so anything could be here
+            try:
+                target_id = evidence['target']['id']
+                if 'ensembl' in target_id:
+                    gene_ids.add(target_id.split('/')[-1])
+            except (KeyError, TypeError, AttributeError):
+                pass
+            try:
+                disease_id = evidence['disease']['id']
+                #validation and fixing shorten the url in different ways
+                efo_ids.add(disease_id.split('/')[-1])
+                efo_ids.add(get_ontology_code_from_url(disease_id))
+            except (KeyError, TypeError, AttributeError):
+                pass
+            eco_ids.update(self._find_evidence_codes(evidence.get('evidence')))
+        efo_ids.discard(None)
+        eco_ids.discard(None)
+
+        self.available_genes.prefetch(gene_ids)
+        self.available_efos.prefetch(efo_ids)
+        self.available_ecos.prefetch(eco_ids)
+
+    def clear_prefetch(self):
+        self.available_genes.clear_prefetch()
+        self.available_efos.clear_prefetch()
+        self.available_ecos.clear_prefetch()
+
+    @staticmethod
+    def _find_evidence_codes(obj):
+        """collect every evidence code (and functional consequence) nested
+        anywhere in the evidence section, as short ontology codes"""
+        codes = set()
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key == 'evidence_codes' and isinstance(value, list):
+                    codes.update(get_ontology_code_from_url(code.strip())
+                        for code in value if isinstance(code, str))
+                elif key == 'functional_consequence' and isinstance(value, str):
+                    codes.add(get_ontology_code_from_url(value))
+                else:
+                    codes.update(EvidenceManager._find_evidence_codes(value))
+        elif isinstance(obj, list):
+            for value in obj:
+                codes.update(EvidenceManager._find_evidence_codes(value))
+        return codes
+
     # @do_profile()#follow=[])
     def fix_evidence(self, evidence):
 
@@ -10,6 +10,12 @@ import mrtarget
 import pkg_resources as res
 from opentargets_urlzsource import URLZSource
 
+#optional, for zstd compressed output
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 
 def urllify(string_name):
@@ -45,16 +51,67 @@ def open_to_write(filename):
         return open(filename,'w')
 
 
+class RotatingLineWriter(object):
+    """write lines to a series of compressed files in `directory`, starting a
+    new file every `lines_per_file` lines. The files are named 
+    <prefix>-0000.jsonl.gz (or .zst) and so on.
+
+    compression is gzip or, with the zstandard package installed, zstd
+    """
+    COMPRESSIONS = ['gzip', 'zstd']
+
+    def __init__(self, directory, prefix, lines_per_file=1000000, compression='gzip'):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError("unknown compression %s" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.directory = directory
+        self.prefix = prefix
+        self.lines_per_file = lines_per_file
+        self.compression = compression
+        self.filenames = []
+        self.file = None
+        self.lines = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _open_next(self):
+        self.close()
+        extension = "gz" if self.compression == 'gzip' else "zst"
+        filename = os.path.join(self.directory, "%s-%04d.jsonl.%s" % (self.prefix, 
+            len(self.filenames), extension))
+        if self.compression == 'gzip':
+            self.file = gzip.open(filename, 'wb')
+        else:
+            self.file = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        self.filenames.append(filename)
+        self.lines = 0
+
+    def write(self, line):
+        if self.file is None or self.lines >= self.lines_per_file:
+            self._open_next()
+        if not isinstance(line, bytes):
+            line = line.encode("utf-8")
+        self.file.write(line + b"\n")
+        self.lines += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
 def open_to_read(filename):
     """return an iterator from izip (filename, (enumerate(file_handle, start=1))"""
     it = more_itertools.with_iter(URLZSource(filename).open())
     return zip(itertools.cycle([filename]), enumerate(it, start=1))
 
 
-def make_iter_lines(iterable_of_filenames, first_n=0):
+def make_iter_lines(iterable_of_filenames, first_n=0, chunk_size=0):
     """return an iterator of lines for all filenames in `iterable_of_filenames`. It returns
     each element from the iterator is  in the shape of (filenae, (line_n, line)) starting
     from line_n = 1. If `first_n` is > 0 then only first n lines will be taken from the iter.
+    If `chunk_size` is > 0 then it returns lists of up to that many lines instead.
     """
     it = iter(iterable_of_filenames)
 
@@ -62,8 +119,99 @@ def make_iter_lines(iterable_of_filenames, first_n=0):
 
     it_lines = itertools.chain.from_iterable(filter(lambda e: e is not None, in_handles))
 
-    return more_itertools.take(first_n, it_lines) \
-        if first_n > 0 else it_lines
+    if first_n > 0:
+        it_lines = more_itertools.take(first_n, it_lines)
+
+    return more_itertools.chunked(it_lines, chunk_size) \
+        if chunk_size > 0 else it_lines
+
+
+def _splittable_path(filename):
+    """the path of a plain local file that can be read from any offset, or None
+    for remote or compressed files"""
+    if filename.startswith('file://'):
+        filename = filename[len('file://'):]
+    elif '://' in filename:
+        return None
+    if filename.endswith('.gz') or filename.endswith('.gzip') or filename.endswith('.zip'):
+        return None
+    return filename
+
+
+def make_splits(iterable_of_filenames, split_size):
+    """return a list of (filename, start, end, line_n) splits of the files in 
+    `iterable_of_filenames`, to be read independently with `iter_split_lines`.
+
+    Plain local files are split in byte ranges of about `split_size` bytes,
+    ending just after a newline, found by reading a single line at each 
+    boundary, and line_n is the line number in the file of the first line of
+    the split, counted from the newlines before it. Compressed or remote files
+    can't be read from the middle, so they are one split each with start 0,
+    end None and line_n 1.
+    """
+    splits = []
+    for filename in iterable_of_filenames:
+        path = _splittable_path(filename)
+        if path is None or split_size <= 0:
+            splits.append((filename, 0, None, 1))
+        else:
+            splits.extend(_plain_file_splits(filename, path, split_size))
+    return splits
+
+
+def _count_newlines(f, start, end, chunk_size=1 << 20):
+    """count the newlines of the bytes from start to end of file f"""
+    count = 0
+    f.seek(start)
+    while start < end:
+        chunk = f.read(min(chunk_size, end - start))
+        if not chunk:
+            break
+        count += chunk.count(b'\n')
+        start += len(chunk)
+    return count
+
+
+def _plain_file_splits(filename, path, split_size):
+    splits = []
+    size = os.path.getsize(path)
+    start = 0
+    line_n = 1
+    with open(path, 'rb') as f:
+        while start < size:
+            #the rest of the line at start + split_size is in this split
+            f.seek(start + split_size)
+            f.readline()
+            end = f.tell()
+            if end >= size:
+                splits.append((filename, start, None, line_n))
+                break
+            splits.append((filename, start, end, line_n))
+            line_n += _count_newlines(f, start, end)
+            start = end
+    return splits
+
+
+def iter_split_lines(split):
+    """return an iterator of the lines of a split made by `make_splits`, in the
+    same (filename, (line_n, line)) shape as `make_iter_lines`, lines as bytes
+    numbered by their line in the file."""
+    filename, start, end, first_line_n = split
+    path = _splittable_path(filename)
+    if path is None:
+        for line_n, line in enumerate(more_itertools.with_iter(URLZSource(filename).open()), 
+                start=first_line_n):
+            yield filename, (line_n, line)
+        return
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line_n, line in enumerate(f, start=first_line_n):
+            if end is not None and position >= end:
+                break
+            yield filename, (line_n, line)
+            position += len(line)
 
 
 def file_or_resource(fname):
@@ -0,0 +1,139 @@
+"""
+Readers of the indexes written by the previous stages.
+
+The stages read their inputs by scanning whole indexes. An
+ElasticsearchIndexReader scans them from the cluster, and a FolderIndexReader
+reads them from the folder written with --elasticsearch-folder, so a run can
+go from one stage to the next without refreshing, force merging and
+scrolling an index in between.
+
+Both yield hits with an _id and a _source like parallel_scan. The folder
+reader only understands the queries the stages scan with: match_all, ids,
+and term or match on a single field, with the _source filtered by a field
+name, a list of them, includes, or False.
+"""
+from builtins import object
+import logging
+import os
+
+from mrtarget.common.esfile import iter_folder_actions
+from mrtarget.common.esutil import parallel_scan, alias_indices
+
+
+class ElasticsearchIndexReader(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def __contains__(self, index):
+        return True
+
+    def scan(self, index, query=None, workers=1):
+        """the hits of the query, the partitions behind an alias read at the
+        same time"""
+        return parallel_scan(self.client, alias_indices(self.client, index), query,
+            workers=workers)
+
+
+def _field_values(source, field):
+    """the values of a dotted field, several when it goes through lists"""
+    values = [source]
+    for part in field.split('.'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                next_values.extend(v.get(part) for v in value if isinstance(v, dict))
+            elif isinstance(value, dict) and part in value:
+                next_values.append(value[part])
+        values = next_values
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def _matcher(query):
+    """a function of (_id, _source) for the supported queries"""
+    query = (query or {}).get("query", {"match_all": {}})
+    if len(query) != 1:
+        raise ValueError("unsupported query %s" % query)
+    kind, body = list(query.items())[0]
+
+    if kind == "match_all":
+        return lambda doc_id, source: True
+    if kind == "ids":
+        ids = set(body["values"])
+        return lambda doc_id, source: doc_id in ids
+    if kind in ("term", "match") and len(body) == 1:
+        field, value = list(body.items())[0]
+        if isinstance(value, dict):
+            value = value.get("value", value.get("query"))
+        return lambda doc_id, source: value in _field_values(source, field)
+    raise ValueError("unsupported query %s" % query)
+
+
+def _set_field(target, source, parts):
+    if parts[0] not in source:
+        return
+    if len(parts) == 1:
+        target[parts[0]] = source[parts[0]]
+    elif isinstance(source[parts[0]], dict):
+        _set_field(target.setdefault(parts[0], {}), source[parts[0]], parts[1:])
+
+
+def _source_filter(query):
+    """a function keeping the fields of a _source the query asks for"""
+    fields = (query or {}).get("_source", True)
+    if fields is True:
+        return lambda source: source
+    if fields is False:
+        return lambda source: {}
+    if isinstance(fields, dict):
+        fields = fields.get("includes", [])
+    if not isinstance(fields, list):
+        fields = [fields]
+
+    def filter_source(source):
+        filtered = {}
+        for field in fields:
+            _set_field(filtered, source, field.split('.'))
+        return filtered
+    return filter_source
+
+
+class FolderIndexReader(object):
+    """reads the indexes of a folder written by esfile, and the others from
+    the fallback reader if there is one"""
+
+    def __init__(self, folder, fallback=None):
+        self.logger = logging.getLogger(__name__)
+        self.folder = folder
+        self.fallback = fallback
+
+    def __contains__(self, index):
+        return os.path.isdir(os.path.join(self.folder, index))
+
+    def scan(self, index, query=None, workers=1):
+        """the hits of the query. The files are read in turn, decoding is bound
+        to a single core anyway, so workers is only used by the fallback"""
+        if index not in self and self.fallback is not None:
+            self.logger.debug("reading %s from the fallback", index)
+            return self.fallback.scan(index, query, workers)
+        return self._scan(index, query)
+
+    def _scan(self, index, query):
+        matches = _matcher(query)
+        filter_source = _source_filter(query)
+        for action in iter_folder_actions(self.folder, index):
+            if matches(action["_id"], action["_source"]):
+                yield {"_index": action["_index"], "_id": action["_id"],
+                    "_source": filter_source(action["_source"])}
+
+
+def new_index_reader(client, folder=None):
+    """the reader of the stage inputs, from the folder when the stages write to
+    one and from elasticsearch for the indexes not in it"""
+    reader = ElasticsearchIndexReader(client)
+    if folder:
+        reader = FolderIndexReader(folder, reader)
+    return reader
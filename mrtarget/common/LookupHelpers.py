@@ -1,12 +1,18 @@
 from builtins import object
+import contextlib
+import hashlib
 import logging
 import os
+import re
+import shutil
+import tempfile
 import time
 
 from mrtarget.common.LookupTables import ECOLookUpTable
 from mrtarget.common.LookupTables import EFOLookUpTable
 from mrtarget.common.LookupTables import HPALookUpTable
 from mrtarget.common.LookupTables import GeneLookUpTable
+from mrtarget.common.LookupSnapshot import LookupSnapshot, SNAPSHOT_MAGIC
 
 from mrtarget.common.IO import file_or_resource
 
@@ -20,6 +26,15 @@ class LookUpData(object):
         self.non_reference_genes = None
         self.mp_ontology = None
 
+    def metrics(self):
+        """structured cache metrics of each of the lookup tables in use"""
+        metrics = {}
+        for name in ("available_genes", "available_efos", "available_ecos", "available_hpa"):
+            table = getattr(self, name)
+            if table is not None:
+                metrics[name] = table.metrics()
+        return metrics
+
 class LookUpDataRetriever(object):
     def __init__(self, es,
             gene_index = None, 
@@ -32,26 +47,40 @@ class LookUpDataRetriever(object):
             hpa_cache_size = 0,
             efo_index = None,
             efo_cache_size = 0,
-            efo_cache_contains_size = 0
+            efo_cache_contains_size = 0,
+            preload = False,
+            snapshot_files = None,
+            cache_dir = None
             ):
 
         self.es = es
         self.lookup = LookUpData()
         self._logger = logging.getLogger(__name__)
 
+        #snapshot files written by build_lookup_snapshots, keyed by table
+        if snapshot_files is None and cache_dir:
+            snapshot_files = build_lookup_snapshots(self.es, cache_dir, persistent=True,
+                gene_index=gene_index, efo_index=efo_index, 
+                eco_index=eco_index, hpa_index=hpa_index)
+        snapshots = {}
+        for key, filename in (snapshot_files or {}).items():
+            snapshots[key] = LookupSnapshot(filename)
+
         if gene_index is not None:
             self.lookup.available_genes = GeneLookUpTable(self.es, gene_index,
-                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size)
+                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size,
+                preload=preload, snapshot=snapshots.get("gene"))
             self._get_non_reference_gene_mappings()
         if efo_index is not None:
             self.lookup.available_efos = EFOLookUpTable(self.es, efo_index,
-            efo_cache_size, efo_cache_contains_size)
+            efo_cache_size, efo_cache_contains_size, preload=preload,
+            snapshot=snapshots.get("efo"))
         if eco_index is not None:
             self.lookup.available_ecos = ECOLookUpTable(self.es, eco_index, 
-            eco_cache_size)
+            eco_cache_size, preload=preload, snapshot=snapshots.get("eco"))
         if hpa_index is not None:
             self.lookup.available_hpa = HPALookUpTable(self.es, hpa_index, 
-            hpa_cache_size)
+            hpa_cache_size, snapshot=snapshots.get("hpa"))
 
 
     def _get_non_reference_gene_mappings(self):
@@ -74,3 +103,89 @@ class LookUpDataRetriever(object):
 
 
 
+
+
+def index_fingerprint(es, index):
+    """short hash of the uuid(s) and document count of an index or alias
+
+    a rebuilt index gets a new uuid, so the fingerprint changes whenever the
+    stage that produces the index runs again"""
+    settings = es.indices.get_settings(index=index)
+    uuids = sorted(v["settings"]["index"]["uuid"] for v in settings.values())
+    count = es.count(index=index)["count"]
+    return hashlib.sha1(("%s %d" % (" ".join(uuids), count)).encode("utf-8")).hexdigest()[:16]
+
+
+def _remove_stale_snapshots(directory, prefix, keep):
+    pattern = re.compile(re.escape(prefix)+r"[0-9a-f]{16}\.snapshot$")
+    for filename in os.listdir(directory):
+        if pattern.match(filename) and filename != keep:
+            os.remove(os.path.join(directory, filename))
+
+
+def build_lookup_snapshots(es, directory, persistent=False, gene_index=None, 
+        efo_index=None, eco_index=None, hpa_index=None):
+    """write a snapshot file in directory for each of the given indexes
+
+    returns a dict suitable for the snapshot_files argument of
+    LookUpDataRetriever, so that the children processes can open the
+    snapshots instead of each of them querying elasticsearch
+
+    when persistent, the file names include a fingerprint of the index and
+    an existing file is reused instead of being built again, so that later
+    stages and runs share it until the index is rebuilt. Snapshots of older
+    versions of the same index are removed"""
+    logger = logging.getLogger(__name__)
+    tables = (("gene", gene_index, GeneLookUpTable),
+        ("efo", efo_index, EFOLookUpTable),
+        ("eco", eco_index, ECOLookUpTable),
+        ("hpa", hpa_index, HPALookUpTable))
+
+    if persistent and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    snapshot_files = {}
+    for key, index, table in tables:
+        if index is None:
+            continue
+        if persistent:
+            prefix = "%s-%s-" % (key, index)
+            #with the file format, so files of an older format are rebuilt
+            fingerprint = hashlib.sha1(SNAPSHOT_MAGIC + 
+                index_fingerprint(es, index).encode("utf-8")).hexdigest()[:16]
+            basename = prefix+fingerprint+".snapshot"
+        else:
+            basename = key+".snapshot"
+        filename = os.path.join(directory, basename)
+
+        if persistent and os.path.exists(filename):
+            logger.info("reusing lookup snapshot %s of %s", filename, index)
+        else:
+            start = time.time()
+            count = table.build_snapshot(es, index, filename)
+            logger.info("wrote %d documents of %s to %s in %.1fs", 
+                count, index, filename, time.time()-start)
+        if persistent:
+            _remove_stale_snapshots(directory, prefix, basename)
+        snapshot_files[key] = filename
+    return snapshot_files
+
+
+@contextlib.contextmanager
+def lookup_snapshots(es, enabled, cache_dir=None, **indexes):
+    """context manager around build_lookup_snapshots writing the snapshots to
+    a temporary directory that is removed on exit, or to cache_dir where
+    they are kept for later stages and runs
+
+    yields None when not enabled so the caller can pass it straight through"""
+    if cache_dir:
+        yield build_lookup_snapshots(es, cache_dir, persistent=True, **indexes)
+        return
+    if not enabled:
+        yield None
+        return
+    directory = tempfile.mkdtemp(prefix="mrtarget-lookup-")
+    try:
+        yield build_lookup_snapshots(es, directory, **indexes)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
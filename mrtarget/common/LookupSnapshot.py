@@ -0,0 +1,197 @@
+"""
+Read-only, memory-mapped snapshot of lookup documents.
+
+A snapshot is written once by the parent process and opened by every child
+process. Because the file is memory-mapped read-only the operating system
+shares the pages between all the processes, so adding more workers does not
+duplicate the documents, nor the index of their ids.
+
+The file layout is:
+
+    MAGIC | document bytes ... | tables ... | header json | header offset (8 bytes)
+
+Each table maps string keys to byte values: the document ids to the documents
+and, for the maps, e.g. uniprot accessions to ensembl ids. A table is the keys
+and values bytes followed by an array of fixed size entries of the (offset,
+length) of the key and of the value, sorted by key, so a key is found by a
+binary search in the file and opening a snapshot only decodes the small
+header of the table positions and the extra json.
+"""
+from builtins import object
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+import simplejson as json
+
+SNAPSHOT_MAGIC = b"MRTSNAP2"
+_OFFSET_STRUCT = struct.Struct("<Q")
+#key offset, key length, value offset, value length
+_ENTRY_STRUCT = struct.Struct("<QQQQ")
+
+
+def _write_table(out, offset, items):
+    """write the (key, value bytes) items as a table at offset, returning the
+    [entries offset, count] of the table and the offset after it"""
+    entries = []
+    for key, value in items:
+        if not isinstance(value, tuple):
+            #a value not already written
+            out.write(value)
+            value = (offset, len(value))
+            offset += value[1]
+        key = key.encode("utf-8")
+        out.write(key)
+        entries.append((key, offset, value))
+        offset += len(key)
+    entries.sort(key=lambda entry: entry[0])
+    table = [offset, len(entries)]
+    for key, key_offset, (value_offset, value_length) in entries:
+        out.write(_ENTRY_STRUCT.pack(key_offset, len(key), value_offset, value_length))
+        offset += _ENTRY_STRUCT.size
+    return table, offset
+
+
+def write_snapshot(filename, docs, extra=None, maps=None):
+    """write an iterable of (id, dict) pairs as a snapshot file
+
+    maps is a dict of name to a dict of strings to look up in the file as
+    well, and extra a dict of small json to be decoded on opening. Either can
+    be a callable returning it that is only called after all the documents
+    have been consumed (so it can be filled while iterating)
+
+    the file is written under a temporary name and renamed at the end so a
+    snapshot file is either complete or not there at all"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    index = []
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(SNAPSHOT_MAGIC)
+            offset = len(SNAPSHOT_MAGIC)
+            for doc_id, doc in docs:
+                data = json.dumps(doc).encode("utf-8")
+                out.write(data)
+                index.append((doc_id, (offset, len(data))))
+                offset += len(data)
+
+            tables = {}
+            tables["docs"], offset = _write_table(out, offset, index)
+            if callable(maps):
+                maps = maps()
+            for name, mapping in (maps or {}).items():
+                tables["map:" + name], offset = _write_table(out, offset,
+                    ((key, value.encode("utf-8")) for key, value in mapping.items()))
+
+            if callable(extra):
+                extra = extra()
+            header = json.dumps({"tables": tables, "extra": extra or {}}).encode("utf-8")
+            out.write(header)
+            out.write(_OFFSET_STRUCT.pack(offset))
+        os.rename(tmp_filename, filename)
+    except Exception:
+        os.remove(tmp_filename)
+        raise
+    return len(index)
+
+
+class SnapshotTable(object):
+    """a table of a snapshot, looked up in the memory map"""
+
+    def __init__(self, mm, entries, count):
+        self._mmap = mm
+        self._entries = entries
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        return _ENTRY_STRUCT.unpack_from(self._mmap, self._entries + i * _ENTRY_STRUCT.size)
+
+    def _find(self, key):
+        """the (offset, length) of the value of key, or None"""
+        key = key.encode("utf-8")
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = self._entry(middle)
+            found = self._mmap[key_offset:key_offset + key_length]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return value_offset, value_length
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __iter__(self):
+        for i in range(self._count):
+            key_offset, key_length, _, _ = self._entry(i)
+            yield self._mmap[key_offset:key_offset + key_length].decode("utf-8")
+
+    def value(self, key):
+        """the bytes of the value of key, or None"""
+        found = self._find(key)
+        if found is None:
+            return None
+        offset, length = found
+        return self._mmap[offset:offset + length]
+
+    def get(self, key, default=None):
+        value = self.value(key)
+        return default if value is None else value.decode("utf-8")
+
+
+class LookupSnapshot(object):
+    """read-only access to a snapshot file written by write_snapshot"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not a lookup snapshot" % filename)
+
+        trailer_start = len(self._mmap) - _OFFSET_STRUCT.size
+        header_start = _OFFSET_STRUCT.unpack(self._mmap[trailer_start:])[0]
+        header = json.loads(self._mmap[header_start:trailer_start].decode("utf-8"))
+        tables = dict((name, SnapshotTable(self._mmap, entries, count))
+            for name, (entries, count) in header["tables"].items())
+        self._index = tables["docs"]
+        self.maps = dict((name[len("map:"):], table)
+            for name, table in tables.items() if name.startswith("map:"))
+        self.extra = header["extra"]
+
+    def __contains__(self, doc_id):
+        return doc_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def ids(self):
+        return iter(self._index)
+
+    def get(self, doc_id, default=None):
+        data = self._index.value(doc_id)
+        if data is None:
+            return default
+        return json.loads(data.decode("utf-8"))
+
+    def iterate(self):
+        for doc_id in self._index:
+            yield doc_id, self.get(doc_id)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    #not pickleable, pass the filename to other processes instead
+    def __getstate__(self):
+        raise TypeError("pass LookupSnapshot.filename between processes, not the object")
@@ -1,24 +1,122 @@
 from __future__ import division
 from builtins import object
-from past.utils import old_div
 import logging
 
+import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import Match,Bool
 
 import cachetools
 import sys
 
+from mrtarget.common.LookupSnapshot import write_snapshot
+
 #TODO remove this class, migrate each of these to where they are actually used
 
+def _scan_index(es, index, includes):
+    """scan every document of an index returning (id, source) pairs with the
+    _source restricted to the `includes` fields (an empty list means no _source,
+    True means the whole document)"""
+    query = {"query": {"match_all": {}}, "_source": includes if includes else False}
+    for hit in elasticsearch.helpers.scan(client=es, query=query, index=index,
+            scroll='4h', size=1000):
+        yield hit['_id'], hit.get('_source', {})
+
+def _mget_index(es, index, ids):
+    """fetch many documents of an index by id with a single mget request
+    returning (id, source) pairs where source is None for missing ids"""
+    if not ids:
+        return
+    response = es.mget(index=index, body={"ids": list(ids)})
+    for doc in response["docs"]:
+        yield doc["_id"], doc.get("_source") if doc.get("found") else None
+
+def deep_getsizeof(obj):
+    """approximate memory used by an object and everything it contains, for
+    the json-like documents stored in the lookup caches"""
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+class LookupCache(cachetools.LRUCache):
+    """LRU cache sized by the deep size of the cached values in bytes
+
+    values that would not fit even in an empty cache are not stored rather
+    than raising, and hits, queries, evictions and rejections are counted
+    so metrics() can report how well the cache is sized"""
+
+    def __init__(self, maxsize):
+        super(LookupCache, self).__init__(maxsize, getsizeof=deep_getsizeof)
+        self.hits = 0
+        self.queries = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def __setitem__(self, key, value):
+        try:
+            super(LookupCache, self).__setitem__(key, value)
+        except ValueError:
+            #value too large for this cache
+            self.rejected += 1
+
+    def popitem(self):
+        item = super(LookupCache, self).popitem()
+        self.evictions += 1
+        return item
+
+    def metrics(self):
+        return {
+            "maxsize": self.maxsize,
+            "currsize": self.currsize,
+            "items": len(self),
+            "queries": self.queries,
+            "hits": self.hits,
+            "hit_ratio": float(self.hits)/self.queries if self.queries else None,
+            "evictions": self.evictions,
+            "rejected": self.rejected,
+        }
+
+def _preload_metrics(table):
+    metrics = {
+        "ids": len(table.preload_ids),
+        "queries": table.preload_queries,
+        "hits": table.preload_hits,
+    }
+    if getattr(table, "preload_u2e", None) is not None:
+        metrics["uniprot"] = len(table.preload_u2e)
+    return metrics
+
+def _add_uniprot_mapping(u2e, ambiguous, source):
+    """add the uniprot ids of a gene document to a uniprot to ensembl
+    mapping, recording uniprot ids claimed by more than one gene"""
+    uniprot_ids = set(source.get("uniprot_accessions") or [])
+    if source.get("uniprot_id"):
+        uniprot_ids.add(source["uniprot_id"])
+    for uniprot_id in uniprot_ids:
+        if uniprot_id in u2e:
+            ambiguous.add(uniprot_id)
+        u2e[uniprot_id] = source.get("ensembl_gene_id")
+
+
 class HPALookUpTable(object):
 
-    def __init__(self, es, index, cachesize):
+    def __init__(self, es, index, cachesize, snapshot=None):
         self._es = es
         self._es_index = index
-        self.cache = cachetools.LRUCache(cachesize, getsizeof=sys.getsizeof)
-        self.cache.hits = 0
-        self.cache.queries = 0
+        self.cache = LookupCache(cachesize)
+        self.snapshot = snapshot
+
+    @staticmethod
+    def build_snapshot(es, index, filename):
+        return write_snapshot(filename, _scan_index(es, index, True))
 
     def get_hpa(self, hpa_id):
 
@@ -27,6 +125,11 @@ class HPALookUpTable(object):
             self.cache.hits += 1
             return self.cache[hpa_id]
 
+        if self.snapshot is not None:
+            val = self.snapshot.get(hpa_id)
+            self.cache[hpa_id] = val
+            return val
+
         response = Search().using(self._es).index(self._es_index).query(Match(_id=hpa_id))[0:1].execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
@@ -40,41 +143,112 @@ class HPALookUpTable(object):
             return val
         #can't have multiple hits, primary key!
 
+    def metrics(self):
+        """structured hit ratio, eviction and memory figures of the caches"""
+        return {"cache": self.cache.metrics()}
+
     def __del__(self):
-        logger = logging.getLogger(__name__+".HPALookUpTable")
-        if self.cache.queries == 0:
-            if self.cache.maxsize > 0:
-                logger.debug("cache {} occupied 100 hitrate".format(
-                    old_div((self.cache.currsize*100),self.cache.maxsize)))
-        else:
-            logger.debug("cache {} occupied {} hitrate".format(
-                old_div((self.cache.currsize*100),self.cache.maxsize),
-                old_div((self.cache.hits*100),self.cache.queries) ))
+        logging.getLogger(__name__+".HPALookUpTable").debug("metrics %s", self.metrics())
 
 class GeneLookUpTable(object):
 
-    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size):
+    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size,
+            preload=False, snapshot=None):
         self._es = es
         self._es_index = es_index
 
-        self.cache_gene = cachetools.LRUCache(cache_gene_size, getsizeof=sys.getsizeof)
-        self.cache_gene.hits = 0
-        self.cache_gene.queries = 0
-        self.cache_u2e = cachetools.LRUCache(cache_u2e_size, getsizeof=sys.getsizeof)
-        self.cache_u2e.hits = 0
-        self.cache_u2e.queries = 0
-        self.cache_contains = cachetools.LRUCache(cache_contains_size, getsizeof=sys.getsizeof)
-        self.cache_contains.hits = 0
-        self.cache_contains.queries = 0
+        self.cache_gene = LookupCache(cache_gene_size)
+        self.cache_u2e = LookupCache(cache_u2e_size)
+        self.cache_contains = LookupCache(cache_contains_size)
+
+        #when preloaded, these hold every gene id and uniprot to ensembl mapping
+        #of the index so membership and mapping never go to elasticsearch
+        self.preloaded = False
+        self.preload_ids = None
+        self.preload_u2e = None
+        self.snapshot = None
+        #documents fetched in bulk by prefetch, until clear_prefetch
+        self.prefetched = {}
+        if snapshot is not None:
+            self.use_snapshot(snapshot)
+        elif preload:
+            self.preload()
+
+    def preload(self):
+        """scan the whole index once keeping only the ids and the uniprot
+        to ensembl mapping in memory"""
+        self.preload_ids = set()
+        self.preload_u2e = {}
+        ambiguous = set()
+        for gene_id, source in _scan_index(self._es, self._es_index,
+                ["ensembl_gene_id", "uniprot_id", "uniprot_accessions"]):
+            self.preload_ids.add(gene_id)
+            _add_uniprot_mapping(self.preload_u2e, ambiguous, source)
+
+        #keep track of uniprot ids mapped by more than one gene so
+        #they raise the same error as the query based lookup
+        self.preload_u2e_ambiguous = frozenset(ambiguous)
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    def use_snapshot(self, snapshot):
+        """answer every lookup from a LookupSnapshot instead of elasticsearch"""
+        self.snapshot = snapshot
+        self.preload_ids = snapshot
+        self.preload_u2e = snapshot.maps["u2e"]
+        self.preload_u2e_ambiguous = frozenset(snapshot.extra["u2e_ambiguous"])
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    @staticmethod
+    def build_snapshot(es, index, filename):
+        u2e = {}
+        ambiguous = set()
+        def docs():
+            for gene_id, source in _scan_index(es, index, True):
+                _add_uniprot_mapping(u2e, ambiguous, source)
+                yield gene_id, source
+        return write_snapshot(filename, docs(), maps=lambda: {"u2e": u2e},
+            extra=lambda: {"u2e_ambiguous": sorted(ambiguous)})
+
+    def prefetch(self, gene_ids):
+        """fetch the documents of many genes with one request, to be used by
+        get_gene and membership checks until clear_prefetch is called"""
+        if self.snapshot is not None:
+            return
+        missing = [gene_id for gene_id in set(gene_ids) 
+            if gene_id not in self.prefetched and gene_id not in self.cache_gene]
+        if self.preloaded:
+            missing = [gene_id for gene_id in missing if gene_id in self.preload_ids]
+        for gene_id, val in _mget_index(self._es, self._es_index, missing):
+            self.prefetched[gene_id] = val
+
+    def clear_prefetch(self):
+        self.prefetched = {}
 
     def get_gene(self, gene_id):
         assert gene_id is not None
 
+        if self.preloaded and gene_id not in self.preload_ids:
+            return None
+
         self.cache_gene.queries += 1
         if gene_id in self.cache_gene:
             self.cache_gene.hits += 1
             return self.cache_gene[gene_id]
 
+        if self.snapshot is not None:
+            val = self.snapshot.get(gene_id)
+            self.cache_gene[gene_id] = val
+            return val
+
+        if gene_id in self.prefetched:
+            val = self.prefetched[gene_id]
+            self.cache_gene[gene_id] = val
+            return val
+
         response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=gene_id))[0:1].execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
@@ -91,6 +265,14 @@ class GeneLookUpTable(object):
     def get_uniprot2ensembl(self, uniprot_id):
         assert uniprot_id is not None
 
+        if self.preloaded:
+            self.preload_queries += 1
+            if uniprot_id in self.preload_u2e_ambiguous:
+                raise ValueError("Multiple genes with uniprot %s" %(uniprot_id))
+            if uniprot_id in self.preload_u2e:
+                self.preload_hits += 1
+            return self.preload_u2e.get(uniprot_id)
+
         self.cache_u2e.queries += 1
         if uniprot_id in self.cache_u2e:
             self.cache_u2e.hits += 1
@@ -117,6 +299,13 @@ class GeneLookUpTable(object):
 
     def __contains__(self, gene_id):
 
+        if self.preloaded:
+            self.preload_queries += 1
+            if gene_id in self.preload_ids:
+                self.preload_hits += 1
+                return True
+            return False
+
         self.cache_contains.queries += 1
         if gene_id in self.cache_contains:
             self.cache_contains.hits += 1
@@ -129,6 +318,9 @@ class GeneLookUpTable(object):
             else:
                 return True
 
+        if gene_id in self.prefetched:
+            return self.prefetched[gene_id] is not None
+
         response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=gene_id))[0:1].source(False).execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value > 0:
@@ -141,52 +333,99 @@ class GeneLookUpTable(object):
             return False
         #can't have multiple hits, primary key!
 
-    def __del__(self):
-        logger = logging.getLogger(__name__+".GeneLookUpTable")
-
-        if self.cache_gene.queries == 0:
-            if self.cache_gene.maxsize > 0:
-                logger.debug("cache_gene {} occupied 100 hitrate".format(
-                    old_div((self.cache_gene.currsize*100),self.cache_gene.maxsize)))
-        else:
-            logger.debug("cache_gene {} occupied {} hitrate".format(
-                old_div((self.cache_gene.currsize*100),self.cache_gene.maxsize),
-                old_div((self.cache_gene.hits*100),self.cache_gene.queries) ))
-
-        if self.cache_u2e.queries == 0:
-            if self.cache_u2e.maxsize > 0:
-                logger.debug("cache_u2e {} occupied 100 hitrate".format(
-                    old_div((self.cache_u2e.currsize*100),self.cache_u2e.maxsize)))
+    def metrics(self):
+        """structured hit ratio, eviction and memory figures of the caches"""
+        metrics = {
+            "cache_gene": self.cache_gene.metrics(),
+        }
+        #the preload answers the uniprot and membership lookups instead
+        if self.preloaded:
+            metrics["preload"] = _preload_metrics(self)
         else:
-            logger.debug("cache_u2e {} occupied {} hitrate".format(
-                old_div((self.cache_u2e.currsize*100),self.cache_u2e.maxsize),
-                old_div((self.cache_u2e.hits*100),self.cache_u2e.queries) ))
-
-        if self.cache_contains.queries == 0:
-            if self.cache_contains.maxsize > 0:
-                logger.debug("cache_contains {} occupied 100 hitrate".format(
-                    old_div((self.cache_contains.currsize*100),self.cache_contains.maxsize)))
-        else:
-            logger.debug("cache_contains {} occupied {} hitrate".format(
-                old_div((self.cache_contains.currsize*100),self.cache_contains.maxsize),
-                old_div((self.cache_contains.hits*100),self.cache_contains.queries) ))
+            metrics["cache_u2e"] = self.cache_u2e.metrics()
+            metrics["cache_contains"] = self.cache_contains.metrics()
+        return metrics
+
+    def __del__(self):
+        logging.getLogger(__name__+".GeneLookUpTable").debug("metrics %s", self.metrics())
 
 class ECOLookUpTable(object):
-    def __init__(self, es, es_index, cache_size):
+    def __init__(self, es, es_index, cache_size, preload=False, snapshot=None):
         self._es = es
         self._es_index = es_index
         #TODO configure size
-        self.cache = cachetools.LRUCache(cache_size, getsizeof=sys.getsizeof)
-        self.cache.hits = 0
-        self.cache.queries = 0
+        self.cache = LookupCache(cache_size)
+
+        self.preloaded = False
+        self.preload_ids = None
+        self.snapshot = None
+        #documents fetched in bulk by prefetch, until clear_prefetch
+        self.prefetched = {}
+        if snapshot is not None:
+            self.use_snapshot(snapshot)
+        elif preload:
+            self.preload()
+
+    def preload(self):
+        """scan the whole index once keeping only the ids in memory"""
+        self.preload_ids = set(eco_id for eco_id, _ in
+            _scan_index(self._es, self._es_index, []))
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    def use_snapshot(self, snapshot):
+        """answer every lookup from a LookupSnapshot instead of elasticsearch"""
+        self.snapshot = snapshot
+        self.preload_ids = snapshot
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    @staticmethod
+    def build_snapshot(es, index, filename):
+        return write_snapshot(filename, _scan_index(es, index, True))
+
+    def prefetch(self, eco_ids):
+        """fetch the documents of many ecos with one request, to be used by
+        get_eco until clear_prefetch is called"""
+        if self.snapshot is not None:
+            return
+        missing = [eco_id for eco_id in set(eco_ids) 
+            if eco_id not in self.prefetched and eco_id not in self.cache]
+        if self.preloaded:
+            missing = [eco_id for eco_id in missing if eco_id in self.preload_ids]
+        for eco_id, val in _mget_index(self._es, self._es_index, missing):
+            self.prefetched[eco_id] = val
+
+    def clear_prefetch(self):
+        self.prefetched = {}
 
     def get_eco(self, eco_id):
 
+        if self.preloaded:
+            self.preload_queries += 1
+            if eco_id not in self.preload_ids:
+                raise ValueError("Multiple eco %s" %(eco_id))
+            self.preload_hits += 1
+
         self.cache.queries += 1
         if eco_id in self.cache:
             self.cache.hits += 1
             return self.cache[eco_id]
 
+        if self.snapshot is not None:
+            val = self.snapshot.get(eco_id)
+            self.cache[eco_id] = val
+            return val
+
+        if eco_id in self.prefetched:
+            val = self.prefetched[eco_id]
+            if val is None:
+                raise ValueError("Multiple eco %s" %(eco_id))
+            self.cache[eco_id] = val
+            return val
+
         response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=eco_id))[0:1].execute()
         if response.hits.total.value > 0:
             val = response.hits[0].to_dict()
@@ -196,29 +435,57 @@ class ECOLookUpTable(object):
             #more then one hit, throw error
             raise ValueError("Multiple eco %s" %(eco_id))
 
+    def metrics(self):
+        """structured hit ratio, eviction and memory figures of the caches"""
+        metrics = {
+            "cache": self.cache.metrics(),
+        }
+        if self.preloaded:
+            metrics["preload"] = _preload_metrics(self)
+        return metrics
+
     def __del__(self):
-        logger = logging.getLogger(__name__+".ECOLookUpTable")
-        if self.cache.queries == 0:
-            if self.cache.maxsize > 0:
-                logger.debug("cache {} occupied 100 hitrate".format(
-                    old_div((self.cache.currsize*100),self.cache.maxsize)))
-        else:
-            logger.debug("cache {} occupied {} hitrate".format(
-                old_div((self.cache.currsize*100),self.cache.maxsize),
-                old_div((self.cache.hits*100),self.cache.queries) ))
+        logging.getLogger(__name__+".ECOLookUpTable").debug("metrics %s", self.metrics())
 
 class EFOLookUpTable(object):
 
-    def __init__(self, es, index, cache_efo_size, cache_contains_size):
+    def __init__(self, es, index, cache_efo_size, cache_contains_size, preload=False,
+            snapshot=None):
         self._es = es
         self._es_index = index
         #TODO configure size
-        self.cache_efo = cachetools.LRUCache(cache_efo_size, getsizeof=sys.getsizeof)
-        self.cache_efo.hits = 0
-        self.cache_efo.queries = 0
-        self.cache_contains = cachetools.LRUCache(cache_contains_size, getsizeof=sys.getsizeof)
-        self.cache_contains.hits = 0
-        self.cache_contains.queries = 0
+        self.cache_efo = LookupCache(cache_efo_size)
+        self.cache_contains = LookupCache(cache_contains_size)
+
+        self.preloaded = False
+        self.preload_ids = None
+        self.snapshot = None
+        #documents fetched in bulk by prefetch, until clear_prefetch
+        self.prefetched = {}
+        if snapshot is not None:
+            self.use_snapshot(snapshot)
+        elif preload:
+            self.preload()
+
+    def preload(self):
+        """scan the whole index once keeping only the ids in memory"""
+        self.preload_ids = set(efo_id for efo_id, _ in
+            _scan_index(self._es, self._es_index, []))
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    def use_snapshot(self, snapshot):
+        """answer every lookup from a LookupSnapshot instead of elasticsearch"""
+        self.snapshot = snapshot
+        self.preload_ids = snapshot
+        self.preloaded = True
+        self.preload_queries = 0
+        self.preload_hits = 0
+
+    @staticmethod
+    def build_snapshot(es, index, filename):
+        return write_snapshot(filename, _scan_index(es, index, True))
 
     @staticmethod
     def get_ontology_code_from_url(url):
@@ -231,13 +498,41 @@ class EFOLookUpTable(object):
             #assume already a short code
             return url
 
+    def prefetch(self, efo_ids):
+        """fetch the documents of many efos with one request, to be used by
+        get_efo and membership checks until clear_prefetch is called"""
+        if self.snapshot is not None:
+            return
+        missing = [efo_id for efo_id in set(efo_ids) 
+            if efo_id not in self.prefetched and efo_id not in self.cache_efo]
+        if self.preloaded:
+            missing = [efo_id for efo_id in missing if efo_id in self.preload_ids]
+        for efo_id, val in _mget_index(self._es, self._es_index, missing):
+            self.prefetched[efo_id] = val
+
+    def clear_prefetch(self):
+        self.prefetched = {}
+
     def get_efo(self, efo_id):
-        
+
+        if self.preloaded and efo_id not in self.preload_ids:
+            return None
+
         self.cache_efo.queries += 1
         if efo_id in self.cache_efo:
             self.cache_efo.hits += 1
             return self.cache_efo[efo_id]
 
+        if self.snapshot is not None:
+            val = self.snapshot.get(efo_id)
+            self.cache_efo[efo_id] = val
+            return val
+
+        if efo_id in self.prefetched:
+            val = self.prefetched[efo_id]
+            self.cache_efo[efo_id] = val
+            return val
+
         response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=efo_id))[0:1].execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
@@ -253,6 +548,13 @@ class EFOLookUpTable(object):
 
     def __contains__(self, efo_id):
 
+        if self.preloaded:
+            self.preload_queries += 1
+            if efo_id in self.preload_ids:
+                self.preload_hits += 1
+                return True
+            return False
+
         self.cache_contains.queries += 1
         if efo_id in self.cache_contains:
             self.cache_contains.hits += 1
@@ -265,6 +567,9 @@ class EFOLookUpTable(object):
             else:
                 return True
 
+        if efo_id in self.prefetched:
+            return self.prefetched[efo_id] is not None
+
         response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=efo_id))[0:1].source(False).execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
@@ -277,23 +582,17 @@ class EFOLookUpTable(object):
             return True
         #can't have multiple hits, primary key!
 
-    def __del__(self):
-        logger = logging.getLogger(__name__+".EFOLookUpTable")
-
-        if self.cache_efo.queries == 0:
-            if self.cache_efo.maxsize > 0:
-                logger.debug("cache_efo {} occupied 100 hitrate".format(
-                    old_div((self.cache_efo.currsize*100),self.cache_efo.maxsize)))
+    def metrics(self):
+        """structured hit ratio, eviction and memory figures of the caches"""
+        metrics = {
+            "cache_efo": self.cache_efo.metrics(),
+        }
+        #the preload answers the membership lookups instead
+        if self.preloaded:
+            metrics["preload"] = _preload_metrics(self)
         else:
-            logger.debug("cache_efo {} occupied {} hitrate".format(
-                old_div((self.cache_efo.currsize*100),self.cache_efo.maxsize),
-                old_div((self.cache_efo.hits*100),self.cache_efo.queries) ))
-
-        if self.cache_contains.queries == 0:
-            if self.cache_contains.maxsize > 0:
-                logger.debug("cache_contains {} occupied 100 hitrate".format(
-                    old_div((self.cache_contains.currsize*100),self.cache_contains.maxsize)))
-        else:
-            logger.debug("cache_contains {} occupied {} hitrate".format(
-                old_div((self.cache_contains.currsize*100),self.cache_contains.maxsize),
-                old_div((self.cache_contains.hits*100),self.cache_contains.queries) ))
+            metrics["cache_contains"] = self.cache_contains.metrics()
+        return metrics
+
+    def __del__(self):
+        logging.getLogger(__name__+".EFOLookUpTable").debug("metrics %s", self.metrics())
@@ -0,0 +1,223 @@
+"""
+Evidence schema validators compiled once per datasource.
+
+The evidence schema is a top level oneOf (or anyOf) of one sub-schema per
+kind of evidence, so a generic validator checks every line against all of
+them. Here the $refs are resolved once, and each datasource gets a validator
+for only the sub-schemas whose sourceID enum accepts it, which gives the same
+valid/invalid result as the whole schema.
+
+With fastjsonschema installed the validators are generated python code,
+written to a cache directory keyed by the hash of the schema uri and the
+datasource, so each worker only has to load them. Without it jsonschema
+validators of the same sub-schemas are used.
+"""
+from builtins import object
+import contextlib
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+try:
+    from urllib.parse import urljoin, urldefrag
+except ImportError:
+    from urlparse import urljoin, urldefrag
+
+import simplejson as json
+from opentargets_urlzsource import URLZSource
+
+#optional, generates python code for each schema
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+#the fastjsonschema code is generated without defaults, with all the errors,
+#and not checking formats, as the jsonschema validators do
+COMPILE_OPTIONS = {"use_default": False, "fast_fail": False, "use_formats": False}
+
+
+def _json_pointer(doc, pointer):
+    for part in pointer.lstrip('/').split('/') if pointer.strip('/') else []:
+        part = part.replace('~1', '/').replace('~0', '~')
+        doc = doc[int(part)] if isinstance(doc, list) else doc[part]
+    return doc
+
+
+class _RefResolver(object):
+    """inline every $ref of a schema, reading each referenced document once"""
+
+    def __init__(self):
+        self.documents = {}
+
+    def load(self, uri):
+        if uri not in self.documents:
+            with URLZSource(uri).open() as f:
+                self.documents[uri] = json.load(f)
+        return self.documents[uri]
+
+    def resolve(self, node, base, stack=()):
+        if isinstance(node, dict):
+            if '$ref' in node:
+                ref = urljoin(base, node['$ref'])
+                if ref in stack:
+                    raise ValueError("recursive schema reference %s" % ref)
+                doc_uri, fragment = urldefrag(ref)
+                target = _json_pointer(self.load(doc_uri or base), fragment)
+                return self.resolve(target, doc_uri or base, stack + (ref,))
+            return dict((k, self.resolve(v, base, stack)) for k, v in node.items())
+        if isinstance(node, list):
+            return [self.resolve(v, base, stack) for v in node]
+        return node
+
+
+def _accepted_sources(schema):
+    """the sourceIDs a resolved sub-schema accepts, or None if it does not say"""
+    sources = None
+    source = schema.get('properties', {}).get('sourceID', {})
+    if 'enum' in source:
+        sources = set(source['enum'])
+    elif 'const' in source:
+        sources = set([source['const']])
+    for part in schema.get('allOf', []):
+        part_sources = _accepted_sources(part)
+        if part_sources is not None:
+            sources = part_sources if sources is None else sources & part_sources
+    return sources
+
+
+def split_schema(schema):
+    """split a resolved schema into one schema per datasource
+
+    returns a dict of sourceID to schema, plus the whole schema under None for
+    the lines of any other datasource"""
+    for keyword in ('oneOf', 'anyOf'):
+        if keyword in schema:
+            break
+    else:
+        return {None: schema}
+
+    alternatives = [(alternative, _accepted_sources(alternative))
+        for alternative in schema[keyword]]
+    sources = set()
+    for _, accepted in alternatives:
+        sources.update(accepted or [])
+
+    schemas = {None: schema}
+    for source in sources:
+        source_schema = dict(schema)
+        source_schema[keyword] = [alternative for alternative, accepted in alternatives
+            if accepted is None or source in accepted]
+        schemas[source] = source_schema
+    return schemas
+
+
+class DatasourceValidators(object):
+    """
+    Validates each evidence with the validator of its sourceID. Like the
+    jsonschema validators, iter_errors yields the errors of an evidence
+    """
+
+    def __init__(self, schema_uri, cache_dir=None):
+        self.logger = logging.getLogger(__name__)
+        self.schema_uri = schema_uri
+        self.cache_dir = cache_dir
+        self.validators = {}
+
+        #generated code imports fastjsonschema, so only reuse it with the same version
+        #and the same compile options
+        key = "%s %s %s" % (schema_uri, fastjsonschema.VERSION if fastjsonschema else "",
+            sorted(COMPILE_OPTIONS.items()))
+        self.cache_key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        manifest = self._cached_manifest()
+        if manifest is not None:
+            for source, filename in manifest.items():
+                self.validators[source or None] = self._load_code(filename)
+            return
+
+        resolver = _RefResolver()
+        schema = resolver.resolve(resolver.load(schema_uri), schema_uri)
+        schemas = split_schema(schema)
+        self.logger.info("compiling %d evidence schema validators", len(schemas))
+        if fastjsonschema is not None:
+            self._compile(schemas)
+        else:
+            import jsonschema
+            for source, source_schema in schemas.items():
+                validator_class = jsonschema.validators.validator_for(source_schema)
+                self.validators[source] = validator_class(source_schema).iter_errors
+
+    def _manifest_filename(self):
+        return os.path.join(self.cache_dir, "schema-%s.json" % self.cache_key)
+
+    def _cached_manifest(self):
+        if fastjsonschema is None or self.cache_dir is None or \
+                not os.path.exists(self._manifest_filename()):
+            return None
+        with open(self._manifest_filename()) as f:
+            return json.load(f)
+
+    def _compile(self, schemas):
+        manifest = {}
+        for source, source_schema in schemas.items():
+            code = fastjsonschema.compile_to_code(source_schema, **COMPILE_OPTIONS)
+            if self.cache_dir is not None:
+                filename = os.path.join(self.cache_dir, "schema-%s-%s.py" % (self.cache_key,
+                    hashlib.sha1((source or "").encode("utf-8")).hexdigest()[:16]))
+                self._write(filename, code)
+                manifest[source or ""] = filename
+            self.validators[source] = self._exec_code(code)
+        if self.cache_dir is not None:
+            #written last, so a cache is only used when complete
+            self._write(self._manifest_filename(), json.dumps(manifest))
+
+    @staticmethod
+    def _write(filename, data):
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.rename(tmp_filename, filename)
+
+    def _load_code(self, filename):
+        with open(filename) as f:
+            return self._exec_code(f.read())
+
+    @staticmethod
+    def _exec_code(code):
+        namespace = {}
+        exec(compile(code, "<evidence schema>", "exec"), namespace)
+        validate = namespace['validate']
+
+        def iter_errors(evidence):
+            try:
+                validate(evidence)
+            except fastjsonschema.JsonSchemaValuesException as e:
+                for error in e.errors:
+                    yield error
+            except fastjsonschema.JsonSchemaException as e:
+                yield e
+        return iter_errors
+
+    def iter_errors(self, evidence):
+        source = evidence.get('sourceID') if isinstance(evidence, dict) else None
+        validator = self.validators.get(source, self.validators[None])
+        return validator(evidence)
+
+
+@contextlib.contextmanager
+def compiled_schema_validators(schema_uri, cache_dir=None):
+    """compile the validators once in the parent process and yield the directory
+    the workers can load them from. Without a cache_dir they are compiled into a 
+    temporary directory removed on exit"""
+    directory = cache_dir if cache_dir is not None else \
+        tempfile.mkdtemp(prefix="mrtarget-schema-")
+    try:
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        DatasourceValidators(schema_uri, directory)
+        yield directory
+    finally:
+        if cache_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -15,8 +15,6 @@ else:
     import anydbm as dbm
 
 import tempfile
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import Match
 
 from opentargets_urlzsource import URLZSource
 import simplejson as json
@@ -171,12 +169,12 @@ class ChEMBLLookup(object):
                             protein_class_id = classification['protein_classification_id']
                             self.protein_classification[i['accession']].append(dict(self.protein_class[protein_class_id]))
 
-    def get_molecules_from_evidence(self, es, index):
-
+    def get_molecules_from_evidence(self, reader, index, scan_workers=1):
+        """read the known_drug evidence with an IndexReader"""
         fields = ['target.id','disease.id', 'evidence.target2drug.urls']
-        for e in Search().using(es).index(index).query(
-            Match(type="known_drug")).source(includes=fields).scan():
-            e = e.to_dict()
+        query = {"query": {"match": {"type": "known_drug"}}, "_source": fields}
+        for hit in reader.scan(index, query, workers=scan_workers):
+            e = hit['_source']
             #get information from URLs that we need to extract short ids
             #e.g. https://www.ebi.ac.uk/chembl/compound/inspect/CHEMBL502835
             molecule_ids = [self.str_hook(i['url'].split('/')[-1]) for i in e['evidence']['target2drug']['urls'] if
@@ -0,0 +1,243 @@
+"""
+Write the output of the stages to a folder instead of a live elasticsearch.
+
+Each index is a sub-folder with its settings and mappings in index.json and
+its documents in gzip compressed files of bulk request lines, one file per
+writer thread, so the folder can be bulk loaded into elasticsearch later
+with each _index and _id as it would have been written, or read back by
+the following stages.
+"""
+from builtins import object
+import collections
+import concurrent.futures
+import glob
+import gzip
+import itertools
+import logging
+import os
+import shutil
+import threading
+
+import more_itertools
+import simplejson as json
+from elasticsearch.serializer import JSONSerializer
+
+from mrtarget.common.esutil import ElasticsearchBulkIndexManager, BulkWriter, \
+    bulk_index_line, send_bulk_payloads, _bulk_payload_entries
+
+
+INDEX_FILENAME = "index.json"
+
+
+class FolderIndexManager(object):
+    """Context manager to open the folder of an index for writing, like
+    ElasticsearchBulkIndexManager does for an elasticsearch index."""
+
+    def __init__(self, folder, index_name, settings={}, mappings={}, append_data=False):
+        self.logger = logging.getLogger(__name__)
+        self.folder = folder
+        self.index_name = index_name
+        self.settings = settings
+        self.mappings = mappings
+        self.append_data = append_data
+
+    def __enter__(self):
+        index_folder = os.path.join(self.folder, self.index_name)
+        if os.path.exists(index_folder) and not self.append_data:
+            self.logger.debug("deleting previous index folder %s", index_folder)
+            shutil.rmtree(index_folder)
+        if not os.path.exists(index_folder):
+            os.makedirs(index_folder)
+        with open(os.path.join(index_folder, INDEX_FILENAME), "w") as f:
+            json.dump({"settings": self.settings, "mappings": self.mappings}, f)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return None
+
+
+class FolderBulkWriter(object):
+    """Writes bulk request lines to the files of each index in folder.
+
+    Each chunk is serialised and compressed by one of thread_count threads
+    and appended to one of the thread_count files of its index in turn, so
+    no two threads write to the same file at once.
+    """
+
+    def __init__(self, folder, thread_count=0, queue_size=4):
+        self.folder = folder
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+        self.shards = max(1, thread_count)
+        self.files = {}
+        self.files_lock = threading.Lock()
+        self.locks = collections.defaultdict(threading.Lock)
+        self.chunks = itertools.count()
+        self.serializer = JSONSerializer()
+
+    def _file(self, index, shard):
+        with self.files_lock:
+            if (index, shard) not in self.files:
+                index_folder = os.path.join(self.folder, index)
+                if not os.path.exists(index_folder):
+                    os.makedirs(index_folder)
+                self.files[(index, shard)] = gzip.open(os.path.join(index_folder,
+                    "part-%04d.ndjson.gz" % shard), "ab")
+            return self.files[(index, shard)]
+
+    def _write(self, entries_by_index, shard):
+        for index, entries in entries_by_index.items():
+            data = b"".join(entries)
+            with self.files_lock:
+                lock = self.locks[(index, shard)]
+            with lock:
+                self._file(index, shard).write(data)
+
+    def _write_actions(self, actions, shard):
+        entries_by_index = collections.defaultdict(list)
+        for action in actions:
+            entries_by_index[action["_index"]].append(("\n".join([
+                bulk_index_line(action["_index"], action["_id"]),
+                self.serializer.dumps(action["_source"]), ""])).encode("utf-8"))
+        self._write(entries_by_index, shard)
+
+    def _write_entries(self, entries, shard):
+        #the entries are split on newlines only, the documents can have other
+        #line separators such as U+2028 unescaped
+        entries_by_index = collections.defaultdict(list)
+        for entry in entries:
+            action = json.loads(entry[:entry.index(b"\n")])
+            entries_by_index[list(action.values())[0]["_index"]].append(entry)
+        self._write(entries_by_index, shard)
+
+    def _write_payload(self, payload, shard):
+        self._write_entries(_bulk_payload_entries(payload), shard)
+
+    def _run(self, function, chunks):
+        """write each chunk with function, yielding the chunks once written"""
+        if self.thread_count <= 0:
+            for chunk in chunks:
+                function(chunk, 0)
+                yield chunk
+            return
+
+        def write(chunk, shard):
+            function(chunk, shard)
+            return chunk
+
+        with concurrent.futures.ThreadPoolExecutor(self.thread_count) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(write, chunk,
+                    next(self.chunks) % self.shards))
+                while len(pending) > self.thread_count + self.queue_size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def write_actions(self, actions, chunk_size=1000):
+        """write the elasticsearch action dicts, yielding (True, item) for each
+        like elasticsearch.helpers.streaming_bulk"""
+        for chunk in self._run(self._write_actions, more_itertools.chunked(actions, chunk_size)):
+            for action in chunk:
+                yield True, {"index": {"_index": action["_index"], "_id": action["_id"],
+                    "status": 201}}
+
+    def write_entries(self, entries, chunk_size=1000):
+        """write actions already serialised by bulk_entry, yielding (True, item)
+        for each like write_actions"""
+        for chunk in self._run(self._write_entries, more_itertools.chunked(entries, chunk_size)):
+            for entry in chunk:
+                action = json.loads(entry[:entry.index(b"\n")])["index"]
+                yield True, {"index": {"_index": action["_index"], "_id": action["_id"],
+                    "status": 201}}
+
+    def write_payloads(self, payloads):
+        """write bulk request bodies already serialised, as send_bulk_payloads
+        sends them. Nothing fails, so nothing is yielded"""
+        for _ in self._run(self._write_payload, (payload for payload in payloads if payload)):
+            pass
+        return iter([])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def index_manager(client, folder, index_name, settings={}, mappings={}, append_data=False,
+        load_options=None):
+    """the index manager of index_name, for the folder when writing to one.
+    The documents are written to its index_name, a new version of the index 
+    when the load_options ask for one"""
+    if folder:
+        return FolderIndexManager(folder, index_name, settings, mappings, append_data)
+    return ElasticsearchBulkIndexManager(client, index_name, settings, mappings, append_data,
+        load_options)
+
+
+def bulk(client, folder, actions, thread_count=0, queue_size=4, chunk_size=None,
+        chunk_bytes=None):
+    """write the actions with a BulkWriter, in requests of at most chunk_size
+    documents and chunk_bytes bytes, or to the folder when writing to one.
+    Yields the (success, item) of each action"""
+    if folder:
+        writer = FolderBulkWriter(folder, thread_count, queue_size)
+        try:
+            for result in writer.write_actions(actions, chunk_size or BulkWriter.CHUNK_SIZE):
+                yield result
+        finally:
+            writer.close()
+    else:
+        writer = BulkWriter(client, thread_count, queue_size, chunk_size, chunk_bytes)
+        for result in writer.write_actions(actions):
+            yield result
+
+
+def bulk_entries(client, folder, entries, thread_count=0, queue_size=4, chunk_size=None,
+        chunk_bytes=None):
+    """like bulk, for actions already serialised into their bulk request lines
+    by bulk_entry"""
+    if folder:
+        writer = FolderBulkWriter(folder, thread_count, queue_size)
+        try:
+            for result in writer.write_entries(entries, chunk_size or BulkWriter.CHUNK_SIZE):
+                yield result
+        finally:
+            writer.close()
+    else:
+        writer = BulkWriter(client, thread_count, queue_size, chunk_size, chunk_bytes)
+        for result in writer.write_entries(entries):
+            yield result
+
+
+def bulk_payloads(client, folder, payloads, thread_count=0, queue_size=4):
+    """send the serialised bulk request bodies with send_bulk_payloads, or 
+    write them to the folder when writing to one. Yields the failed items"""
+    if folder:
+        writer = FolderBulkWriter(folder, thread_count, queue_size)
+        try:
+            writer.write_payloads(payloads)
+        finally:
+            writer.close()
+        return iter([])
+    return send_bulk_payloads(client, payloads, thread_count, queue_size)
+
+
+def iter_folder_actions(folder, index_name):
+    """read back the documents of an index written to folder, as the action
+    dicts they were written from with the _source decoded"""
+    filenames = sorted(glob.glob(os.path.join(folder, index_name, "part-*.ndjson.gz")))
+    for filename in filenames:
+        with gzip.open(filename, "rt") as f:
+            for action_line in f:
+                source_line = next(f)
+                action = list(json.loads(action_line).values())[0]
+                yield {"_index": action["_index"], "_id": action["_id"],
+                    "_source": json.loads(source_line)}
+
+
+def read_index_settings(folder, index_name):
+    """the settings and mappings of an index written to folder"""
+    with open(os.path.join(folder, index_name, INDEX_FILENAME)) as f:
+        return json.load(f)
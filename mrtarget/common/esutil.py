@@ -1,14 +1,639 @@
 
 from builtins import object
+import collections
+import concurrent.futures
 import logging
+import queue
+import re
+import threading
 import time
-from elasticsearch import RequestError
+import elasticsearch.helpers
+from elasticsearch import RequestError, ConnectionTimeout
+from elasticsearch.serializer import JSONSerializer
+import simplejson as json
+
+
+#marks the end of a slice in the parallel_scan queue
+_SLICE_DONE = object()
+
+def parallel_scan(client, index, query=None, workers=1, maxsize=10000, 
+        scroll='4h', size=1000):
+    """Scan all the hits of a query like elasticsearch.helpers.scan, but
+    with a sliced scroll read by `workers` threads in parallel.
+
+    The hits of all the slices are merged into a single stream in no
+    particular order through a queue of at most `maxsize` hits, so a slow
+    consumer does not make the readers buffer the whole index. An error in
+    any of the readers is raised in the consumer.
+
+    `index` can also be a list of indices, e.g. the partitions behind an
+    alias, which are then read at the same time with the workers shared
+    between them.
+
+    With workers <= 1 this is a plain elasticsearch.helpers.scan.
+    """
+    if query is None:
+        query = {"query": {"match_all": {}}}
+
+    indices = index if isinstance(index, list) else [index]
+
+    if workers <= 1:
+        for index in indices:
+            for hit in elasticsearch.helpers.scan(client, query=query, index=index,
+                    scroll=scroll, size=size):
+                yield hit
+        return
+
+    #each index in as many slices as it gets workers
+    slices = max(1, workers // max(1, len(indices)))
+    readers = [(index, slice_id) for index in indices for slice_id in range(slices)]
+
+    hits = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        #give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                hits.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_slice(index, slice_id):
+        try:
+            slice_query = dict(query)
+            if slices > 1:
+                slice_query["slice"] = {"id": slice_id, "max": slices}
+            for hit in elasticsearch.helpers.scan(client, query=slice_query, 
+                    index=index, scroll=scroll, size=size):
+                if not put(hit):
+                    return
+            put(_SLICE_DONE)
+        except Exception as e:
+            put(e)
+
+    threads = [threading.Thread(target=read_slice, args=(index, slice_id), 
+        name="scan-%s-%d" % (index, slice_id)) for index, slice_id in readers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = len(readers)
+        while running > 0:
+            item = hits.get()
+            if item is _SLICE_DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def alias_indices(client, name):
+    """the concrete indices an alias points to, sorted, or [name] when it is
+    an index itself or does not exist"""
+    if not client.indices.exists_alias(name=name):
+        return [name]
+    return sorted(client.indices.get_alias(name=name))
+
+
+def bulk_index_line(index, doc_id):
+    """the action line of a bulk request indexing a document"""
+    return json.dumps({"index": {"_index": index, "_id": doc_id}})
+
+
+def bulk_entry(index, doc_id, source):
+    """the bytes of the bulk request lines indexing a document already
+    serialised as the json string source"""
+    return ("%s\n%s\n" % (bulk_index_line(index, doc_id), source)).encode("utf-8")
+
+
+def send_bulk_payloads(client, payloads, thread_count=0, queue_size=4):
+    """Send bulk request bodies already serialised by the producers, e.g. the
+    bytes of several bulk_index_line and document lines, without decoding 
+    them again, with a BulkWriter.
+
+    With thread_count > 0 that many requests are in flight at once, and at 
+    most queue_size more payloads are read ahead. Yields the items of the
+    responses that failed.
+    """
+    return BulkWriter(client, thread_count, queue_size).write_payloads(payloads)
+
+
+def _bulk_payload_entries(payload):
+    """split a bulk request body into the bytes of each of its actions, with
+    the document line of the actions that have one"""
+    lines = payload.split(b"\n")
+    entries = []
+    i = 0
+    while i < len(lines):
+        if not lines[i]:
+            i += 1
+            continue
+        op_type = list(json.loads(lines[i]).keys())[0]
+        size = 1 if op_type == "delete" else 2
+        entries.append(b"\n".join(lines[i:i + size]) + b"\n")
+        i += size
+    return entries
+
+
+def _item_result(item):
+    """the result of a bulk response item, whatever its action"""
+    return list(item.values())[0]
+
+
+def _is_written(result):
+    return 200 <= result.get("status", 200) < 300 and "error" not in result
+
+
+def _is_rejected(result):
+    """if elasticsearch refused a bulk item because it was too busy"""
+    if result.get("status") == 429:
+        return True
+    error = result.get("error")
+    return isinstance(error, dict) and error.get("type") == "es_rejected_execution_exception"
+
+
+class BulkWriter(object):
+    """Writes to elasticsearch with bulk requests, in place of parallel_bulk
+    and streaming_bulk, for all the stages.
+
+    The actions are serialised into requests of at most chunk_bytes bytes and 
+    chunk_size documents. Up to thread_count requests are in flight at once,
+    fewer while elasticsearch rejects them: each rejection halves the number
+    of requests in flight and every RECOVER_AFTER accepted requests allow one
+    more again. Only the rejected items of a request are sent again, after an
+    exponential backoff, up to max_retries times, and the items that failed 
+    otherwise are given back as they are.
+
+    The documents, bytes and retries of each index are counted and logged
+    with the throughput at the end of each write.
+    """
+
+    CHUNK_BYTES = 10*1024*1024
+    CHUNK_SIZE = 5000
+    MAX_RETRIES = 8
+    INITIAL_BACKOFF = 2
+    MAX_BACKOFF = 600
+    RECOVER_AFTER = 10
+
+    def __init__(self, client, thread_count=0, queue_size=4, chunk_size=None, 
+            chunk_bytes=None, max_retries=None):
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.thread_count = thread_count
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.chunk_bytes = chunk_bytes or self.CHUNK_BYTES
+        self.max_retries = self.MAX_RETRIES if max_retries is None else max_retries
+        self.serializer = JSONSerializer()
+
+        #requests in flight, and how many are allowed
+        self.concurrency = max(1, thread_count)
+        self.in_flight = 0
+        self.accepted = 0
+        self.condition = threading.Condition()
+
+        #index to [documents, bytes, retries]
+        self.stats = collections.defaultdict(lambda: [0, 0, 0])
+        self.stats_lock = threading.Lock()
+        self.rejected_requests = 0
+        self.start = None
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def _release(self, rejected):
+        with self.condition:
+            self.in_flight -= 1
+            if rejected:
+                if self.concurrency > 1:
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.logger.info("bulk requests rejected, sending %d at a time", 
+                        self.concurrency)
+                self.accepted = 0
+            else:
+                self.accepted += 1
+                if self.accepted >= self.RECOVER_AFTER and \
+                        self.concurrency < max(1, self.thread_count):
+                    self.concurrency += 1
+                    self.accepted = 0
+            self.condition.notify_all()
+
+    def _backoff(self, attempt):
+        return min(self.MAX_BACKOFF, self.INITIAL_BACKOFF * 2 ** attempt)
+
+    def _count(self, written, payload_bytes, retried):
+        """add the written items of a request of payload_bytes to the stats,
+        sharing its bytes between them, and the retried items"""
+        with self.stats_lock:
+            for result in written:
+                stats = self.stats[result.get("_index")]
+                stats[0] += 1
+                stats[1] += payload_bytes / len(written)
+            for result in retried:
+                self.stats[result.get("_index")][2] += 1
+
+    def _send(self, payload, entries=None):
+        """send a bulk request body, sending its rejected items again until
+        they are written or out of retries, and return the (success, item)
+        of each of its actions"""
+        results = []
+        attempt = 0
+        while True:
+            self._acquire()
+            items = None
+            try:
+                items = self.client.bulk(body=payload)["items"]
+            except elasticsearch.TransportError as e:
+                #the whole request was rejected, it is sent again as it is
+                if e.status_code != 429 or attempt >= self.max_retries:
+                    raise
+            finally:
+                self._release(items is None or 
+                    any(_is_rejected(_item_result(i)) for i in items))
+
+            if items is not None:
+                retry = [n for n, item in enumerate(items) 
+                    if _is_rejected(_item_result(item))]
+                if attempt >= self.max_retries:
+                    retry = []
+                retry_set = set(retry)
+                done = [item for n, item in enumerate(items) if n not in retry_set]
+                written = [_item_result(item) for item in done 
+                    if _is_written(_item_result(item))]
+                self._count(written, len(payload), [_item_result(items[n]) for n in retry])
+                results.extend((_is_written(_item_result(item)), item) for item in done)
+                if not retry:
+                    return results
+
+                if entries is None:
+                    entries = _bulk_payload_entries(payload)
+                entries = [entries[n] for n in retry]
+                payload = b"".join(entries)
+            else:
+                with self.stats_lock:
+                    self.rejected_requests += 1
+
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def _run(self, requests):
+        """send the (payload, entries) requests, yielding the results of each"""
+        if self.start is None:
+            self.start = time.time()
+        if self.thread_count <= 0:
+            for payload, entries in requests:
+                yield self._send(payload, entries)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.thread_count) as executor:
+            pending = collections.deque()
+            for payload, entries in requests:
+                pending.append(executor.submit(self._send, payload, entries))
+                while len(pending) > self.thread_count + self.queue_size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _serialise(self, action):
+        """the bytes of the bulk lines of an action dict"""
+        action, data = elasticsearch.helpers.expand_action(action)
+        lines = [self.serializer.dumps(action)]
+        if data is not None:
+            lines.append(self.serializer.dumps(data))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _chunk_entries(self, serialised):
+        """join the bytes of each action into requests"""
+        entries = []
+        size = 0
+        for entry in serialised:
+            if entries and (len(entries) >= self.chunk_size or 
+                    size + len(entry) > self.chunk_bytes):
+                yield b"".join(entries), entries
+                entries = []
+                size = 0
+            entries.append(entry)
+            size += len(entry)
+        if entries:
+            yield b"".join(entries), entries
+
+    def write_actions(self, actions):
+        """write the elasticsearch action dicts, yielding the (success, item)
+        of each like elasticsearch.helpers.streaming_bulk"""
+        return self.write_entries(self._serialise(action) for action in actions)
+
+    def write_entries(self, entries):
+        """write actions already serialised into their bulk request lines, 
+        e.g. by bulk_entry in the processes producing them, so they only have
+        to be joined into requests. Yields the (success, item) of each"""
+        try:
+            for results in self._run(self._chunk_entries(entries)):
+                for result in results:
+                    yield result
+        finally:
+            self.log_stats()
+
+    def write_payloads(self, payloads):
+        """send bulk request bodies already serialised, yielding the items
+        that failed"""
+        try:
+            for results in self._run((payload, None) for payload in payloads if payload):
+                for success, item in results:
+                    if not success:
+                        yield item
+        finally:
+            self.log_stats()
+
+    def log_stats(self):
+        if self.start is None:
+            return
+        elapsed = max(time.time() - self.start, 1e-6)
+        with self.stats_lock:
+            for index, (docs, size, retries) in sorted(self.stats.items(), key=lambda i: str(i[0])):
+                self.logger.info("wrote %d documents, %.1f MB to %s in %.1fs, "
+                    "%.0f docs/s, %.2f MB/s, %d retries", docs, size / 1024 / 1024, index, 
+                    elapsed, docs / elapsed, size / 1024 / 1024 / elapsed, retries)
+            if self.rejected_requests:
+                self.logger.info("%d whole bulk requests were rejected and sent again",
+                    self.rejected_requests)
+
+
+def _index_setting(index_settings, key):
+    """the value of a dotted index setting, flat or nested, or None"""
+    if key in index_settings:
+        return index_settings[key]
+    head, _, rest = key.partition(".")
+    if rest and isinstance(index_settings.get(head), dict):
+        return _index_setting(index_settings[head], rest)
+    return None
+
+
+class LoadProfile(object):
+    """How one index is tuned for bulk loading, from the load block of its
+    entry in the es config, e.g.
+
+        val-right:
+          name: master_evidence-data
+          load:
+            translog-flush-threshold: 1gb
+            merge-scheduler-threads: 1
+            best-compression: true
+
+    translog_flush_threshold and merge_scheduler_threads are set while the
+    index is loaded and reverted to its own settings after. With 
+    best_compression the index is switched to that codec once loaded, so the
+    merge of the finalisation rewrites it compressed, unless it was appended
+    to.
+    """
+
+    def __init__(self, translog_flush_threshold=None, merge_scheduler_threads=None,
+            best_compression=False):
+        self.translog_flush_threshold = translog_flush_threshold
+        self.merge_scheduler_threads = merge_scheduler_threads
+        self.best_compression = best_compression
+
+    @classmethod
+    def from_config(cls, config):
+        """the profile of a load block, with hyphens in its keys"""
+        return cls(**dict((key.replace("-", "_"), value) for key, value in config.items()))
+
+    def load_settings(self):
+        """the index settings while loading"""
+        settings = {}
+        if self.translog_flush_threshold is not None:
+            settings["translog.flush_threshold_size"] = self.translog_flush_threshold
+        if self.merge_scheduler_threads is not None:
+            settings["merge.scheduler.max_thread_count"] = self.merge_scheduler_threads
+        return settings
+
+    def revert_settings(self, index_settings):
+        """the load settings as in index_settings, the default if not there"""
+        return dict((key, _index_setting(index_settings, key)) 
+            for key in self.load_settings())
+
+    def finalise(self, client, index, created=True):
+        """switch the codec of the loaded index, it has to be closed for it so
+        only if it was created by this load and is not served yet"""
+        if self.best_compression and not created:
+            logging.getLogger(__name__).info("not compressing %s, it was appended to "
+                "and would be closed while served", index)
+        elif self.best_compression:
+            logging.getLogger(__name__).debug("compressing %s", index)
+            client.indices.close(index=index)
+            client.indices.put_settings(index=index, body={
+                "index" : {
+                    "codec" : "best_compression"
+                }
+            })
+            client.indices.open(index=index)
+
+
+class BulkLoadOptions(object):
+    """How the stages load their indexes into elasticsearch, the same for all
+    of them.
+
+    With keep_versions > 0 each index is built as a new version, an index 
+    named by version_index_name, while the previous one is still served 
+    behind an alias of the index name. Once loaded the alias is moved to the
+    new version, and only the keep_versions latest versions are kept. With
+    keep_versions 0 the index is replaced in place.
+
+    Once loaded an index is finalised: merged down to max_num_segments 
+    segments (0 leaves the segments as they are), then given its replicas 
+    back, or replicas if set, and waited on to reach wait_for_status, by 
+    default green when the cluster has the data nodes to hold the replicas
+    and yellow when it has not, e.g. a single node. The merges of 
+    several indexes run in parallel, as background tasks on clusters from 
+    BACKGROUND_FORCEMERGE_VERSION, and finalisation gives up waiting after
+    finalise_timeout seconds. With defer_finalise the loaded indexes are only
+    refreshed, and finalised all at once by finalise_deferred at the end of 
+    the run.
+
+    profiles are the LoadProfile of the indexes tuned for loading, by name.
+    """
+
+    def __init__(self, keep_versions=0, max_num_segments=1, replicas=None, 
+            finalise_timeout=3600, defer_finalise=False, profiles=None,
+            wait_for_status=None):
+        self.keep_versions = keep_versions
+        self.max_num_segments = max_num_segments
+        self.replicas = replicas
+        self.finalise_timeout = finalise_timeout
+        self.defer_finalise = defer_finalise
+        self.profiles = profiles if profiles is not None else {}
+        self.wait_for_status = wait_for_status
+        #the replicas of the indexes waiting to be finalised, by name, and
+        #the client of their cluster
+        self.deferred = collections.OrderedDict()
+        self.client = None
+
+    @property
+    def versioned(self):
+        return self.keep_versions > 0
+
+    def profile(self, index_name):
+        """the LoadProfile of index_name, the default one if not tuned"""
+        return self.profiles.get(index_name, LoadProfile())
+
+    def finalise_later(self, client, replicas):
+        """finalise the indexes, a dict of their replicas by name, now or at
+        the end of the run"""
+        if self.defer_finalise:
+            self.client = client
+            self.deferred.update(replicas)
+        else:
+            finalise_indices(client, replicas, self)
+
+    def finalise_deferred(self):
+        """finalise the indexes deferred so far, in parallel"""
+        if self.deferred:
+            finalise_indices(self.client, self.deferred, self)
+            self.deferred = collections.OrderedDict()
+
+
+def wait_for_tasks(client, tasks, timeout, poll_interval=10):
+    """poll the background tasks, a dict of what they do by task id, until 
+    all completed or timeout seconds passed, logging their progress. Returns 
+    the ones still running"""
+    logger = logging.getLogger(__name__)
+    deadline = time.time() + timeout
+    running = dict(tasks)
+    while running:
+        for task_id in list(running):
+            response = client.tasks.get(task_id=task_id)
+            if response.get("completed"):
+                description = running.pop(task_id)
+                if response.get("error"):
+                    raise RuntimeError("%s failed: %s" % (description, response["error"]))
+                logger.info("%s done in %.1fs", description, 
+                    response["task"]["running_time_in_nanos"] / 1e9)
+        if not running or time.time() >= deadline:
+            break
+        logger.info("waiting on %s", ", ".join(sorted(running.values())))
+        time.sleep(poll_interval)
+    return running
+
+
+#the first version that can force merge in a background task
+BACKGROUND_FORCEMERGE_VERSION = (8, 1)
+
+
+def cluster_version(client):
+    """the (major, minor) version of the elasticsearch cluster"""
+    number = client.info()["version"]["number"]
+    return tuple(int(part) for part in re.findall(r'\d+', number)[:2])
+
+
+def _forcemerge_tasks(client, indices, load_options):
+    """force merge the indices in background tasks of the cluster"""
+    logger = logging.getLogger(__name__)
+    tasks = {}
+    for index in indices:
+        logger.debug("Force merging %s", index)
+        response = client.indices.forcemerge(index=index, 
+            max_num_segments=load_options.max_num_segments,
+            params={"wait_for_completion": "false"})
+        tasks[response["task"]] = "merging %s" % index
+    for description in wait_for_tasks(client, tasks, load_options.finalise_timeout).values():
+        logger.warning("still %s after %ds, leaving it to the cluster", 
+            description, load_options.finalise_timeout)
+
+
+def _forcemerge_blocking(client, indices, load_options):
+    """force merge the indices in a request each, all at once"""
+    logger = logging.getLogger(__name__)
+
+    def forcemerge(index):
+        logger.debug("Force merging %s", index)
+        try:
+            client.indices.forcemerge(index=index, 
+                max_num_segments=load_options.max_num_segments,
+                request_timeout=load_options.finalise_timeout)
+            logger.info("merged %s", index)
+        except ConnectionTimeout:
+            logger.warning("still merging %s after %ds, leaving it to the cluster", 
+                index, load_options.finalise_timeout)
+
+    with concurrent.futures.ThreadPoolExecutor(len(indices)) as executor:
+        #raise the errors of the merges
+        list(executor.map(forcemerge, indices))
+
+
+def finalised_status(client, replicas):
+    """the health finalised indexes with the numbers of replicas can reach,
+    green only if there are more data nodes than replicas of each shard"""
+    #an unset number of replicas is the default of 1
+    most = max(int(number) if number is not None else 1 for number in replicas)
+    data_nodes = client.cluster.health()["number_of_data_nodes"]
+    return "green" if data_nodes > most else "yellow"
+
+
+def finalise_indices(client, replicas, load_options):
+    """merge the loaded indexes, a dict of their replicas by name, give them
+    their replicas and wait for them to reach the wait_for_status of the 
+    load_options, all of them at once and for at most its finalise_timeout"""
+    logger = logging.getLogger(__name__)
+    deadline = time.time() + load_options.finalise_timeout
+    indices = list(replicas)
+
+    #merging will compress everything into fewer segments
+    #temporarily, will use more disk as things are copied around
+    #but in the end should be smaller and more performant
+    #it is done before there are replicas to merge as well
+    if load_options.max_num_segments:
+        if cluster_version(client) >= BACKGROUND_FORCEMERGE_VERSION:
+            _forcemerge_tasks(client, indices, load_options)
+        else:
+            _forcemerge_blocking(client, indices, load_options)
+
+    numbers_of_replicas = []
+    for index in indices:
+        number_of_replicas = load_options.replicas if load_options.replicas is not None \
+            else replicas[index]
+        numbers_of_replicas.append(number_of_replicas)
+        client.indices.put_settings(index=index, body={
+            "index" : {
+                "number_of_replicas" : number_of_replicas
+            }
+        })
+
+    #wait for everthing to sort itself out
+    status = load_options.wait_for_status or finalised_status(client, numbers_of_replicas)
+    timeout = max(int(deadline - time.time()), 1)
+    health = client.cluster.health(index=",".join(indices), wait_for_status=status,
+        timeout="%ds" % timeout, request_timeout=timeout + 30)
+    if health.get("timed_out"):
+        logger.warning("%s not %s after %ds", ", ".join(indices), status,
+            load_options.finalise_timeout)
+    else:
+        logger.info("finalised %s", ", ".join(indices))
+
+
+def version_index_name(alias, version):
+    """the name of the index of one version of alias"""
+    return "%s-%s" % (alias, version)
+
+
+def is_version_index(alias, index):
+    """if index is named as a version of alias by version_index_name"""
+    return re.match(r'^%s-\d{14}$' % re.escape(alias), index) is not None
 
 
 class ElasticsearchBulkIndexManager(object):
     """Context manager to open an an Elasticsearch index for bulk loading."""
 
-    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False):
+    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False,
+            load_options=None, version=None):
         """Set the index to load to, and define initial state for it.
 
         Parameters
@@ -22,14 +647,42 @@ class ElasticsearchBulkIndexManager(object):
             set this to True if you want the data to be appended to the
             existing index with name index_name instead of replacing
             this index with an empty index first.
+        load_options
+            the BulkLoadOptions, when versioned index_name is the alias 
+            and the documents are written to the index_name of this manager.
+            Appending is to the current version, or unversioned to 
+            index_name if there isn't a single one
+        version
+            of the index built when versioned, by default the time
         """
         self.logger = logging.getLogger(__name__)
         self.client = client
+        self.alias = index_name
         self.index_name = index_name
+        self.load_options = load_options if load_options is not None else BulkLoadOptions()
+        self.profile = self.load_options.profile(index_name)
+        #the new version when building one
+        self.version = None
+        if self.load_options.versioned:
+            current = [index for index in alias_indices(client, index_name) 
+                if is_version_index(index_name, index)]
+            if append_data and len(current) == 1:
+                self.index_name = current[0]
+            elif append_data:
+                #a new version would only have the appended documents, so 
+                #append to the index of that name as when not versioned
+                self.logger.warning("no single version of %s to append to, "
+                    "appending to %s unversioned", index_name, index_name)
+            else:
+                self.version = version if version is not None else time.strftime("%Y%m%d%H%M%S")
+                self.index_name = version_index_name(index_name, self.version)
         #these are set on entry 
         self.old_number_of_replicas = None
         self.old_refresh_interval = None
         self.old_translog_durability = None
+        self.old_profile_settings = {}
+        #if the index is new, created on entry
+        self.created = False
         #these might or might not be set
         self.settings = settings
         self.mappings = mappings
@@ -64,50 +717,95 @@ class ElasticsearchBulkIndexManager(object):
                     if "translog.durability" in old_settings[self.index_name]["settings"]["index"]:
                         #store transaction log durability setting
                         self.old_translog_durability = old_settings[self.index_name]["settings"]["index"]["translog.durability"]
+                    self.old_profile_settings = self.profile.revert_settings(
+                        old_settings[self.index_name]["settings"]["index"])
 
 
         #set replicas to zero
         #set update interval to "never"
         #set transaction log durability to "async"
+        #and whatever the load profile of the index tunes
         self.logger.debug("changing settings for bulk into %s", self.index_name)
+        load_settings = {
+            "number_of_replicas" : 0,
+            "refresh_interval" : -1,
+            "translog.durability" : "async"
+        }
+        load_settings.update(self.profile.load_settings())
         self.client.indices.put_settings(index=self.index_name, body={
-            "index" : {
-                "number_of_replicas" : 0,
-                "refresh_interval" : -1,
-                "translog.durability" : "async"
-            }
+            "index" : load_settings
         })
         return self
         
     def __exit__(self, type, value, traceback):
         #teardown
 
-        #restore old settings
+        if type is not None and self.version is not None:
+            #the alias still points to the previous version
+            self.logger.warning("deleting %s of the failed load of %s", 
+                self.index_name, self.alias)
+            self.client.indices.delete(index=self.index_name, ignore=[404])
+            return None
+
+        #restore old settings, but the replicas until the index is merged
         self.logger.debug("Restoring old settings for %s", self.index_name)
+        old_settings = {
+            "refresh_interval" : self.old_refresh_interval,
+            "translog.durability" : self.old_translog_durability
+        }
+        old_settings.update(self.old_profile_settings)
         self.client.indices.put_settings(index=self.index_name, body={
-            "index" : {
-                "number_of_replicas" : self.old_number_of_replicas,
-                "refresh_interval" : self.old_refresh_interval,
-                "translog.durability" : self.old_translog_durability
-            }
+            "index" : old_settings
         })
-        
-
-        #run force-merge
-        #this will compress everyhting into a single "segment"
-        #temporarily, will use more disk as things are copied around
-        #but in the end should be smaller and more performant
-        self.logger.debug("Force merging %s", self.index_name)
-        self.client.indices.forcemerge(index=self.index_name, max_num_segments=1)
+        self.profile.finalise(self.client, self.index_name, self.created)
+        self.client.indices.refresh(index=self.index_name)
 
-        #wait for everthing to sort itself out
-        #self.wait_for_status(u"yellow")
-        self.wait_for_status(u"green")
+        if self.load_options.defer_finalise:
+            #the later stages read the new version before it is merged
+            self.publish()
+        self.load_options.finalise_later(self.client, 
+            {self.index_name: self.old_number_of_replicas})
+        if not self.load_options.defer_finalise:
+            self.publish()
 
         #don't return True to indicate any exceptions have been handled
         #this contex manager is only for cleanup
         return None
 
+    def publish(self):
+        """move the alias to the new version, when building one"""
+        if self.version is not None:
+            self.swap_alias()
+            self.delete_old_versions()
+
+    def swap_alias(self):
+        """point the alias to the new version only, in one update"""
+        previous = [index for index in alias_indices(self.client, self.alias) 
+            if index != self.alias]
+        #an index of the same name as the alias is replaced whole
+        if self.client.indices.exists(index=self.alias) and \
+                not self.client.indices.exists_alias(name=self.alias):
+            self.logger.warning("deleting unversioned index %s to replace it with alias", 
+                self.alias)
+            self.client.indices.delete(index=self.alias)
+
+        actions = [{"add": {"index": self.index_name, "alias": self.alias}}]
+        actions.extend({"remove": {"index": index, "alias": self.alias}} 
+            for index in previous if index != self.index_name)
+        self.client.indices.update_aliases(body={"actions": actions})
+        self.logger.info("%s now points to %s", self.alias, self.index_name)
+
+    def delete_old_versions(self):
+        """delete the versions older than the keep_versions latest ones"""
+        versions = sorted(index for index in 
+            self.client.indices.get(index=self.alias + "-*", ignore=[404])
+            if is_version_index(self.alias, index))
+        serving = set(alias_indices(self.client, self.alias))
+        for index in versions[:-self.load_options.keep_versions]:
+            if index not in serving:
+                self.logger.info("deleting old version %s of %s", index, self.alias)
+                self.client.indices.delete(index=index, ignore=[404])
+
     def create_index(self):
         """Tell the Elasticsearch client to create the index as configured."""
         self.logger.debug("creating index %s", self.index_name)
@@ -117,6 +815,7 @@ class ElasticsearchBulkIndexManager(object):
         }
         try:
             self.client.indices.create(index=self.index_name, body=body)
+            self.created = True
         except RequestError as e:
             if u'resource_already_exists_exception' == e.error:
                 self.logger.debug("swallowing index exists exception")
@@ -124,11 +823,207 @@ class ElasticsearchBulkIndexManager(object):
                 # if it wasn't this error, raise it again
                 raise e
 
-    def wait_for_status(self, desired):
-        #TODO implement a timeout?
-        self.logger.debug("Checking index status %s", self.index_name)
-        status = None
-        while status != desired:
-            time.sleep(1)
-            status = self.client.cat.indices(index=self.index_name).strip().split()[0]
-            self.logger.debug("Status of %s is %s", self.index_name, status)
+
+def partition_index_name(alias, key, run_id):
+    """the name of the index of one partition, e.g. a datasource, written by
+    the run run_id behind alias"""
+    key = re.sub(r'[^a-z0-9_]', '_', str(key).lower())
+    return "%s-%s-%s" % (alias, key, run_id)
+
+
+#reindex script routing each document of an unpartitioned index to the
+#partition of the key at params.path, as partition_index_name names it, and
+#leaving out the ones of the keys written by the load
+_COPY_PARTITIONS_SCRIPT = """
+def value = ctx._source;
+for (String part : params.path) {
+  value = value instanceof Map ? value.get(part) : null;
+}
+if (value == null) {
+  ctx.op = 'noop';
+} else {
+  String key = value.toString().toLowerCase();
+  StringBuilder name = new StringBuilder();
+  for (int i = 0; i < key.length(); ++i) {
+    String c = key.substring(i, i + 1);
+    name.append(params.allowed.indexOf(c) >= 0 ? c : '_');
+  }
+  if (params.written.contains(name.toString())) {
+    ctx.op = 'noop';
+  } else {
+    ctx._index = params.prefix + name.toString() + params.suffix;
+  }
+}
+"""
+
+
+class ElasticsearchPartitionedIndexManager(object):
+    """Context manager to bulk load into partitions of an alias, e.g. one index
+    per datasource, replacing only the partitions written this time.
+
+    The partitions are created on their first document by an index template
+    matching only the partitions of this load, deleted after it. They are 
+    named by partition_index_name with the run_id of this load, so the 
+    writers can name them without asking. Once the load succeeded the new
+    partitions are put behind the alias and the older partitions of the same
+    keys removed from it in one update, then deleted. If the load fails the
+    new partitions are deleted and the alias is left as it was. The new
+    partitions are finalised as the load_options say.
+
+    An alias still serving an unpartitioned index, a version of it or an index
+    of its name, is only loaded with a partition_field, the dotted path in the
+    documents of their partition key: the documents of the keys not written 
+    are copied to partitions of this load before the unpartitioned index is 
+    replaced, so they stay searchable. Documents without it are not copied.
+    """
+
+    def __init__(self, client, alias, settings={}, mappings={}, run_id=None,
+            load_options=None, partition_field=None):
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.alias = alias
+        self.settings = settings
+        self.mappings = mappings
+        self.run_id = run_id if run_id is not None else time.strftime("%Y%m%d%H%M%S")
+        self.load_options = load_options if load_options is not None else BulkLoadOptions()
+        self.profile = self.load_options.profile(alias)
+        self.partition_field = partition_field
+        #partitions written by this load, added by the writers
+        self.partitions = set()
+
+    def partition(self, key):
+        return partition_index_name(self.alias, key, self.run_id)
+
+    def _index_settings(self):
+        return self.settings.get("index", self.settings)
+
+    def template_name(self):
+        """the index template creating the partitions of this load"""
+        return self.alias + "-partitions"
+
+    def add(self, index):
+        self.partitions.add(index)
+
+    def unpartitioned(self):
+        """the indices the alias serves that are not partitions of it"""
+        if not self.client.indices.exists_alias(name=self.alias):
+            return [self.alias] if self.client.indices.exists(index=self.alias) else []
+        return [index for index in alias_indices(self.client, self.alias)
+            if is_version_index(self.alias, index)]
+
+    def __enter__(self):
+        unpartitioned = self.unpartitioned()
+        if unpartitioned and self.partition_field is None:
+            raise ValueError("%s serves the unpartitioned %s, which a partitioned load "
+                "without a partition field would replace whole" % (self.alias, 
+                    ", ".join(unpartitioned)))
+
+        #the partitions start with the same bulk loading settings as
+        #ElasticsearchBulkIndexManager
+        index_settings = dict(self._index_settings())
+        index_settings.pop("translog", None)
+        index_settings.update({
+            "number_of_replicas": 0,
+            "refresh_interval": -1,
+            "translog.durability": "async"
+        })
+        index_settings.update(self.profile.load_settings())
+        self.logger.debug("creating index template for partitions of %s", self.alias)
+        self.client.indices.put_template(name=self.template_name(), body={
+            "index_patterns": ["%s-*-%s" % (self.alias, self.run_id)],
+            "settings": {"index": index_settings},
+            "mappings": self.mappings
+        })
+        return self
+
+    def copy_unpartitioned(self, unpartitioned):
+        """copy the documents of the keys not written from the unpartitioned
+        indices to partitions of this load, created by its template"""
+        prefix = self.alias + "-"
+        suffix = "-" + self.run_id
+        written = sorted(index[len(prefix):-len(suffix)] for index in self.partitions)
+        for index in unpartitioned:
+            self.logger.info("copying the partitions of %s not written to %s", 
+                self.alias, index)
+            response = self.client.reindex(body={
+                "source": {"index": index},
+                #every document is routed or left out by the script
+                "dest": {"index": self.partition("copy")},
+                "script": {"lang": "painless", "source": _COPY_PARTITIONS_SCRIPT, "params": {
+                    "path": self.partition_field.split("."),
+                    "allowed": "abcdefghijklmnopqrstuvwxyz0123456789_",
+                    "written": written, "prefix": prefix, "suffix": suffix}}
+            }, params={"wait_for_completion": "false"})
+            task_id = response["task"]
+            wait_for_tasks(self.client, {task_id: "copying %s" % index}, float("inf"))
+            failures = self.client.tasks.get(task_id=task_id).get("response", {}).get("failures")
+            if failures:
+                raise RuntimeError("copying %s failed: %s" % (index, failures))
+        self.partitions.update(self.client.indices.get(index="%s*%s" % (prefix, suffix)))
+
+    def _discard(self):
+        self.client.indices.delete_template(name=self.template_name(), ignore=[404])
+        for index in sorted(self.partitions):
+            self.client.indices.delete(index=index, ignore=[404])
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            self.logger.warning("deleting partitions of the failed load of %s", self.alias)
+            self._discard()
+            return None
+
+        unpartitioned = self.unpartitioned() if self.partitions else []
+        if unpartitioned:
+            try:
+                self.copy_unpartitioned(unpartitioned)
+            except Exception:
+                self.logger.warning("deleting partitions of the failed copy to %s", self.alias)
+                self._discard()
+                raise
+
+        #the partitions of this load are all created by now
+        self.client.indices.delete_template(name=self.template_name(), ignore=[404])
+
+        partitions = sorted(self.partitions)
+        if not partitions:
+            return None
+
+        self.logger.debug("Restoring settings of the partitions of %s", self.alias)
+        index_settings = self._index_settings()
+        old_settings = {
+            "refresh_interval" : index_settings.get("refresh_interval"),
+            "translog.durability" : index_settings.get("translog", {}).get("durability",
+                index_settings.get("translog.durability"))
+        }
+        old_settings.update(self.profile.revert_settings(index_settings))
+        self.client.indices.put_settings(index=",".join(partitions), body={
+            "index" : old_settings
+        })
+        self.profile.finalise(self.client, ",".join(partitions))
+        self.client.indices.refresh(index=",".join(partitions))
+        self.load_options.finalise_later(self.client, collections.OrderedDict(
+            (index, index_settings.get("number_of_replicas")) for index in partitions))
+
+        #older partitions of the keys written this time, and the unpartitioned
+        #indices now copied
+        keys = set(index[:-len(self.run_id)] for index in partitions)
+        replaced = [index for index in alias_indices(self.client, self.alias)
+            if index != self.alias and index not in self.partitions and
+                index[:index.rfind("-") + 1] in keys]
+        replaced.extend(index for index in unpartitioned if index != self.alias)
+
+        #an unpartitioned index of the same name has to go for the alias
+        if self.alias in unpartitioned:
+            self.logger.info("deleting unpartitioned index %s", self.alias)
+            self.client.indices.delete(index=self.alias)
+
+        actions = [{"add": {"index": index, "alias": self.alias}} for index in partitions]
+        actions.extend({"remove": {"index": index, "alias": self.alias}} for index in replaced)
+        self.client.indices.update_aliases(body={"actions": actions})
+        self.logger.info("%s now has partitions %s", self.alias, 
+            ", ".join(alias_indices(self.client, self.alias)))
+
+        for index in replaced:
+            self.logger.debug("deleting replaced partition %s", index)
+            self.client.indices.delete(index=index, ignore=[404])
+        return None
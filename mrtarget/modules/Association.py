@@ -1,19 +1,27 @@
 from builtins import str
 from builtins import object
 import logging
+import contextlib
 import copy
+import os
+import shutil
+import tempfile
+import zlib
 
 import functools
 import itertools
 from collections import defaultdict
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
-from mrtarget.common.DataStructure import JSONSerializable
+from mrtarget.common.esutil import parallel_scan, bulk_entry
+from mrtarget.common.IndexReader import new_index_reader
+from mrtarget.common.esfile import index_manager, bulk_entries
+from mrtarget.common.EvidenceColumns import EvidenceColumns, open_evidence_columns
+from mrtarget.common.DataStructure import PipelineEncoder, json_serialize
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.LookupHelpers import LookUpDataRetriever
-from mrtarget.common.Scoring import ScoringMethods, HarmonicSumScorer
-from mrtarget.modules.EFO import EFO
+from mrtarget.common.LookupHelpers import LookUpDataRetriever, lookup_snapshots
+from mrtarget.common.Scoring import ScoringMethods, HarmonicSumScorer, harmonic_sum_groups
+from mrtarget.modules.EFO import EFO, EfoDag
 from mrtarget.common.EvidenceString import Evidence, ExtendedInfoGene, ExtendedInfoEFO
 from mrtarget.modules.GeneData import Gene
 from mrtarget.modules.HPA import HPAExpression, hpa2tissues
@@ -22,48 +30,84 @@ from opentargets_urlzsource import URLZSource
 import elasticsearch
 from elasticsearch import helpers
 from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll, ConstantScore, Q
+from elasticsearch_dsl.query import ConstantScore, Q
 import pypeln.process as pr
 import simplejson as json
 
 
-class AssociationScore(JSONSerializable):
+class ScoreLayout(object):
+    """
+    Fixed ordering of the datasources and datatypes, built once from 
+    datasources_to_datatypes, so the scores and counts of each association 
+    can be kept in flat lists instead of nested dicts
+    """
+    __slots__ = ('datasources_to_datatypes', 'datasources', 'datatypes',
+        'datasource_index', 'datatype_index', 'datasource_datatype')
+
+    def __init__(self, datasources_to_datatypes):
+        self.datasources_to_datatypes = datasources_to_datatypes
+        self.datasources = list(datasources_to_datatypes.keys())
+        self.datatypes = sorted(set(datasources_to_datatypes.values()))
+        self.datasource_index = dict((ds, i) for i, ds in enumerate(self.datasources))
+        self.datatype_index = dict((dt, i) for i, dt in enumerate(self.datatypes))
+        #index of the datatype of each datasource
+        self.datasource_datatype = [self.datatype_index[datasources_to_datatypes[ds]]
+            for ds in self.datasources]
+
+
+class AssociationScore(object):
+    __slots__ = ('layout', 'datasource_scores', 'datatype_scores', 'overall')
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.datasource_scores = [0.0] * len(layout.datasources)
+        self.datatype_scores = [0.0] * len(layout.datatypes)
 
-    def __init__(self, datasources, datatypes):
-        self.datasources = {}
-        for datasource in datasources:
-            self.datasources[datasource] = 0.0
-        self.datatypes = {}
-        for datatype in datatypes:
-            self.datatypes[datatype] = 0.0
+    @property
+    def datasources(self):
+        return dict(zip(self.layout.datasources, self.datasource_scores))
 
+    @property
+    def datatypes(self):
+        return dict(zip(self.layout.datatypes, self.datatype_scores))
 
-class Association(JSONSerializable):
+    def set_datasource(self, datasource, score):
+        self.datasource_scores[self.layout.datasource_index[datasource]] = score
 
-    def __init__(self, target, disease, is_direct, datasources, datatypes):
+    def to_dict(self):
+        score = dict(datasources=self.datasources, datatypes=self.datatypes)
+        if hasattr(self, 'overall'):
+            score['overall'] = self.overall
+        return score
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+
+class Association(object):
+    #slotted, so not a JSONSerializable, which has a __dict__
+    #the fields written out, the others are private
+    FIELDS = ('target', 'disease', 'is_direct', 'id', 'private')
+    __slots__ = FIELDS + ('_layout', '_scores', '_evidence_total', '_datasource_counts',
+        '_datatype_counts')
+
+    def __init__(self, target, disease, is_direct, layout):
         self.target = {'id': target}
         self.disease = {'id': disease}
         self.is_direct = is_direct
         self.set_id()
 
+        #scores and evidence counts are kept compact and only expanded to 
+        #nested dicts of every datasource and datatype by to_json
+        self._layout = layout
+        self._scores = {}
         for method_key, method in list(ScoringMethods.__dict__.items()):
             if not method_key.startswith('_'):
-                self.set_scoring_method(method, AssociationScore(datasources, datatypes))
-
-        self.evidence_count = dict(total=0.0,
-                                   datatypes={},
-                                   datasources={})
-
-        self.evidence_count['datasources'] = {}
-        for datasource in datasources:
-            self.evidence_count['datasources'][datasource] = 0.0
-
-        self.evidence_count['datatypes'] = {}
-        for datatype in datatypes:
-            self.evidence_count['datatypes'][datatype] = 0.0
-
-
+                self.set_scoring_method(method, AssociationScore(layout))
 
+        self._evidence_total = 0.0
+        self._datasource_counts = [0.0] * len(layout.datasources)
+        self._datatype_counts = [0.0] * len(layout.datatypes)
 
         self.private = {}
         self.private['facets'] = dict(datatype=[],
@@ -74,7 +118,7 @@ class Association(JSONSerializable):
     def get_scoring_method(self, method):
         if method not in list(ScoringMethods.__dict__.values()):
             raise AttributeError("method need to be a valid ScoringMethods")
-        return self.__dict__[method]
+        return self._scores[method]
 
     def set_scoring_method(self, method, score):
         if method not in list(ScoringMethods.__dict__.values()):
@@ -82,7 +126,37 @@ class Association(JSONSerializable):
         if not isinstance(score, AssociationScore):
             raise AttributeError("score need to be an instance"
                                  "of AssociationScore")
-        self.__dict__[method] = score
+        self._scores[method] = score
+
+    def count_evidence(self, datasource, datatype):
+        """count one evidence, only if both its datasource and datatype are known"""
+        datasource_i = self._layout.datasource_index.get(datasource)
+        datatype_i = self._layout.datatype_index.get(datatype)
+        if datasource_i is None or datatype_i is None:
+            return False
+        self._evidence_total += 1
+        self._datasource_counts[datasource_i] += 1
+        self._datatype_counts[datatype_i] += 1
+        return True
+
+    @property
+    def evidence_count(self):
+        return dict(total=self._evidence_total,
+            datatypes=dict(zip(self._layout.datatypes, self._datatype_counts)),
+            datasources=dict(zip(self._layout.datasources, self._datasource_counts)))
+
+    def to_dict(self):
+        association = dict((k, getattr(self, k)) for k in self.FIELDS)
+        for method, score in self._scores.items():
+            association[method] = score.to_dict()
+        association['evidence_count'] = self.evidence_count
+        return association
+
+    def to_json(self):
+        return json.dumps(self.to_dict(),
+                          default=json_serialize,
+                          sort_keys=True,
+                          cls=PipelineEncoder)
 
     def set_id(self):
         self.id = '%s-%s' % (self.target['id'], self.disease['id'])
@@ -228,6 +302,8 @@ class Association(JSONSerializable):
 
 
 class EvidenceScore(object):
+    __slots__ = ('score', 'datatype', 'datasource', 'is_direct')
+
     def __init__(self, score, datatype, datasource, is_direct):
         self.score = score
         self.datatype = datatype
@@ -239,73 +315,107 @@ class Scorer(object):
     '''
     Aggregates evidence for a given target-disease pair
     '''
-    def __init__(self):
-        pass
+    #below this many evidence the per datasource scorers are faster than numpy
+    VECTORISED_MIN_EVIDENCE = 20
 
-    def score(self,target, disease, evidence_scores, is_direct, datasources_to_datatypes):
+    def __init__(self):
+        self._layout = None
 
+    def layout(self, datasources_to_datatypes):
+        """the ScoreLayout of datasources_to_datatypes, built once and reused"""
+        if self._layout is None or \
+                self._layout.datasources_to_datatypes is not datasources_to_datatypes:
+            self._layout = ScoreLayout(datasources_to_datatypes)
+        return self._layout
 
-        datasources = list(datasources_to_datatypes.keys())
-        datatypes = set(datasources_to_datatypes.values())
+    def score(self,target, disease, evidence_scores, is_direct, datasources_to_datatypes):
 
-        association = Association(target, disease, is_direct, datasources, datatypes)
+        layout = self.layout(datasources_to_datatypes)
+        association = Association(target, disease, is_direct, layout)
 
         # set evidence counts
         for e in evidence_scores:
             # make sure datatype is constrained
-            if all([e.datatype in association.evidence_count['datatypes'],
-                    e.datasource in association.evidence_count['datasources']]):
-                association.evidence_count['total']+=1
-                association.evidence_count['datatypes'][e.datatype]+=1
-                association.evidence_count['datasources'][e.datasource]+=1
-
+            if association.count_evidence(e.datasource, e.datatype):
                 # set facet data
                 association.set_available_datatype(e.datatype)
                 association.set_available_datasource(e.datasource)
 
         # compute harmonic sum with quadratic (scale_factor) degradation
         #limit to first 100 entries and scale with afactor of 2
-        self._harmonic_sum(evidence_scores, association, 100, 2, datasources_to_datatypes)
+        self._harmonic_sum(evidence_scores, association, 100, 2, layout)
 
         return association
 
     def _harmonic_sum(self, evidence_scores, association, 
-            max_entries, scale_factor, datasources_to_datatypes):
+            max_entries, scale_factor, layout):
         har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
-        datasource_scorers = {}
-        for e in evidence_scores:
-            if e.datasource not in datasource_scorers:
-                datasource_scorers[e.datasource]= HarmonicSumScorer(buffer=max_entries)
-            datasource_scorers[e.datasource].add(e.score)
         '''compute datasource scores'''
         overall_scorer = HarmonicSumScorer(buffer=max_entries)
-        for datasource in datasource_scorers:
+        for datasource, score in self._datasource_harmonic_sums(evidence_scores,
+                max_entries, scale_factor):
             '''cap datasource scores at this level so very big scores 
             do not take over smaller score around the range of 1'''
-            har_sum_score.datasources[datasource]=datasource_scorers[datasource].score(scale_factor=scale_factor, cap=1)
-            overall_scorer.add(har_sum_score.datasources[datasource])
+            har_sum_score.set_datasource(datasource, score)
+            overall_scorer.add(score)
         '''compute datatype scores'''
         datatypes_scorers = dict()
-        for ds in har_sum_score.datasources:
-            dt = datasources_to_datatypes[ds]
+        for ds, score in enumerate(har_sum_score.datasource_scores):
+            dt = layout.datasource_datatype[ds]
             if dt not in datatypes_scorers:
                 datatypes_scorers[dt]= HarmonicSumScorer(buffer=max_entries)
-            datatypes_scorers[dt].add(har_sum_score.datasources[ds])
+            datatypes_scorers[dt].add(score)
         for datatype in datatypes_scorers:
-            har_sum_score.datatypes[datatype]=datatypes_scorers[datatype].score(scale_factor=scale_factor)
+            har_sum_score.datatype_scores[datatype]=datatypes_scorers[datatype].score(scale_factor=scale_factor)
         '''compute overall scores'''
         har_sum_score.overall = overall_scorer.score(scale_factor=scale_factor)
 
         return association
 
+    def _datasource_harmonic_sums(self, evidence_scores, max_entries, scale_factor):
+        '''(datasource, capped harmonic sum) for each datasource with evidence
+
+        small pairs are scored one HarmonicSumScorer per datasource, pairs with
+        many evidence are scored with a single vectorised pass over all of
+        them; both give exactly the same values'''
+        if len(evidence_scores) < self.VECTORISED_MIN_EVIDENCE:
+            datasource_scorers = {}
+            for e in evidence_scores:
+                if e.datasource not in datasource_scorers:
+                    datasource_scorers[e.datasource]= HarmonicSumScorer(buffer=max_entries)
+                datasource_scorers[e.datasource].add(e.score)
+            return [(datasource, scorer.score(scale_factor=scale_factor, cap=1))
+                for datasource, scorer in datasource_scorers.items()]
+
+        datasource_indexes = {}
+        scores = []
+        groups = []
+        for e in evidence_scores:
+            groups.append(datasource_indexes.setdefault(e.datasource, len(datasource_indexes)))
+            scores.append(e.score)
+        harmonic_sums = harmonic_sum_groups(scores, groups, len(datasource_indexes),
+            buffer=max_entries, scale_factor=scale_factor, cap=1)
+        return [(datasource, harmonic_sums[i])
+            for datasource, i in datasource_indexes.items()]
+
 def produce_evidence_local_init(es_hosts, es_index_val_right,
-        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        efo_dag=None):
     es = new_es_client(es_hosts)
     return (es, es_index_val_right, scoring_weights, 
-        is_direct_do_not_propagate, datasources_to_datatypes)
+        is_direct_do_not_propagate, datasources_to_datatypes, efo_dag)
+
+#fields of the evidence needed to compute the associations
+EVIDENCE_SCORING_FIELDS = ['target.id', 'private.efo_codes', 'disease.id',
+    'scores.association_score','sourceID','id']
+
+#when propagating with an EfoDag the ancestor codes are not read from the evidence
+EVIDENCE_SCORING_FIELDS_DAG = [f for f in EVIDENCE_SCORING_FIELDS if f != 'private.efo_codes']
+
+def evidence_scoring_fields(efo_dag):
+    return EVIDENCE_SCORING_FIELDS if efo_dag is None else EVIDENCE_SCORING_FIELDS_DAG
 
-def get_evidence_for_target_simple(es, target, index):
-    fields = ['target.id', 'private.efo_codes', 'disease.id','scores.association_score','sourceID','id']
+def get_evidence_for_target_simple(es, target, index, fields=EVIDENCE_SCORING_FIELDS):
     evidence = Search().using(es).index(index).query(
         ConstantScore(filter=Q('term', target__id=target))
     ).source(includes=fields).params(scroll='4h', size=1000).scan()
@@ -313,12 +423,28 @@ def get_evidence_for_target_simple(es, target, index):
         yield ev.to_dict()
 
 def produce_evidence(target, es, es_index_val_right,
-        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        efo_dag=None):
+    evidences = get_evidence_for_target_simple(es, target, es_index_val_right,
+        evidence_scoring_fields(efo_dag))
+    return group_evidence(evidences,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes, efo_dag)
+
+def group_evidence(evidences, 
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        efo_dag=None):
+    """group the evidence of a target by (target, disease) propagating up the 
+    disease ontology, returning a list of (target, disease, scores, is_direct)
+
+    the ancestors are read from private.efo_codes of each evidence, or from
+    efo_dag when one is given"""
+    if efo_dag is not None:
+        return group_evidence_dag(evidences, scoring_weights, 
+            is_direct_do_not_propagate, datasources_to_datatypes, efo_dag)
+
     data_cache = {}
     return_values = []
-    for evidence in get_evidence_for_target_simple(es, target, es_index_val_right):
-
-        
+    for evidence in evidences:
 
         if evidence['sourceID'] in is_direct_do_not_propagate:
             efo_list = [evidence['disease']['id']]
@@ -356,10 +482,130 @@ def produce_evidence(target, es, es_index_val_right,
 
     return return_values
 
+def group_evidence_dag(evidences, 
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes, efo_dag):
+    """same result as group_evidence, but propagating along an in-memory EfoDag
+
+    each evidence makes one direct and one indirect EvidenceScore, and the 
+    lists of the ancestor diseases share them instead of making new ones. As
+    with the efo codes, an evidence of a disease without path codes makes no
+    association at all, unless its datasource is not propagated"""
+    #(target, disease index) to the (direct, indirect) scores of its own evidence
+    own_scores = {}
+    #diseases not in the dag are only associated directly, indexed after it
+    unknown = {}
+    #if each disease is in its own path codes
+    on_own_path = {}
+    for evidence in evidences:
+        disease = evidence['disease']['id']
+        data_source = evidence['sourceID']
+        propagate = data_source not in is_direct_do_not_propagate
+        if disease in efo_dag.index:
+            disease_index = efo_dag.index[disease]
+        elif propagate:
+            continue
+        else:
+            disease_index = unknown.setdefault(disease, len(efo_dag) + len(unknown))
+        key = (evidence['target']['id'], disease_index)
+        if key not in own_scores:
+            own_scores[key] = ([], [])
+
+        score = evidence['scores']['association_score']
+        if data_source in scoring_weights:
+            score = score * scoring_weights[data_source]
+
+        data_type = datasources_to_datatypes[data_source]
+
+        if propagate:
+            if disease_index not in on_own_path:
+                on_own_path[disease_index] = bool(
+                    (efo_dag.ancestors(disease_index) == disease_index).any())
+            if on_own_path[disease_index]:
+                own_scores[key][0].append(EvidenceScore(score, data_type, data_source, True))
+            own_scores[key][1].append(EvidenceScore(score, data_type, data_source, False))
+        else:
+            own_scores[key][0].append(EvidenceScore(score, data_type, data_source, True))
+
+    data_cache = defaultdict(list)
+    for (target, disease_index), (direct, indirect) in own_scores.items():
+        if direct:
+            data_cache[(target, disease_index)].extend(direct)
+        if indirect:
+            for ancestor in efo_dag.ancestors(disease_index):
+                if ancestor != disease_index:
+                    data_cache[(target, ancestor)].extend(indirect)
+
+    codes = dict((i, disease) for disease, i in unknown.items())
+    return_values = []
+    for (target, disease_index), evidence in data_cache.items():
+        if disease_index < len(efo_dag):
+            disease = efo_dag.codes[disease_index]
+        else:
+            disease = codes[disease_index]
+        #if any of the evidence is direct, the assication is direct
+        key = (target, disease_index)
+        is_direct = key in own_scores and len(own_scores[key][0]) > 0
+        return_values.append((target, disease, evidence, is_direct))
+
+    return return_values
+
+def spill_evidence_partitions(reader, es_index_val_right, directory, partitions, 
+        scan_workers=1, fields=EVIDENCE_SCORING_FIELDS):
+    """scan the whole evidence index once with the IndexReader for the fields
+    needed for scoring and write each evidence to one of the partition files,
+    chosen by its target, so that all the evidence of a target is in the same
+    file
+
+    returns the list of partition file names"""
+    logger = logging.getLogger(__name__)
+    filenames = [os.path.join(directory, "evidence-%04d.json" % i) for i in range(partitions)]
+    files = [open(filename, "w") for filename in filenames]
+    try:
+        count = 0
+        query = {"query": {"match_all": {}}, "_source": fields}
+        for hit in reader.scan(es_index_val_right, query, workers=scan_workers):
+            evidence = hit['_source']
+            #crc32 rather than hash() so it does not depend on the process
+            partition = zlib.crc32(evidence['target']['id'].encode("utf-8")) % partitions
+            files[partition].write(json.dumps(evidence)+"\n")
+            count += 1
+        logger.info("spilled %d evidence into %d partitions", count, partitions)
+    finally:
+        for f in files:
+            f.close()
+    return filenames
+
+def produce_evidence_partition(filename, es, es_index_val_right,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        efo_dag=None):
+    """read a partition file written by spill_evidence_partitions and yield the
+    grouped evidence of each of its targets in turn"""
+    targets = defaultdict(list)
+    with open(filename) as f:
+        for line in f:
+            evidence = json.loads(line)
+            targets[evidence['target']['id']].append(evidence)
+    for target in list(targets):
+        for value in group_evidence(targets.pop(target), scoring_weights, 
+                is_direct_do_not_propagate, datasources_to_datatypes, efo_dag):
+            yield value
+
+def produce_evidence_columns(chunk, es, es_index_val_right,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        efo_dag=None):
+    """take the (directory, start, end) targets of the evidence columns
+    written by --val and yield the grouped evidence of each of them in turn"""
+    directory, start, end = chunk
+    columns = open_evidence_columns(directory)
+    for evidences in columns.target_evidence(start, end):
+        for value in group_evidence(evidences, scoring_weights, 
+                is_direct_do_not_propagate, datasources_to_datatypes, efo_dag):
+            yield value
+
 def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
         es_index_gene, es_index_hpa, es_index_efo,
         gene_cache_size, hpa_cache_size,
-        efo_cache_size, ):
+        efo_cache_size, lookup_snapshot_files, es_index=None):
     scorer = Scorer()
     lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
         gene_index=es_index_gene,
@@ -367,12 +613,18 @@ def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
         hpa_index=es_index_hpa,
         hpa_cache_size = hpa_cache_size,
         efo_index=es_index_efo,
-        efo_cache_size = efo_cache_size
+        efo_cache_size = efo_cache_size,
+        snapshot_files = lookup_snapshot_files
         ).lookup
-    return scorer, lookup_data, datasources_to_datatypes, dry_run
+    return scorer, lookup_data, datasources_to_datatypes, dry_run, es_index
+
+def score_producer_local_done(status, scorer, lookup_data, datasources_to_datatypes, dry_run,
+        es_index=None):
+    logging.getLogger(__name__).info("scoring lookup metrics %s", 
+        json.dumps(lookup_data.metrics()))
 
 def score_producer(data, 
-        scorer, lookup_data, datasources_to_datatypes, dry_run):
+        scorer, lookup_data, datasources_to_datatypes, dry_run, es_index=None):
     target, disease, evidence, is_direct = data
 
     if evidence:
@@ -414,26 +666,36 @@ def score_producer(data,
 
             element_id = '%s-%s' % (target, disease)
 
-            #convert the score into a JSON-compatible object
-            #otherwise Python serialization consumes too much memory
-            return (element_id, score.to_json())
+            #convert the score into the lines of the bulk request indexing it
+            #so the writer in the parent process only has to send them
+            return bulk_entry(es_index, element_id, score.to_json())
 
         return None
 
 
 class ScoringProcess(object):
 
+    #number of files the evidence is split into by target in single pass mode
+    SINGLE_PASS_PARTITIONS = 64
+    #number of targets a producer takes from the evidence columns at a time
+    COLUMNS_CHUNK_TARGETS = 100
+
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
             es_index_gene, es_index_val_right, es_index_hpa, es_index_efo,
             workers_write, workers_production, workers_score, 
             queue_score, queue_produce, queue_write, 
             cache_hpa, cache_efo, cache_target, 
             scoring_weights, is_direct_do_not_propagate,
-            datasources_to_datatypes):
+            datasources_to_datatypes, lookup_snapshot=False, lookup_cache_dir=None,
+            single_pass=False, workers_scan=1, propagate_in_memory=False, es_folder=None,
+            evidence_columns=None, es_bulk_bytes=None, es_load=None):
 
         self.logger = logging.getLogger(__name__)
 
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -456,105 +718,157 @@ class ScoringProcess(object):
         self.scoring_weights = scoring_weights
         self.is_direct_do_not_propagate = is_direct_do_not_propagate
         self.datasources_to_datatypes = datasources_to_datatypes
-
-
-    def get_targets(self, es):
-        for target in Search().using(es).index(self.es_index_gene).query(MatchAll()).params(scroll = '4h').scan():
-            yield str(target.meta.id)
+        self.lookup_snapshot = lookup_snapshot
+        self.lookup_cache_dir = lookup_cache_dir
+        self.single_pass = single_pass
+        self.workers_scan = workers_scan
+        self.propagate_in_memory = propagate_in_memory
+        self.evidence_columns = evidence_columns
+
+
+    def get_targets(self, reader):
+        query = {"query": {"match_all": {}}, "_source": False}
+        for target in reader.scan(self.es_index_gene, query, workers=self.workers_scan):
+            yield str(target['_id'])
+
+    def get_efo_dag(self, reader):
+        """when propagating in memory, load the EFO graph once for all the
+        producers, otherwise None to use private.efo_codes of the evidence"""
+        if not self.propagate_in_memory:
+            return None
+        return EfoDag.build(reader, self.es_index_efo, self.workers_scan)
+
+    def evidence_column_chunks(self):
+        """the (directory, start, end) chunks of targets of the evidence
+        columns written by --val"""
+        columns = EvidenceColumns(self.evidence_columns)
+        self.logger.info("reading %d evidence of %d targets from the columns in %s",
+            len(columns), columns.target_count, self.evidence_columns)
+        return [(self.evidence_columns, start, end) 
+            for start, end in columns.target_chunks(self.COLUMNS_CHUNK_TARGETS)]
+
+    @contextlib.contextmanager
+    def evidence_partitions(self, reader, efo_dag=None):
+        """when single pass, scan the evidence once into partition files in a
+        temporary directory removed on exit, otherwise yield None"""
+        if not self.single_pass or self.evidence_columns:
+            yield None
+            return
+        directory = tempfile.mkdtemp(prefix="mrtarget-assoc-")
+        try:
+            yield spill_evidence_partitions(reader, self.es_index_val_right, 
+                directory, self.SINGLE_PASS_PARTITIONS, self.workers_scan,
+                evidence_scoring_fields(efo_dag))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
 
     def process_all(self, dry_run):
 
         # do not pass this es object to other processess, single process only!
         es = new_es_client(self.es_hosts)
 
-        targets = self.get_targets(es)
+        #the inputs written to the folder are read from it
+        reader = new_index_reader(es, self.es_folder)
+        if self.evidence_columns and self.single_pass:
+            self.logger.warning("reading the evidence from %s, not in a single pass",
+                self.evidence_columns)
+        elif not self.single_pass and self.es_folder and self.es_index_val_right in reader:
+            #the evidence of each target is searched for in elasticsearch otherwise
+            self.logger.warning("reading %s from %s in a single pass", 
+                self.es_index_val_right, self.es_folder)
+            self.single_pass = True
+
+        targets = self.get_targets(reader)
+        efo_dag = self.get_efo_dag(reader)
 
         self.logger.info('setting up stages')
 
-        #bake the arguments for the setup into function objects
-        produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
-            self.es_hosts, self.es_index_val_right,
-            self.scoring_weights, self.is_direct_do_not_propagate, 
-            self.datasources_to_datatypes)
-        score_producer_local_init_baked = functools.partial(score_producer_local_init,
-            self.datasources_to_datatypes, dry_run, self.es_hosts,
-            self.es_index_gene, self.es_index_hpa, self.es_index_efo,
-            self.cache_target, self.cache_hpa, self.cache_efo)
+        #when requested, build the lookup tables once here and let the children
+        #share the memory-mapped files instead of querying elasticsearch
+        with lookup_snapshots(es, self.lookup_snapshot, self.lookup_cache_dir, 
+                gene_index=self.es_index_gene,
+                hpa_index=self.es_index_hpa, efo_index=self.es_index_efo) as snapshot_files, \
+                self.evidence_partitions(reader, efo_dag) as partitions:
+            with URLZSource(self.es_mappings).open() as mappings_file:
+                mappings = json.load(mappings_file)
+
+            with URLZSource(self.es_settings).open() as settings_file:
+                settings = json.load(settings_file)
+
+            #the scorers serialise the associations into the index it names
+            manager = index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load)
+
+            #bake the arguments for the setup into function objects
+            produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
+                self.es_hosts, self.es_index_val_right,
+                self.scoring_weights, self.is_direct_do_not_propagate, 
+                self.datasources_to_datatypes, efo_dag)
+            score_producer_local_init_baked = functools.partial(score_producer_local_init,
+                self.datasources_to_datatypes, dry_run, self.es_hosts,
+                self.es_index_gene, self.es_index_hpa, self.es_index_efo,
+                self.cache_target, self.cache_hpa, self.cache_efo, snapshot_files,
+                manager.index_name)
         
-        #pipeline stage for making the lists of the target/disease pairs and evidence
-        pipeline_stage1 = pr.flat_map(produce_evidence, targets, 
-            workers=self.workers_production,
-            maxsize=self.queue_produce,
-            on_start=produce_evidence_local_init_baked)
-
-        #pipeline stage for scoring the evidence sets
-        #includes writing to elasticsearch
-        pipeline_stage2 = pr.map(score_producer, pipeline_stage1, 
-            workers=self.workers_score,
-            maxsize=self.queue_score,
-            on_start=score_producer_local_init_baked)
-
-        with URLZSource(self.es_mappings).open() as mappings_file:
-            mappings = json.load(mappings_file)
-
-        with URLZSource(self.es_settings).open() as settings_file:
-            settings = json.load(settings_file)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
-            #load into elasticsearch
-            self.logger.info('stages created, running scoring and writing')
-            client = es
-            chunk_size = 1000 #TODO make configurable
-            actions = self.elasticsearch_actions(pipeline_stage2, self.es_index)
-            failcount = 0
-
-            if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    self.logger.debug("Using parallel bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.parallel_bulk(client, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    self.logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(client, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
-
-                if failcount:
-                    raise RuntimeError("%s relations failed to index" % failcount)
+            #pipeline stage for making the lists of the target/disease pairs and evidence
+            if self.evidence_columns:
+                #each producer groups the evidence of chunks of targets of the columns
+                pipeline_stage1 = pr.flat_map(produce_evidence_columns, 
+                    self.evidence_column_chunks(), 
+                    workers=self.workers_production,
+                    maxsize=self.queue_produce,
+                    on_start=produce_evidence_local_init_baked)
+            elif partitions is not None:
+                #each producer groups whole partitions of the already scanned evidence
+                pipeline_stage1 = pr.flat_map(produce_evidence_partition, partitions, 
+                    workers=self.workers_production,
+                    maxsize=self.queue_produce,
+                    on_start=produce_evidence_local_init_baked)
+            else:
+                pipeline_stage1 = pr.flat_map(produce_evidence, targets, 
+                    workers=self.workers_production,
+                    maxsize=self.queue_produce,
+                    on_start=produce_evidence_local_init_baked)
+
+            #pipeline stage for scoring the evidence sets
+            #includes writing to elasticsearch
+            pipeline_stage2 = pr.map(score_producer, pipeline_stage1, 
+                workers=self.workers_score,
+                maxsize=self.queue_score,
+                on_start=score_producer_local_init_baked,
+                on_done=score_producer_local_done)
+
+            with manager:
+                #load into elasticsearch
+                self.logger.info('stages created, running scoring and writing')
+                client = es
+                entries = (entry for entry in pipeline_stage2 if entry is not None)
+                failcount = 0
+
+                if not dry_run:
+                    results = bulk_entries(client, self.es_folder, entries,
+                            thread_count=self.workers_write, queue_size=self.queue_write, 
+                            chunk_bytes=self.es_bulk_bytes)
+                    for success, details in results:
+                        if not success:
+                            failcount += 1
+
+                    if failcount:
+                        raise RuntimeError("%s relations failed to index" % failcount)
 
         self.logger.info("DONE")
 
-    """
-    Generates elasticsearch action objects from the results iterator
-
-    Output suitable for use with elasticsearch.helpers 
-    """
-    def elasticsearch_actions(self, results, index):
-        for r in results:
-            if r is not None:
-                element_id, score = r
-                action = {}
-                action["_index"] = index
-                action["_id"] = element_id
-                #elasticsearch client uses https://github.com/elastic/elasticsearch-py/blob/master/elasticsearch/serializer.py#L24
-                #to turn objects into JSON bodies. This in turn calls json.dumps() using simplejson if present.
-                action["_source"] = score
-                yield action
-                    
     """
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
 
         #number of eco entries
         association_count = 0
         #Note: try to avoid doing this more than once!
-        for association in Search().using(es).index(index).query(MatchAll()).params(scroll = '4h').scan():
+        query = {"query": {"match_all": {}}, "_source": False}
+        for association in parallel_scan(es, index, query, workers=scan_workers):
             association_count += 1
             if association_count % 1000 == 0:
                 self.logger.debug("checking %d", association_count)
@@ -24,7 +24,9 @@ from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer, _document_frequency
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.IndexReader import new_index_reader
+from mrtarget.common.esfile import index_manager, bulk_entries
+from mrtarget.common.esutil import bulk_entry
 from mrtarget.common.DataStructure import SparseFloatDict
 
 class RelationType(object):
@@ -157,24 +159,17 @@ class OverlapDistance(object):
 Consumes the iterable passed in and loads into into provided loader
 whilst also respecting the dry run flag given
 
-Uses elasticsearch.helpers.parallel_bulk with multiple threads for high
-performance loading
+Uses a BulkWriter with multiple threads for high performance loading
 """
-def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, index):
-    chunk_size = 1000 #TODO make configurable
-    actions = elasticsearch_actions(results, dry_run, index)
+def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, index,
+        es_folder=None, es_bulk_bytes=None):
+    #the relations come already serialised by calculate_pair
+    entries = (entry for entry in results if entry)
     failcount = 0
 
     if not dry_run:
-        results = None
-        if workers_write > 0:
-            results = elasticsearch.helpers.parallel_bulk(es, actions,
-                    thread_count=workers_write,
-                    queue_size=queue_write, 
-                    chunk_size=chunk_size)
-        else:
-            results = elasticsearch.helpers.streaming_bulk(es, actions,
-                    chunk_size=chunk_size)
+        results = bulk_entries(es, es_folder, entries,
+                thread_count=workers_write, queue_size=queue_write, chunk_bytes=es_bulk_bytes)
         for success, details in results:
             if not success:
                 failcount += 1
@@ -183,29 +178,18 @@ def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, ind
             raise RuntimeError("%s relations failed to index" % failcount)
 
 """
-Generates elasticsearch action objects from the results iterator
-
-Output suitable for use with elasticsearch.helpers 
+Generates the bytes of the bulk request lines of a relation, in the process
+calculating it so the writer only has to send them
 """
-def elasticsearch_actions(results, dry_run, index):
-    for r in results:
-        if r:
-            subj = copy(r.subject)
-            obj = copy(r.object)
-            if subj['id'] != obj['id']:
-                r.subject = obj
-                r.object = subj
-                r.set_id()
+def relation_bulk_entry(r, index):
+    subj = copy(r.subject)
+    obj = copy(r.object)
+    if subj['id'] != obj['id']:
+        r.subject = obj
+        r.object = subj
+        r.set_id()
 
-            if not dry_run:
-                action = {}
-                action["_index"] = index
-                action["_id"] = r.id
-                #elasticsearch client uses https://github.com/elastic/elasticsearch-py/blob/master/elasticsearch/serializer.py#L24
-                #to turn objects into JSON bodies. This in turn calls json.dumps() using simplejson if present.
-                action["_source"] = r.to_json()
-
-                yield action
+    return bulk_entry(index, r.id, r.to_json())
 
 
 
@@ -216,7 +200,7 @@ def digest_in_buckets(v, buckets_number):
     return tuple(digested)
 
 
-def get_disease_to_targets_vectors(threshold, evidence_count, es, index):
+def get_disease_to_targets_vectors(threshold, evidence_count, reader, index, scan_workers=1):
     '''
     Get all the association objects that are:
     - direct -> to avoid ontology inflation
@@ -226,7 +210,7 @@ def get_disease_to_targets_vectors(threshold, evidence_count, es, index):
     :param evidence_count: minimum number of evidence consider for fetching association data
     :return: two dictionaries mapping target to disease  and the reverse
     '''
-    res = elasticsearch.helpers.scan(client=es,
+    res = reader.scan(index,
             query={
                 "query": {
                     "term": {
@@ -236,9 +220,8 @@ def get_disease_to_targets_vectors(threshold, evidence_count, es, index):
                 '_source': {
                     'includes':
                         ["target.id", 'disease.id', 'harmonic-sum', 'evidence_count']},
-                'size': 1000,
             },
-            index=index
+            workers=scan_workers
         )
 
     target_results = dict()
@@ -265,8 +248,8 @@ def get_disease_to_targets_vectors(threshold, evidence_count, es, index):
 
     return target_results, disease_results
 
-def get_target_labels(ids, es, index):
-    res = elasticsearch.helpers.scan(client=es,
+def get_target_labels(ids, reader, index):
+    res = reader.scan(index,
             query={"query": {
                 "ids": {
                     "values": ids,
@@ -274,16 +257,14 @@ def get_target_labels(ids, es, index):
             },
                 '_source': 'approved_symbol',
                 'size': 1,
-            },
-            index=index
-        )
+            })
 
 
 
     return dict((hit['_id'],hit['_source']['approved_symbol']) for hit in res)
 
-def get_disease_labels(ids, es, index):
-    res = elasticsearch.helpers.scan(client=es,
+def get_disease_labels(ids, reader, index):
+    res = reader.scan(index,
             query={
                 "query": {
                     "ids": {
@@ -292,9 +273,7 @@ def get_disease_labels(ids, es, index):
                 },
                 '_source': 'label',
                 'size': 1,
-            },
-            index=index
-        )
+            })
 
     return dict((hit['_id'],hit['_source']['label']) for hit in res)
 
@@ -307,8 +286,9 @@ def get_disease_labels(ids, es, index):
 """
 Dummy function to bake arguments into 
 """
-def calculate_pairs_local_init(type, row_labels, rows_ids, column_ids, threshold, idf, idf_):
-    return (type, row_labels, rows_ids, column_ids, threshold, idf, idf_)
+def calculate_pairs_local_init(type, row_labels, rows_ids, column_ids, threshold, idf, idf_,
+        index=None):
+    return (type, row_labels, rows_ids, column_ids, threshold, idf, idf_, index)
 
 """
 Dummy function to bake arguments into 
@@ -324,7 +304,8 @@ used to standardize d2d and t2t code path
 def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids, 
         threshold, buckets_number, es, dry_run, 
         workers_production, workers_score, workers_write,
-        queue_production_score, queue_score_result, queue_write, index):
+        queue_production_score, queue_score_result, queue_write, index, es_folder=None,
+        es_bulk_bytes=None):
 
     #do some initial setup
     vectorizer = DictVectorizer(sparse=True)
@@ -355,7 +336,7 @@ def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids,
         vector_hashes, buckets, threshold, sums_vector, data_vector)
 
     calculate_pairs_local_init_baked = functools.partial(calculate_pairs_local_init, 
-        type, subject_labels, subject_ids, other_ids, threshold, idf, idf_)
+        type, subject_labels, subject_ids, other_ids, threshold, idf, idf_, index)
 
     #create stage for producing disease-to-disease
     pipeline_stage = pr.flat_map(produce_pairs, list(range(len(subject_ids))), 
@@ -372,7 +353,7 @@ def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids,
     #store in elasticsearch
     #this could be multi process, but just use a single for now
     store_in_elasticsearch(pipeline_stage, es, dry_run, workers_write, queue_write,
-        index)
+        index, es_folder, es_bulk_bytes)
 
 """
 Function to run in child processess
@@ -389,7 +370,8 @@ def produce_pairs(i, vector_hashes, buckets, threshold, sums_vector, data_vector
             compared.add(j)
     return result
 
-def calculate_pair(data, type, row_labels, rows_ids, column_ids, threshold, idf, idf_):
+def calculate_pair(data, type, row_labels, rows_ids, column_ids, threshold, idf, idf_,
+        index=None):
 
     subject_index, subject_data, object_index, object_data = data
     
@@ -426,7 +408,7 @@ def calculate_pair(data, type, row_labels, rows_ids, column_ids, threshold, idf,
         body['shared_diseases'] = shared_labels
     #create the relation object
     r = Relation(subject, object, dist, type, **body)
-    return r
+    return relation_bulk_entry(r, index)
 
 
 class DataDrivenRelationProcess(object):
@@ -441,8 +423,13 @@ class DataDrivenRelationProcess(object):
             ddr_queue_score_result,
             ddr_queue_write,
             score_threshold,
-            evidence_count):
+            evidence_count,
+            ddr_workers_scan=1, es_folder=None, es_bulk_bytes=None,
+            es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -457,15 +444,19 @@ class DataDrivenRelationProcess(object):
         self.ddr_queue_write = ddr_queue_write
         self.score_threshold = score_threshold
         self.evidence_count = evidence_count
+        self.ddr_workers_scan = ddr_workers_scan
 
         self.logger = logging.getLogger(__name__)
 
     def process_all(self, dry_run):
 
         es = new_es_client(self.es_hosts)
+        #the inputs written to the folder are read from it
+        reader = new_index_reader(es, self.es_folder)
 
         target_data, disease_data = get_disease_to_targets_vectors(
-                self.score_threshold, self.evidence_count, es, self.es_index_assoc)
+                self.score_threshold, self.evidence_count, reader, self.es_index_assoc,
+                self.ddr_workers_scan)
 
         if len(target_data) == 0 or len(disease_data) == 0:
             raise Exception('Could not find a set of targets AND diseases that had the sufficient number'
@@ -476,10 +467,10 @@ class DataDrivenRelationProcess(object):
         target_keys = sorted(target_data.keys())
 
         self.logger.info('getting disese labels')
-        disease_id_to_label = get_disease_labels(disease_keys, es, self.es_index_efo)
+        disease_id_to_label = get_disease_labels(disease_keys, reader, self.es_index_efo)
         disease_labels = [disease_id_to_label[hit_id] for hit_id in disease_keys]
         self.logger.info('getting target labels')
-        target_id_to_label = get_target_labels(target_keys, es, self.es_index_gen)
+        target_id_to_label = get_target_labels(target_keys, reader, self.es_index_gen)
         target_labels = [target_id_to_label[hit_id] for hit_id in target_keys]
 
 
@@ -489,7 +480,8 @@ class DataDrivenRelationProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
 
             #calculate and store disease-to-disease in multiple processess
             self.logger.info('handling disease-to-disease')
@@ -497,7 +489,7 @@ class DataDrivenRelationProcess(object):
                 target_keys, 0.19, 1024, es, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
-                self.es_index)
+                manager.index_name, self.es_folder, self.es_bulk_bytes)
             self.logger.info('handled disease-to-disease')
 
             #calculate and store target-to-target in multiple processess
@@ -506,6 +498,6 @@ class DataDrivenRelationProcess(object):
                 disease_keys, 0.19, 1024, es, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
-                self.es_index)
+                manager.index_name, self.es_folder, self.es_bulk_bytes)
             self.logger.info('handled target-to-target')
 
@@ -6,11 +6,10 @@ import logging
 
 import simplejson as json
 import elasticsearch
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll
 
 from opentargets_urlzsource import URLZSource
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import parallel_scan
+from mrtarget.common.esfile import index_manager, bulk
 from mrtarget.common.connection import new_es_client
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
 
@@ -76,8 +75,13 @@ class DrugProcess(object):
                  chembl_molecule_uris,
                  chembl_indication_uris,
                  adverse_events_uris,
-                 drugbank_uris):
+                 drugbank_uris,
+                 lookup_cache_dir=None, es_folder=None, es_bulk_bytes=None,
+                 es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -103,6 +107,8 @@ class DrugProcess(object):
 
         self.drugbank_uris = drugbank_uris
 
+        self.lookup_cache_dir = lookup_cache_dir
+
         self.logger = logging.getLogger(__name__)
 
     def process_all(self, dry_run):
@@ -953,7 +959,8 @@ class DrugProcess(object):
                                                gene_cache_contains_size=self.cache_target_contains,
                                                efo_index=self.es_index_efo,
                                                efo_cache_size=self.cache_efo,
-                                               efo_cache_contains_size=self.cache_efo_contains
+                                               efo_cache_contains_size=self.cache_efo_contains,
+                                               cache_dir=self.lookup_cache_dir
                                                ).lookup
 
         # these are all separate files
@@ -1053,6 +1060,7 @@ class DrugProcess(object):
 
             drugs[ident] = drug
 
+        self.logger.info("drug lookup metrics %s", self.lookup_data.metrics())
         return drugs
 
     def store(self, es, dry_run, data):
@@ -1063,21 +1071,15 @@ class DrugProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
             # write into elasticsearch
-            chunk_size = 1000  # TODO make configurable
-            actions = elasticsearch_actions(list(data.items()), self.es_index)
+            actions = elasticsearch_actions(list(data.items()), manager.index_name)
             failcount = 0
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                                                                  thread_count=self.workers_write,
-                                                                  queue_size=self.queue_write,
-                                                                  chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                                                                   chunk_size=chunk_size)
+                results = bulk(es, self.es_folder, actions,
+                        thread_count=self.workers_write, queue_size=self.queue_write, 
+                        chunk_bytes=self.es_bulk_bytes)
                 for success, details in results:
                     if not success:
                         failcount += 1
@@ -1092,13 +1094,14 @@ class DrugProcess(object):
     of string test names and result objects
     """
 
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
         self.logger.info("Starting QC")
 
         # number of drug entries
         drug_count = 0
         # Note: try to avoid doing this more than once!
-        for drug_entry in Search().using(es).index(index).query(MatchAll()).scan():
+        query = {"query": {"match_all": {}}, "_source": False}
+        for drug_entry in parallel_scan(es, index, query, workers=scan_workers):
             drug_count += 1
 
         # put the metrics into a single dict
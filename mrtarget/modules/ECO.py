@@ -8,13 +8,12 @@ from mrtarget.common.LookupTables import ECOLookUpTable
 from mrtarget.common.DataStructure import JSONSerializable
 from opentargets_ontologyutils.rdf_utils import OntologyClassReader
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import parallel_scan
+from mrtarget.common.esfile import index_manager, bulk
 import opentargets_ontologyutils.eco_so
 import logging
 import elasticsearch
 import simplejson as json
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll
 
 
 '''
@@ -64,8 +63,12 @@ def elasticsearch_actions(items, index):
 class EcoProcess(object):
 
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
-            eco_uri, so_uri, workers_write, queue_write):
+            eco_uri, so_uri, workers_write, queue_write, es_folder=None,
+            es_bulk_bytes=None, es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -104,23 +107,17 @@ class EcoProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(list(self.ecos.items()), self.es_index)
+            actions = elasticsearch_actions(list(self.ecos.items()), manager.index_name)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = bulk(es, self.es_folder, actions,
+                        thread_count=self.workers_write, queue_size=self.queue_write, 
+                        chunk_bytes=self.es_bulk_bytes)
                 for success, details in results:
                     if not success:
                         failcount += 1
@@ -132,12 +129,13 @@ class EcoProcess(object):
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
 
         #number of eco entries
         eco_count = 0
         #Note: try to avoid doing this more than once!
-        for eco_entry in Search().using(es).index(index).query(MatchAll()).scan():
+        query = {"query": {"match_all": {}}, "_source": False}
+        for eco_entry in parallel_scan(es, index, query, workers=scan_workers):
             eco_count += 1
 
         #put the metrics into a single dict
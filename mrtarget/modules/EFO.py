@@ -6,10 +6,10 @@ from opentargets_ontologyutils.rdf_utils import OntologyClassReader, DiseaseUtil
 import opentargets_ontologyutils.efo
 from rdflib import URIRef
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import parallel_scan
+from mrtarget.common.esfile import index_manager, bulk
 import elasticsearch
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll
+import numpy as np
 import simplejson as json
 from opentargets_urlzsource import URLZSource
 
@@ -104,14 +104,78 @@ def elasticsearch_actions(items, index):
 
         yield action
 
+class EfoDag(object):
+    """
+    In-memory EFO graph used to propagate associations up the ontology.
+
+    Each term has an integer index, and indexes follow a topological order
+    (every ancestor has a smaller index than its descendants). The ancestors
+    of each term are the union of the codes in its path_codes, itself 
+    included unless it has none, the same codes an evidence stores in private.efo_codes, and
+    are kept as one flat integer array with per-term offsets.
+    """
+
+    def __init__(self, paths):
+        """paths is a dict of term code to the list of its paths from the root"""
+        ancestors = {}
+        depth = {}
+        for code, path_codes in paths.items():
+            ancestors[code] = set(c for path in path_codes for c in path)
+            for path in path_codes:
+                for i, c in enumerate(path):
+                    depth[c] = max(depth.get(c, 0), i)
+            depth.setdefault(code, 0)
+        #terms only seen in the paths of others have no path codes
+        for code in depth:
+            ancestors.setdefault(code, set())
+
+        #sort by longest path from the root, an ancestor is always shallower
+        self.codes = sorted(depth, key=lambda c: (depth[c], c))
+        self.index = dict((code, i) for i, code in enumerate(self.codes))
+
+        self.offsets = np.zeros(len(self.codes) + 1, dtype=np.int64)
+        flat = []
+        for i, code in enumerate(self.codes):
+            flat.extend(sorted(self.index[c] for c in ancestors[code]))
+            self.offsets[i + 1] = len(flat)
+        self.ancestor_indexes = np.array(flat, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def ancestors(self, i):
+        """integer indexes of the ancestors of the term with index i, itself 
+        included when in its path codes"""
+        return self.ancestor_indexes[self.offsets[i]:self.offsets[i + 1]]
+
+    @staticmethod
+    def build(reader, index, scan_workers=1):
+        """read the path codes of every term in the EFO index with an IndexReader"""
+        query = {"query": {"match_all": {}}, "_source": ["path_codes"]}
+        paths = {}
+        for hit in reader.scan(index, query, workers=scan_workers):
+            paths[hit["_id"]] = hit["_source"].get("path_codes", [])
+        dag = EfoDag(paths)
+        logging.getLogger(__name__).info("loaded %d EFO terms with %d ancestor links",
+            len(dag), len(dag.ancestor_indexes))
+        return dag
+
+
 class EfoProcess(object):
 
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
                  efo_uri, hpo_uri, mp_uri,
                  disease_phenotype_uris,
-                 workers_write, queue_write
+                 workers_write, queue_write, es_folder=None, es_bulk_bytes=None,
+                 es_load=None
                  ):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -230,23 +294,17 @@ class EfoProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(list(self.efos.items()), self.es_index)
+            actions = elasticsearch_actions(list(self.efos.items()), manager.index_name)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = bulk(es, self.es_folder, actions,
+                        thread_count=self.workers_write, queue_size=self.queue_write, 
+                        chunk_bytes=self.es_bulk_bytes)
                 for success, details in results:
                     if not success:
                         failcount += 1
@@ -259,7 +317,7 @@ class EfoProcess(object):
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
         self.logger.info("Starting QC")
         #number of EFO terms
         efo_term_count = 0
@@ -272,7 +330,9 @@ class EfoProcess(object):
 
         #loop over all efo terms and calculate the metrics
         #Note: try to avoid doing this more than once!
-        for efo_term in Search().using(es).index(index).query(MatchAll()).scan():
+        query = {"query": {"match_all": {}}, "_source": ["label", "definition", "path_labels"]}
+        for hit in parallel_scan(es, index, query, workers=scan_workers):
+            efo_term = hit["_source"]
             efo_term_count += 1
 
             #path_labels is a list of lists of all paths to the root
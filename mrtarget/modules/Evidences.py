@@ -6,20 +6,30 @@ import simplejson as json
 import pypeln.process as pr
 import addict
 import codecs
+import collections
 import functools
 import itertools
 
 import elasticsearch
+import more_itertools
 
-import opentargets_validator.helpers
 import mrtarget.common.IO as IO
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.DataStructure import get_json_backend
+from mrtarget.common.esutil import bulk_index_line, send_bulk_payloads, \
+    ElasticsearchPartitionedIndexManager, partition_index_name
+from mrtarget.common.esfile import index_manager, bulk, bulk_payloads
+from mrtarget.common.EvidenceColumns import EvidenceColumnsWriter, scoring_fields
+from mrtarget.common.EvidenceManifest import EvidenceManifest
 from mrtarget.common.EvidenceString import EvidenceManager, Evidence
-from mrtarget.common.LookupHelpers import LookUpDataRetriever
+from mrtarget.common.LookupHelpers import LookUpDataRetriever, lookup_snapshots
+from mrtarget.common.SchemaValidation import DatasourceValidators, compiled_schema_validators
 from opentargets_urlzsource import URLZSource
 
+#used when no backend is given, e.g. outside of the pipeline
+DEFAULT_JSON_BACKEND = get_json_backend()
+
 def make_validated_evs_obj(filename, hash, line, line_n, is_valid=False, explanation_type='', explanation_str='',
                            target_id=None, efo_id=None, data_type=None, id=None):
     return addict.Dict(is_valid=is_valid, explanation_type=explanation_type, explanation_str=explanation_str,
@@ -27,12 +37,21 @@ def make_validated_evs_obj(filename, hash, line, line_n, is_valid=False, explana
                        filename=filename, hash=hash)
 
 
-def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_manager):
-    """take line as a dict, convert into an evidence object and apply a list of modifiers:
-    fix_evidence, and if valid then score_evidence, extend data and inject loci
+def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_manager,
+        json_backend=None, scoring_columns=False):
+    """take the evidence dict kept by validate_evidence, convert into an evidence 
+    object and apply a list of modifiers: fix_evidence, and if valid then 
+    score_evidence, extend data and inject loci
+
+    the evidence is serialised only once, into the line of the right, and 
+    when scoring_columns is set its scoring fields kept for an 
+    EvidenceColumnsWriter
     """
+    if json_backend is None:
+        json_backend = DEFAULT_JSON_BACKEND
+
     left, right = None, None
-    ev = Evidence(validated_evs.line, datasources_to_datatypes)
+    ev = Evidence(validated_evs.pop('evidence'), datasources_to_datatypes)
 
     (fixed_ev, _) = evidence_manager.fix_evidence(ev)
 
@@ -46,32 +65,178 @@ def fix_and_score_evidence(validated_evs, datasources_to_datatypes, evidence_man
         fixed_ev_ext = evidence_manager.get_extended_evidence(fixed_ev)
 
         validated_evs.is_valid = True
-        validated_evs.line = fixed_ev_ext.to_json()
+        validated_evs.line = json_backend.dumps(fixed_ev_ext.evidence, sort_keys=True)
+        if scoring_columns:
+            validated_evs.scoring = scoring_fields(fixed_ev_ext.evidence)
         right = validated_evs
 
     else:
         validated_evs.explanation_type = 'invalid_fixed_evidence'
         validated_evs.explanation_str = problem_str
         validated_evs.is_valid = False
+        #line is still the original line, decode it again as this is rare
+        validated_evs['id'] = line_hash(json_backend.loads(validated_evs.line))
         left = validated_evs
 
     # return either left or right
     return left, right
 
 
-def process_evidence(line, logger, validator, luts, datasources_to_datatypes, evidence_manager):
+def process_evidence(line, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        json_backend, scoring_columns=False):
     # validate evidence
-    (left, right) = validate_evidence(line, logger, validator, luts, datasources_to_datatypes)
+    (left, right) = validate_evidence(line, logger, validator, luts, datasources_to_datatypes,
+        json_backend=json_backend)
 
     # fix evidence 
     if right is not None:
-        # ev comes as addict.Dict
-        # too much code at the moment to move evidences to addict
-        (left, right) = fix_and_score_evidence(right, datasources_to_datatypes, evidence_manager)
+        (left, right) = fix_and_score_evidence(right, datasources_to_datatypes, evidence_manager,
+            json_backend, scoring_columns)
 
     return left, right
 
 
+def process_evidence_batch(lines, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        json_backend, scoring_columns=False):
+    """process a window of lines, fetching the lookups they need with one
+    request per lookup table instead of one request per evidence"""
+    parsed_lines = []
+    for line in lines:
+        try:
+            (filename, (line_n, l)) = line
+            parsed_lines.append(json_backend.loads(codecs.decode(l, 'utf-8', 'replace')))
+        except Exception:
+            #left for validate_evidence to report
+            parsed_lines.append(None)
+
+    evidence_manager.prefetch(parsed_lines)
+    try:
+        results = []
+        for line, parsed_line in zip(lines, parsed_lines):
+            (left, right) = validate_evidence(line, logger, validator, luts, 
+                datasources_to_datatypes, parsed_line, json_backend)
+            if right is not None:
+                (left, right) = fix_and_score_evidence(right, datasources_to_datatypes, 
+                    evidence_manager, json_backend, scoring_columns)
+            results.append((left, right))
+        return results
+    finally:
+        evidence_manager.clear_prefetch()
+
+
+def process_evidence_chunk(lines, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        json_backend, index_valid=None, index_invalid=None, partition_run=None,
+        scoring_columns=False):
+    """process a chunk of lines like process_evidence_batch, returning the 
+    elasticsearch bulk request body of the results so the parent process 
+    does not have to unpickle and serialise each of them, with the documents
+    written as by bulk_payload"""
+    results = process_evidence_batch(lines, logger, validator, luts, 
+        datasources_to_datatypes, evidence_manager, json_backend, scoring_columns)
+    return bulk_payload(results, index_valid, index_invalid, json_backend, partition_run,
+        scoring_columns)
+
+
+def process_evidence_split(split, logger, validator, luts, datasources_to_datatypes, evidence_manager,
+        json_backend, batch_size=1, index_valid=None, index_invalid=None, partition_run=None,
+        scoring_columns=False):
+    """read a split of an input file in this worker and process its lines, 
+    yielding the (left, right) of each line or, when batching, what
+    process_evidence_chunk returns for each chunk of batch_size lines"""
+    lines = IO.iter_split_lines(split)
+    if batch_size > 1:
+        for chunk in more_itertools.chunked(lines, batch_size):
+            yield process_evidence_chunk(chunk, logger, validator, luts, 
+                datasources_to_datatypes, evidence_manager, json_backend, 
+                index_valid, index_invalid, partition_run, scoring_columns)
+    else:
+        for line in lines:
+            yield process_evidence(line, logger, validator, luts, 
+                datasources_to_datatypes, evidence_manager, json_backend, scoring_columns)
+
+
+def valid_index_name(index_valid, right, partition_run=None):
+    """the index of a valid evidence, the partition of its datasource when
+    writing the partitions of the run partition_run"""
+    if partition_run is None:
+        return index_valid
+    return partition_index_name(index_valid, right['data_source'], partition_run)
+
+
+def bulk_payload(results, index_valid, index_invalid, json_backend, partition_run=None,
+        scoring_columns=False):
+    """the bulk request body, as bytes, of the (left, right) results, the
+    (filename, line_n, index, id) of each document in it, the lefts left
+    out of it for an InvalidEvidenceSink when index_invalid is None, and the
+    scoring fields of the rights for an EvidenceColumnsWriter when
+    scoring_columns is set"""
+    lines = []
+    written = []
+    rejected = []
+    scored = []
+    for left, right in results:
+        if right is not None:
+            index = valid_index_name(index_valid, right, partition_run)
+            lines.append(bulk_index_line(index, right['hash']))
+            lines.append(right['line'])
+            written.append((right['filename'], right['line_n'], index, right['hash']))
+            if scoring_columns:
+                scored.append(right['scoring'])
+        elif left is not None:
+            written.append((left['filename'], left['line_n'], index_invalid, left['id']))
+            if index_invalid is None:
+                rejected.append(left)
+                continue
+            lines.append(bulk_index_line(index_invalid, left['id']))
+            lines.append(json_backend.dumps(left))
+    if not lines:
+        return b"", written, rejected, scored
+    lines.append("")
+    return "\n".join(lines).encode("utf-8"), written, rejected, scored
+
+
+def record_payloads(results, manifest=None, partitions=None, invalid_sink=None,
+        columns=None):
+    """yield the bulk request bodies of the (payload, written, rejected, scored)
+    results, storing the written documents in the manifest, their indices in
+    the partitions manager, the rejected evidence in the sink and the scoring
+    fields in the columns writer when there are any"""
+    for payload, written, rejected, scored in results:
+        for left in rejected:
+            invalid_sink.write(left)
+        for row in scored:
+            columns.add(row)
+        for filename, line_n, index, doc_id in written:
+            if manifest is not None:
+                manifest.record(filename, line_n, index, doc_id)
+            if partitions is not None:
+                partitions.add(index)
+        yield payload
+
+
+def record_results(results, index_valid, index_invalid, manifest):
+    """pass the (left, right) results through, storing their documents in the
+    manifest"""
+    for left, right in results:
+        if right is not None:
+            manifest.record(right['filename'], right['line_n'], index_valid, right['hash'])
+        elif left is not None:
+            manifest.record(left['filename'], left['line_n'], index_invalid, left['id'])
+        yield left, right
+
+
+def delete_removed_documents(es, documents, chunk_size=1000):
+    """delete the (index, id) documents of the lines no longer in the input,
+    returning the number of failed deletes"""
+    failcount = 0
+    for chunk in more_itertools.chunked(documents, chunk_size):
+        payload = "".join("%s\n" % json.dumps({"delete": {"_index": index, "_id": doc_id}})
+            for index, doc_id in chunk).encode("utf-8")
+        for item in send_bulk_payloads(es, [payload]):
+            failcount += 1
+    return failcount
+
+
 """
 This function is called once in each child process to do local setup for 
 validation
@@ -79,10 +244,12 @@ validation
 def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes, 
         datasources_to_datatypes, es_hosts, es_index_gene, es_index_eco, es_index_efo,
         cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains):
+        cache_eco, cache_efo, cache_efo_contains, preload_lookups, 
+        lookup_snapshot_files, json_backend, schema_cache_dir):
     logger = logging.getLogger(__name__)
 
-    validator = opentargets_validator.helpers.generate_validator_from_schema(schema_uri)
+    #already compiled by the parent, only loaded here
+    validator = DatasourceValidators(schema_uri, schema_cache_dir)
 
     lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
         gene_index=es_index_gene,
@@ -90,10 +257,12 @@ def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes,
         gene_cache_u2e_size = cache_target_u2e,
         gene_cache_contains_size = cache_target_contains,
         eco_index=es_index_eco,
-        eco_cache_size = cache_efo_contains,
+        eco_cache_size = cache_eco,
         efo_index=es_index_efo,
         efo_cache_size = cache_efo,
-        efo_cache_contains_size = cache_efo_contains
+        efo_cache_contains_size = cache_efo_contains,
+        preload = preload_lookups,
+        snapshot_files = lookup_snapshot_files
         ).lookup
 
 
@@ -101,203 +270,293 @@ def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes,
     evidence_manager = EvidenceManager(lookup_data, eco_scores_uri, 
         excluded_biotypes, datasources_to_datatypes)
 
-    return logger, validator, lookup_data, datasources_to_datatypes, evidence_manager
+    return (logger, validator, lookup_data, datasources_to_datatypes, evidence_manager, 
+        get_json_backend(json_backend))
+
+"""
+This function is called once in each child process when it has finished
+"""
+def validation_on_done(status, logger, validator, lookup_data, datasources_to_datatypes, evidence_manager,
+        json_backend):
+    logger.info("validation lookup metrics %s", json.dumps(lookup_data.metrics()))
+
+def line_hash(parsed_line):
+    """id of an invalid evidence, the md5 of its canonical json
+
+    always simplejson so the ids do not depend on the json backend"""
+    return hashlib.md5(json.dumps(parsed_line, sort_keys=True).encode("utf-8")).hexdigest()
+
 
-def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
+def validate_evidence(line, logger, validator, luts, datasources_to_datatypes, parsed_line=None,
+        json_backend=None):
     """this function is called once per line until number of lines is exhausted. 
 
     It returns a tuple with (left, right) where left is the faulty line and the
     right is the fully validated and processed. There is a specific case where you
     get (None, None) which means we are not quetting the right expected input
+
+    parsed_line can be given when the line has already been decoded as json.
+    The right keeps the validated evidence as a dict in its evidence key, for
+    fix_and_score_evidence to use without decoding it again
     """
     if not line or line is None or len(line) != 2:
         logger.error('line != triple and this is weird as if any line you must have a triple')
         return None, None
 
+    if json_backend is None:
+        json_backend = DEFAULT_JSON_BACKEND
+
     (filename, (line_n, l)) = line
     decoded_line = codecs.decode(l, 'utf-8', 'replace')
     validated_evs = make_validated_evs_obj(filename=filename, hash='', line=decoded_line, line_n=line_n)
 
     try:
-        data_type = None
-        data_source = None
-        parsed_line = None
+        if parsed_line is None:
+            parsed_line = json_backend.loads(decoded_line)
+    except Exception as e:
+        validated_evs.explanation_type = 'unparseable_json'
+        validated_evs['id'] = str(hashlib.md5(decoded_line.encode("utf-8")).hexdigest())
+        return validated_evs, None
 
-        try:
-            parsed_line = json.loads(decoded_line)
-            hash_line = hashlib.md5(json.dumps(parsed_line, sort_keys=True).encode("utf-8")).hexdigest()
-            validated_evs['id'] = str(hash_line)
-        except Exception as e:
-            validated_evs.explanation_type = 'unparseable_json'
-            validated_evs['id'] = str(hashlib.md5(decoded_line).hexdigest())
-            return validated_evs, None
-
-        if 'label' in parsed_line or 'type' in parsed_line:
-            # setting type from label in case we have label??
-            if 'label' in parsed_line:
-                parsed_line['type'] = parsed_line.pop('label', None)
-
-            data_type = parsed_line['type']
-            validated_evs.data_type = data_type
+    try:
+        evidence = check_evidence(parsed_line, validated_evs, logger, validator, luts, 
+            datasources_to_datatypes)
+    except Exception as e:
+        validated_evs.explanation_type = 'exception'
+        validated_evs.explanation_str = str(e)
+        evidence = None
 
+    if evidence is None:
+        #the hash of the whole line is only needed to store the invalid ones
+        validated_evs['id'] = line_hash(parsed_line)
+        return validated_evs, None
+
+    validated_evs.evidence = evidence
+    validated_evs.is_valid = True
+    return None, validated_evs
+
+
+def check_evidence(parsed_line, validated_evs, logger, validator, luts, datasources_to_datatypes):
+    """check a decoded evidence against the schema and the lookup tables
+
+    returns the evidence as a new dict ready to be fixed and scored, leaving 
+    parsed_line unchanged, or None with the explanation set in validated_evs"""
+
+    #shallow copy, the nested values changed below are copied too
+    evidence = dict(parsed_line)
+
+    data_type = None
+    data_source = None
+
+    if 'label' in evidence or 'type' in evidence:
+        # setting type from label in case we have label??
+        if 'label' in evidence:
+            evidence['type'] = evidence.pop('label', None)
+
+        data_type = evidence['type']
+        validated_evs.data_type = data_type
+
+    else:
+        validated_evs.explanation_type = 'key_fields_missing'
+        return None
+
+    if data_type is None:
+        validated_evs.explanation_type = 'missing_datatype'
+        return None
+
+    if 'sourceID' not in evidence:
+        validated_evs.explanation_type = 'missing_datasource'
+        return None
+
+    data_source = evidence['sourceID']
+    validated_evs.data_source = data_source
+
+    if data_source not in datasources_to_datatypes:
+        validated_evs.explanation_type = 'unsupported_datasource'
+        validated_evs.explanation_str = data_source
+        return None
+
+    # validate line
+    validation_errors = \
+        [str(e) for e in validator.iter_errors(evidence)]
+
+    if validation_errors:
+        # here I have to log all fails to logger and elastic
+        error_messages = ' '.join(validation_errors).replace('\n', ' ; ').replace('\r', '')
+
+        validated_evs.explanation_type = 'validation_error'
+        validated_evs.explanation_str = error_messages
+
+        return None
+
+    target_id = None
+    efo_id = None
+    evidence['unique_association_fields'] = dict(evidence.get('unique_association_fields') or {})
+    evidence['unique_association_fields']['datasource'] = data_source
+
+    if (evidence.get('target') or {}).get('id'):
+        target_id = evidence['target']['id']
+        validated_evs.target_id = target_id
+    if (evidence.get('disease') or {}).get('id'):
+        efo_id = evidence['disease']['id']
+        validated_evs.efo_id = efo_id
+
+    # flatten but is it always valid unique_association_fields?
+    validated_evs.hash = hashlib.md5(json.dumps(evidence['unique_association_fields'], 
+        sort_keys=True).encode("utf-8")).hexdigest()
+    evidence['id'] = str(validated_evs.hash)
+
+    disease_failed = False
+    target_failed = False
+
+    if efo_id:
+        # Check disease term or phenotype term
+        # elasticsearch is based on short ontology id, not full iri
+        if '/' in efo_id:
+            short_efo_id = luts.available_efos.get_ontology_code_from_url(efo_id)
         else:
-            validated_evs.explanation_type = 'key_fields_missing'
-            return validated_evs, None
-
-        if data_type is None:
-            validated_evs.explanation_type = 'missing_datatype'
-            return validated_evs, None
-
-        if 'sourceID' not in parsed_line:
-            validated_evs.explanation_type = 'missing_datasource'
-            return validated_evs, None
-
-        data_source = parsed_line['sourceID']
-        validated_evs.data_source = data_source
-
-        if data_source not in datasources_to_datatypes:
-            validated_evs.explanation_type = 'unsupported_datasource'
-            validated_evs.explanation_str = data_source
-            return validated_evs, None
-
-        # validate line
-        validation_errors = \
-            [str(e) for e in validator.iter_errors(parsed_line)]
-
-        if validation_errors:
-            # here I have to log all fails to logger and elastic
-            error_messages = ' '.join(validation_errors).replace('\n', ' ; ').replace('\r', '')
-
-            validated_evs.explanation_type = 'validation_error'
-            validated_evs.explanation_str = error_messages
-
-            return validated_evs, None
-
-        target_id = None
-        efo_id = None
-        # generate fantabulous dict from addict
-        evidence_obj = addict.Dict(parsed_line)
-        evidence_obj.unique_association_fields['datasource'] = data_source
-
-        if evidence_obj.target.id:
-            target_id = evidence_obj.target.id
-            validated_evs.target_id = evidence_obj.target.id
-        if evidence_obj.disease.id:
-            efo_id = evidence_obj.disease.id
-            validated_evs.efo_id = evidence_obj.disease.id
-
-        # flatten but is it always valid unique_association_fields?
-        validated_evs.hash = hashlib.md5(json.dumps(evidence_obj.unique_association_fields, 
-            sort_keys=True).encode("utf-8")).hexdigest()
-        evidence_obj['id'] = str(validated_evs.hash)
-
-        disease_failed = False
-        target_failed = False
-
-        if efo_id:
-            # Check disease term or phenotype term
-            # elasticsearch is based on short ontology id, not full iri
-            if '/' in efo_id:
-                short_efo_id = luts.available_efos.get_ontology_code_from_url(efo_id)
-            else:
-                #handle being given a short id to start with
-                short_efo_id = efo_id
-
-            #if its not in the efo lookup table, fail
-            if short_efo_id not in luts.available_efos:
-                validated_evs.explanation_type = 'invalid_disease'
-                validated_evs.explanation_str = efo_id
-                disease_failed = True
-        else:
-            #disease is missing entirely
-            #should never happen because it will fail validation, but...
-            validated_evs.explanation_type = 'missing_disease'
+            #handle being given a short id to start with
+            short_efo_id = efo_id
+
+        #if its not in the efo lookup table, fail
+        if short_efo_id not in luts.available_efos:
+            validated_evs.explanation_type = 'invalid_disease'
+            validated_evs.explanation_str = efo_id
             disease_failed = True
+    else:
+        #disease is missing entirely
+        #should never happen because it will fail validation, but...
+        validated_evs.explanation_type = 'missing_disease'
+        disease_failed = True
+
+    # CHECK GENE/PROTEIN IDENTIFIER Check Ensembl ID, UniProt ID
+    # and UniProt ID mapping to a Gene ID
+    # http://identifiers.org/ensembl/ENSG00000178573
+    if target_id:
+        if 'ensembl' in target_id:
+            ensembl_id = target_id.split('/')[-1]
+            if not ensembl_id in luts.available_genes:
+                validated_evs.explanation_type = 'invalid_target'
+                validated_evs.explanation_str = ensembl_id
+                target_failed = True
+
+            elif ensembl_id in luts.non_reference_genes:
+                logger.warning('nonref ensembl gene found %s line_n %d filename %s',
+                                               ensembl_id, validated_evs.line_n, validated_evs.filename)
+
+        elif 'uniprot' in target_id:
+            uniprot_id = target_id.split('/')[-1]
+            ensembl_id = luts.available_genes.get_uniprot2ensembl(uniprot_id)
+
+            if ensembl_id is None:
+                validated_evs.explanation_type = 'unknown_uniprot_entry'
+                validated_evs.explanation_str = uniprot_id
+                target_failed = True
+
+            elif (ensembl_id is not None) and \
+                    ensembl_id in luts.available_genes and \
+                    'is_reference' in luts.available_genes.get_gene(ensembl_id) and \
+                    (not luts.available_genes.get_gene(ensembl_id)['is_reference'] is True):
+                validated_evs.explanation_type = 'nonref_ensembl_xref_for_uniprot_entry'
+                validated_evs.explanation_str = uniprot_id
+                target_failed = True
+            else:
+                try:
+                    reference_target_list = luts.available_genes.get_gene(ensembl_id)['is_reference'] is True
+                except KeyError:
+                    reference_target_list = []
 
-        # CHECK GENE/PROTEIN IDENTIFIER Check Ensembl ID, UniProt ID
-        # and UniProt ID mapping to a Gene ID
-        # http://identifiers.org/ensembl/ENSG00000178573
-        if target_id:
-            if 'ensembl' in target_id:
-                ensembl_id = target_id.split('/')[-1]
-                if not ensembl_id in luts.available_genes:
-                    validated_evs.explanation_type = 'invalid_target'
-                    validated_evs.explanation_str = ensembl_id
+                if reference_target_list:
+                    target_id = 'http://identifiers.org/ensembl/%s' % reference_target_list[0]
+                else:
+                    target_id = ensembl_id
+                if target_id is None:
+                    validated_evs.explanation_type = 'missing_target_id_for_protein'
+                    validated_evs.explanation_str = uniprot_id
                     target_failed = True
 
-                elif ensembl_id in luts.non_reference_genes:
-                    logger.warning('nonref ensembl gene found %s line_n %d filename %s',
-                                                   ensembl_id, line_n, filename)
+    # If there is no target id after the processing step
+    if target_id is None:
+        validated_evs.explanation_type = 'missing_target_id'
+        target_failed = True
 
-            elif 'uniprot' in target_id:
-                uniprot_id = target_id.split('/')[-1]
-                ensembl_id = luts.available_genes.get_uniprot2ensembl(uniprot_id)
+    if target_failed or disease_failed:
 
-                if ensembl_id is None:
-                    validated_evs.explanation_type = 'unknown_uniprot_entry'
-                    validated_evs.explanation_str = uniprot_id
-                    target_failed = True
+        if target_failed and disease_failed:
+            validated_evs.explanation_type = 'target_id_and_disease_id'
+            validated_evs.explanation_str = ''
 
-                elif (ensembl_id is not None) and \
-                        ensembl_id in luts.available_genes and \
-                        'is_reference' in luts.available_genes.get_gene(ensembl_id) and \
-                        (not luts.available_genes.get_gene(ensembl_id)['is_reference'] is True):
-                    validated_evs.explanation_type = 'nonref_ensembl_xref_for_uniprot_entry'
-                    validated_evs.explanation_str = uniprot_id
-                    target_failed = True
-                else:
-                    try:
-                        reference_target_list = luts.available_genes.get_gene(ensembl_id)['is_reference'] is True
-                    except KeyError:
-                        reference_target_list = []
-
-                    if reference_target_list:
-                        target_id = 'http://identifiers.org/ensembl/%s' % reference_target_list[0]
-                    else:
-                        target_id = ensembl_id
-                    if target_id is None:
-                        validated_evs.explanation_type = 'missing_target_id_for_protein'
-                        validated_evs.explanation_str = uniprot_id
-                        target_failed = True
-
-        # If there is no target id after the processing step
-        if target_id is None:
-            validated_evs.explanation_type = 'missing_target_id'
-            target_failed = True
-
-        if target_failed or disease_failed:
-
-            if target_failed and disease_failed:
-                validated_evs.explanation_type = 'target_id_and_disease_id'
-                validated_evs.explanation_str = ''
-
-            return validated_evs, None
-
-        validated_evs.line = json.dumps(evidence_obj.to_dict())
-        validated_evs.is_valid = True
-        return None, validated_evs
+        return None
+
+    return evidence
+
+
+class InvalidEvidenceSink(object):
+    """
+    Writes the invalid evidence to rotated compressed json lines files in a
+    directory instead of an elasticsearch index, and on close a tab separated 
+    summary of their counts by explanation_type and datasource.
+
+    It is a context manager so it can take the place of the 
+    ElasticsearchBulkIndexManager of the invalid evidence index.
+    """
+
+    SUMMARY_FILENAME = "invalid-evidence-summary.tsv"
+
+    def __init__(self, directory, json_backend, lines_per_file=1000000, compression='gzip'):
+        self.logger = logging.getLogger(__name__)
+        self.directory = directory
+        self.json_backend = json_backend
+        self.writer = IO.RotatingLineWriter(directory, "invalid-evidence", 
+            lines_per_file, compression)
+        self.counts = collections.Counter()
+
+    def write(self, left):
+        self.writer.write(self.json_backend.dumps(left))
+        self.counts[(left.get('explanation_type') or '', left.get('data_source') or '')] += 1
+
+    def close(self):
+        self.writer.close()
+        with open(os.path.join(self.directory, self.SUMMARY_FILENAME), "w") as f:
+            f.write("explanation_type\tdatasource\tcount\n")
+            for (explanation_type, datasource), count in sorted(self.counts.items()):
+                f.write("%s\t%s\t%d\n" % (explanation_type, datasource, count))
+        self.logger.info("wrote %d invalid evidence to %d files in %s", 
+            sum(self.counts.values()), len(self.writer.filenames), self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return None
 
-    except Exception as e:
-        validated_evs.explanation_type = 'exception'
-        validated_evs.explanation_str = str(e)
-        return validated_evs, None
 
 """
 Generates elasticsearch action objects from the results iterator
 
 Output suitable for use with elasticsearch.helpers 
 """
-def elasticsearch_actions(lines, index_valid, index_invalid):
+def elasticsearch_actions(lines, index_valid, index_invalid, partitions=None, invalid_sink=None,
+        columns=None):
     for line in lines:
         (left, right) = line
         if right is not None:
             #valid
+            if columns is not None:
+                columns.add(right['scoring'])
             action = {}
-            action["_index"] = index_valid
+            if partitions is not None:
+                action["_index"] = partitions.partition(right['data_source'])
+                partitions.add(action["_index"])
+            else:
+                action["_index"] = index_valid
             action["_id"] = right['hash']
             action["_source"] = right['line']
             #print("  valid %s" % action["_id"])
             yield action
+        elif left is not None and invalid_sink is not None:
+            invalid_sink.write(left)
         elif left is not None:
             #invalid
             action = {}
@@ -320,7 +579,12 @@ def process_evidences_pipeline(
         cache_target, cache_target_u2e, cache_target_contains,
         cache_eco, cache_efo, cache_efo_contains,
         eco_scores_uri, schema_uri, excluded_biotypes, 
-        datasources_to_datatypes):
+        datasources_to_datatypes, preload_lookups=False, lookup_snapshot=False,
+        batch_size=1, lookup_cache_dir=None, json_backend='simplejson',
+        schema_cache_dir=None, split_size=0, incremental_manifest=None,
+        partition_by_datasource=False, invalid_dir=None, invalid_lines_per_file=1000000,
+        invalid_compression='gzip', es_folder=None, scoring_columns_dir=None,
+        es_bulk_bytes=None, es_load=None):
 
     logger = logging.getLogger(__name__)
 
@@ -343,22 +607,54 @@ def process_evidences_pipeline(
 
     logger.info('start evidence processing pipeline')
 
-    #create a iterable of lines from all file handles
-    evs = IO.make_iter_lines(checked_filenames, first_n)
-
-    #create functions with pre-baked arguments
-    validation_on_start_baked = functools.partial(validation_on_start, 
-        eco_scores_uri, schema_uri, excluded_biotypes, datasources_to_datatypes,
-        es_hosts, es_index_gene, es_index_eco, es_index_efo,
-        cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains)
-
-    #here is the pipeline definition
-    pl_stage = pr.map(process_evidence, evs, 
-        workers=workers_validation, maxsize=queue_validation,
-        on_start=validation_on_start_baked)
-
-    logger.info('stages created, running scoring and writing')
+    #fail before starting the workers if the json backend is not available
+    get_json_backend(json_backend)
+
+    if split_size > 0 and first_n > 0:
+        logger.warning('reading the first %d lines in the main process, not in splits', first_n)
+        split_size = 0
+
+    manifest = None
+    if incremental_manifest and es_folder:
+        logger.warning('not using the incremental manifest when writing to a folder')
+    elif incremental_manifest and (first_n > 0 or dry_run):
+        logger.warning('not using the incremental manifest for a partial or dry run')
+    elif incremental_manifest:
+        manifest = EvidenceManifest(incremental_manifest)
+        #the documents of the unchanged lines are kept in the indexes
+        append_data = True
+        if split_size > 0:
+            logger.warning('reading the files in the main process to compare their lines')
+            split_size = 0
+
+    if partition_by_datasource and (append_data or manifest is not None):
+        logger.warning('appending to %s, not writing partitions of it', es_index_valid)
+        partition_by_datasource = False
+    if partition_by_datasource and es_folder:
+        logger.warning('writing %s to a folder, not writing partitions of it', es_index_valid)
+        partition_by_datasource = False
+
+    if scoring_columns_dir and (append_data or manifest is not None or partition_by_datasource):
+        logger.warning('not writing the scoring columns of only part of %s', es_index_valid)
+        scoring_columns_dir = None
+    elif scoring_columns_dir and dry_run:
+        logger.warning('not writing the scoring columns of a dry run')
+        scoring_columns_dir = None
+
+    if split_size > 0:
+        #the validators read the splits of the files themselves
+        evs = IO.make_splits(checked_filenames, split_size)
+        logger.info('read %d files as %d splits', len(checked_filenames), len(evs))
+    elif manifest is not None:
+        #only the new or changed lines of the changed files go to the validators
+        evs = manifest.filter_lines(IO.make_iter_lines(manifest.plan(checked_filenames)))
+        if batch_size > 1:
+            evs = more_itertools.chunked(evs, batch_size)
+    else:
+        #create a iterable of lines from all file handles
+        #in chunks of batch_size lines when batching
+        evs = IO.make_iter_lines(checked_filenames, first_n, 
+            batch_size if batch_size > 1 else 0)
 
     with URLZSource(es_mappings_valid).open() as mappings_file:
         mappings_valid = json.load(mappings_file)
@@ -372,36 +668,136 @@ def process_evidences_pipeline(
     with URLZSource(es_settings_invalid).open() as settings_file:
         settings_invalid = json.load(settings_file)
 
-    with ElasticsearchBulkIndexManager(es, es_index_invalid, settings_invalid, mappings_invalid, append_data):
-        with ElasticsearchBulkIndexManager(es, es_index_valid, settings_valid, mappings_valid, append_data):
-            #load into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(pl_stage, 
-                es_index_valid, es_index_invalid)
-            failcount = 0
-
-            if not dry_run:
-                results = None
-                if workers_write > 0:
-                    logger.debug("Using parallel bulk writer for Elasticearch")
-                    # this can silently crash ?
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=workers_write,
-                            queue_size=queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+    invalid_sink = None
+    if invalid_dir:
+        #the validators leave the invalid evidence out of the bulk requests
+        invalid_sink = InvalidEvidenceSink(invalid_dir, get_json_backend(json_backend),
+            invalid_lines_per_file, invalid_compression)
+        es_index_invalid = None
+
+    columns = None
+    if scoring_columns_dir:
+        #the validators return the scoring fields of the valid evidence
+        columns = EvidenceColumnsWriter(scoring_columns_dir)
+
+    partitions = None
+    partition_run = None
+    if partition_by_datasource:
+        #the validators name the partition of each evidence
+        partitions = ElasticsearchPartitionedIndexManager(es, es_index_valid, 
+            settings_valid, mappings_valid, load_options=es_load,
+            partition_field="unique_association_fields.datasource")
+        partition_run = partitions.run_id
+        logger.info('writing the datasources to partitions of %s of run %s', 
+            es_index_valid, partition_run)
+
+    #the validators write to the indexes the managers name, a new version of
+    #them when building one
+    if partitions is None:
+        valid_index_manager = index_manager(es, es_folder, es_index_valid, 
+            settings_valid, mappings_valid, append_data, es_load)
+        es_index_valid = valid_index_manager.index_name
+    else:
+        valid_index_manager = partitions
 
-                for success, details in results:
-                    if not success:
+    if invalid_sink is None:
+        invalid_index_manager = index_manager(es, es_folder, es_index_invalid, 
+            settings_invalid, mappings_invalid, append_data, es_load)
+        es_index_invalid = invalid_index_manager.index_name
+    else:
+        invalid_index_manager = invalid_sink
+
+    #when requested, build the lookup tables once here and let the children
+    #share the memory-mapped files instead of querying elasticsearch
+    with lookup_snapshots(es, lookup_snapshot, lookup_cache_dir, gene_index=es_index_gene,
+            eco_index=es_index_eco, efo_index=es_index_efo) as snapshot_files, \
+            compiled_schema_validators(schema_uri, schema_cache_dir) as schema_validators_dir:
+        #create functions with pre-baked arguments
+        validation_on_start_baked = functools.partial(validation_on_start, 
+            eco_scores_uri, schema_uri, excluded_biotypes, datasources_to_datatypes,
+            es_hosts, es_index_gene, es_index_eco, es_index_efo,
+            cache_target, cache_target_u2e, cache_target_contains,
+            cache_eco, cache_efo, cache_efo_contains, preload_lookups,
+            snapshot_files, json_backend, schema_validators_dir)
+
+        #here is the pipeline definition
+        if split_size > 0:
+            #each worker reads and handles a split of the files at a time
+            process_evidence_split_baked = functools.partial(process_evidence_split,
+                batch_size=batch_size, index_valid=es_index_valid, index_invalid=es_index_invalid,
+                partition_run=partition_run, scoring_columns=columns is not None)
+            pl_stage = pr.flat_map(process_evidence_split_baked, evs, 
+                workers=workers_validation, maxsize=queue_validation,
+                on_start=validation_on_start_baked,
+                on_done=validation_on_done)
+        elif batch_size > 1:
+            #each worker handles a chunk of lines at a time and returns
+            #it as the body of a bulk request
+            process_evidence_chunk_baked = functools.partial(process_evidence_chunk,
+                index_valid=es_index_valid, index_invalid=es_index_invalid,
+                partition_run=partition_run, scoring_columns=columns is not None)
+            pl_stage = pr.map(process_evidence_chunk_baked, evs, 
+                workers=workers_validation, maxsize=queue_validation,
+                on_start=validation_on_start_baked,
+                on_done=validation_on_done)
+        else:
+            process_evidence_baked = functools.partial(process_evidence,
+                scoring_columns=columns is not None)
+            pl_stage = pr.map(process_evidence_baked, evs, 
+                workers=workers_validation, maxsize=queue_validation,
+                on_start=validation_on_start_baked,
+                on_done=validation_on_done)
+
+        logger.info('stages created, running scoring and writing')
+
+        with invalid_index_manager:
+            with valid_index_manager:
+                #load into elasticsearch
+                if manifest is not None and batch_size <= 1:
+                    pl_stage = record_results(pl_stage, es_index_valid, es_index_invalid,
+                        manifest)
+                actions = elasticsearch_actions(pl_stage, 
+                    es_index_valid, es_index_invalid, partitions, invalid_sink, columns)
+                failcount = 0
+
+                if not dry_run and batch_size > 1:
+                    logger.debug("Using bulk payloads of the validators for Elasticearch")
+                    for item in bulk_payloads(es, es_folder,
+                            record_payloads(pl_stage, manifest, partitions, invalid_sink,
+                                columns), 
+                            thread_count=workers_write, queue_size=queue_write):
                         failcount += 1
 
-                if failcount:
-                    raise RuntimeError("%s relations failed to index" % failcount)
+                    if failcount:
+                        raise RuntimeError("%s relations failed to index" % failcount)
+
+                elif not dry_run:
+                    results = bulk(es, es_folder, actions,
+                            thread_count=workers_write, queue_size=queue_write, 
+                            chunk_bytes=es_bulk_bytes)
+
+                    for success, details in results:
+                        if not success:
+                            failcount += 1
+
+                    if failcount:
+                        raise RuntimeError("%s relations failed to index" % failcount)
+
+                if manifest is not None:
+                    #unreachable files are kept, the run fails below anyway
+                    removed = manifest.removed_documents(filenames)
+                    logger.info('deleting %d documents of removed lines', len(removed))
+                    failcount = delete_removed_documents(es, removed)
+                    if failcount:
+                        raise RuntimeError("%s removed relations failed to delete" % failcount)
+                    manifest.commit()
+                    manifest.close()
+
+                logger.info('stages created, ran scoring and writing')
 
-            logger.info('stages created, ran scoring and writing')
+        if columns is not None:
+            #only once everything is written, a failed run keeps the previous ones
+            columns.close()
 
 
     if failed_filenames:
@@ -14,11 +14,10 @@ import petl
 import more_itertools
 from opentargets_urlzsource import URLZSource
 import elasticsearch
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import parallel_scan
+from mrtarget.common.esfile import index_manager, bulk
 from mrtarget.common.connection import new_es_client
 from addict import Dict
 from mrtarget.common.DataStructure import JSONSerializable, json_serialize, PipelineEncoder
@@ -506,8 +505,12 @@ class HPAProcess(object):
             tissue_curation_map_url,
             normal_tissue_url,
             rna_level_url, rna_value_url, rna_zscore_url, 
-            workers_write, queue_write):
+            workers_write, queue_write, es_folder=None, es_bulk_bytes=None,
+            es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -552,23 +555,17 @@ class HPAProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
   
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(self.hpa_merged_table, dry_run, self.es_index)
+            actions = elasticsearch_actions(self.hpa_merged_table, dry_run, manager.index_name)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = bulk(es, self.es_folder, actions,
+                        thread_count=self.workers_write, queue_size=self.queue_write, 
+                        chunk_bytes=self.es_bulk_bytes)
                 for success, details in results:
                     if not success:
                         failcount += 1
@@ -586,13 +583,14 @@ class HPAProcess(object):
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
         self.logger.info("Starting QC")
 
         #number of hpa entries
         hpa_count = 0
         #Note: try to avoid doing this more than once!
-        for hpa_entry in Search().using(es).index(index).query(MatchAll()).scan():
+        query = {"query": {"match_all": {}}, "_source": False}
+        for hpa_entry in parallel_scan(es, index, query, workers=scan_workers):
             hpa_count += 1
 
         #put the metrics into a single dict
@@ -8,12 +8,11 @@ from networkx.algorithms import all_simple_paths
 
 from mrtarget.common.DataStructure import TreeNode, JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import parallel_scan
+from mrtarget.common.esfile import index_manager, bulk
 from opentargets_urlzsource import URLZSource
 
 import elasticsearch
-from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll
 
 import simplejson as json
 
@@ -124,8 +123,12 @@ def elasticsearch_actions(reactions, index):
 class ReactomeProcess(object):
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
             pathway_data_url, pathway_relation_url,
-            workers_write, queue_write):
+            workers_write, queue_write, es_folder=None, es_bulk_bytes=None,
+            es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -160,23 +163,17 @@ class ReactomeProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             docs = generate_documents(self.g)
-            actions = elasticsearch_actions(docs, self.es_index)
+            actions = elasticsearch_actions(docs, manager.index_name)
             failcount = 0
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
+                results = bulk(es, self.es_folder, actions,
+                        thread_count=self.workers_write, queue_size=self.queue_write, 
+                        chunk_bytes=self.es_bulk_bytes)
                 for success, _ in results:
                     if not success:
                         failcount += 1
@@ -189,13 +186,14 @@ class ReactomeProcess(object):
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
-    def qc(self, es, index):
+    def qc(self, es, index, scan_workers=1):
         self.logger.info("Starting QC")
 
         #number of reactions
         reaction_count = 0
         #Note: try to avoid doing this more than once!
-        for _ in Search().using(es).index(index).query(MatchAll()).scan():
+        query = {"query": {"match_all": {}}, "_source": False}
+        for _ in parallel_scan(es, index, query, workers=scan_workers):
             reaction_count += 1
 
         #put the metrics into a single dict
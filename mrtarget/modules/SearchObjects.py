@@ -8,7 +8,8 @@ from collections import defaultdict
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.chembl_lookup import ChEMBLLookup
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.IndexReader import new_index_reader
+from mrtarget.common.esfile import index_manager, bulk
 
 from opentargets_urlzsource import URLZSource
 
@@ -184,22 +185,15 @@ def elasticsearch_actions(items, dry_run, index):
 
             yield action
 
-def store_in_elasticsearch(so_it, dry_run, es, index, workers_write, queue_write):
+def store_in_elasticsearch(so_it, dry_run, es, index, workers_write, queue_write, es_folder=None,
+        es_bulk_bytes=None):
         #write into elasticsearch
-        chunk_size = 1000 #TODO make configurable
         actions = elasticsearch_actions(so_it, dry_run, index)
         failcount = 0
 
         if not dry_run:
-            results = None
-            if workers_write > 0:
-                results = elasticsearch.helpers.parallel_bulk(es, actions,
-                        thread_count=workers_write,
-                        queue_size=queue_write, 
-                        chunk_size=chunk_size)
-            else:
-                results = elasticsearch.helpers.streaming_bulk(es, actions,
-                        chunk_size=chunk_size)
+            results = bulk(es, es_folder, actions,
+                    thread_count=workers_write, queue_size=queue_write, chunk_bytes=es_bulk_bytes)
             for success, details in results:
                 if not success:
                     failcount += 1
@@ -215,8 +209,12 @@ class SearchObjectProcess(object):
             chembl_mechanism_uri, 
             chembl_component_uri, 
             chembl_protein_uri, 
-            chembl_molecule_set_uri_pattern):
+            chembl_molecule_set_uri_pattern,
+            workers_scan=1, es_folder=None, es_bulk_bytes=None, es_load=None):
         self.es_hosts = es_hosts
+        self.es_folder = es_folder
+        self.es_bulk_bytes = es_bulk_bytes
+        self.es_load = es_load
         self.es_index = es_index
         self.es_mappings = es_mappings
         self.es_settings = es_settings
@@ -231,6 +229,7 @@ class SearchObjectProcess(object):
         self.chembl_component_uri = chembl_component_uri
         self.chembl_protein_uri = chembl_protein_uri
         self.chembl_molecule_set_uri_pattern = chembl_molecule_set_uri_pattern
+        self.workers_scan = workers_scan
 
         self.logger = logging.getLogger(__name__)
 
@@ -247,13 +246,16 @@ class SearchObjectProcess(object):
         '''
 
         es = new_es_client(self.es_hosts)
+        #the inputs written to the folder are read from it
+        reader = new_index_reader(es, self.es_folder)
         #setup chembl handler
         self.chembl_handler = ChEMBLLookup(self.chembl_target_uri, 
             self.chembl_mechanism_uri, 
             self.chembl_component_uri, 
             self.chembl_protein_uri, 
             self.chembl_molecule_set_uri_pattern)
-        self.chembl_handler.get_molecules_from_evidence(es, self.es_index_val_right)
+        self.chembl_handler.get_molecules_from_evidence(reader, self.es_index_val_right,
+            self.workers_scan)
         all_molecules = set()
         for target, molecules in  list(self.chembl_handler.target2molecule.items()):
             all_molecules = all_molecules|molecules
@@ -269,29 +271,30 @@ class SearchObjectProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with index_manager(es, self.es_folder, self.es_index, settings, mappings,
+                load_options=self.es_load) as manager:
             #process targets
             self.logger.info('handling targets')
-            targets = self.get_targets(es)
+            targets = self.get_targets(reader)
             so_it = self.handle_search_object(targets, es, SearchObjectTypes.TARGET)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
-                self.workers_write, self.queue_write)
+            store_in_elasticsearch(so_it, dry_run, es, manager.index_name, 
+                self.workers_write, self.queue_write, self.es_folder, self.es_bulk_bytes)
 
             #process diseases
             self.logger.info('handling diseases')
-            diseases = self.get_diseases(es)
+            diseases = self.get_diseases(reader)
             so_it = self.handle_search_object(diseases, es, SearchObjectTypes.DISEASE)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
-                self.workers_write, self.queue_write)
+            store_in_elasticsearch(so_it, dry_run, es, manager.index_name, 
+                self.workers_write, self.queue_write, self.es_folder, self.es_bulk_bytes)
 
 
-    def get_targets(self, es):
-        for target in Search().using(es).index(self.es_index_gene).extra(track_total_hits=True).query(MatchAll()).scan():
-            yield target.to_dict()
+    def get_targets(self, reader):
+        for target in reader.scan(self.es_index_gene, workers=self.workers_scan):
+            yield target['_source']
     
-    def get_diseases(self, es):
-        for disease in Search().using(es).index(self.es_index_efo).extra(track_total_hits=True).query(MatchAll()).scan():
-            yield disease.to_dict()
+    def get_diseases(self, reader):
+        for disease in reader.scan(self.es_index_efo, workers=self.workers_scan):
+            yield disease['_source']
 
     def handle_search_object(self, data_it, es, search_type):
         for data in data_it:
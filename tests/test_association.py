@@ -0,0 +1,175 @@
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+import simplejson as json
+
+from mrtarget.common.EvidenceColumns import EvidenceColumnsWriter, scoring_fields
+from mrtarget.common.IndexReader import ElasticsearchIndexReader
+from mrtarget.modules.Association import group_evidence, \
+    spill_evidence_partitions, produce_evidence_partition, produce_evidence_columns, \
+    Scorer, EvidenceScore
+from mrtarget.common.Scoring import ScoringMethods
+from mrtarget.modules.EFO import EfoDag
+
+DATASOURCES_TO_DATATYPES = {"ds1": "dt1", "ds2": "dt2"}
+
+def make_evidence(target, disease, efo_codes, score, source):
+    return {"target": {"id": target}, "disease": {"id": disease},
+        "private": {"efo_codes": efo_codes}, "sourceID": source,
+        "scores": {"association_score": score}, "id": "%s-%s-%s" % (target, disease, source)}
+
+EVIDENCE = [
+    make_evidence("ENSG01", "EFO_2", ["EFO_1", "EFO_2"], 0.5, "ds1"),
+    make_evidence("ENSG01", "EFO_3", ["EFO_1", "EFO_3"], 0.25, "ds2"),
+    make_evidence("ENSG02", "EFO_2", ["EFO_1", "EFO_2"], 1.0, "ds2"),
+    make_evidence("ENSG03", "EFO_3", ["EFO_1", "EFO_3"], 0.1, "ds1"),
+]
+
+
+def summarise(grouped):
+    return sorted((target, disease, is_direct, 
+            sorted((e.score, e.datasource, e.is_direct) for e in scores))
+        for target, disease, scores, is_direct in grouped)
+
+
+class SinglePassTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_partitions_match_per_target(self, scan):
+        scan.return_value = iter([{"_source": e} for e in EVIDENCE])
+        es = mock.Mock()
+        es.indices.exists_alias.return_value = False
+        filenames = spill_evidence_partitions(ElasticsearchIndexReader(es), "evidence",
+            self.directory, 2)
+        self.assertEqual(len(filenames), 2)
+
+        single_pass = []
+        for filename in filenames:
+            single_pass.extend(produce_evidence_partition(filename, None, "evidence",
+                {"ds2": 0.5}, ["ds2"], DATASOURCES_TO_DATATYPES))
+
+        per_target = []
+        for target in ("ENSG01", "ENSG02", "ENSG03"):
+            per_target.extend(group_evidence(
+                [e for e in EVIDENCE if e["target"]["id"] == target],
+                {"ds2": 0.5}, ["ds2"], DATASOURCES_TO_DATATYPES))
+
+        self.assertEqual(summarise(single_pass), summarise(per_target))
+        self.assertEqual(len(single_pass), 6)
+
+    def test_columns_match_per_target(self):
+        writer = EvidenceColumnsWriter(self.directory + "/columns")
+        for evidence in EVIDENCE:
+            writer.add(scoring_fields(evidence))
+        writer.close()
+
+        columns = []
+        for chunk in [(self.directory + "/columns", 0, 2), (self.directory + "/columns", 2, 3)]:
+            columns.extend(produce_evidence_columns(chunk, None, "evidence",
+                {"ds2": 0.5}, ["ds2"], DATASOURCES_TO_DATATYPES))
+
+        self.assertEqual(summarise(columns), summarise(group_evidence(EVIDENCE,
+            {"ds2": 0.5}, ["ds2"], DATASOURCES_TO_DATATYPES)))
+
+
+class VectorisedScorerTestCase(unittest.TestCase):
+
+    def test_same_association_both_paths(self):
+        rnd = random.Random(7)
+        datasources_to_datatypes = {"ds1": "dt1", "ds2": "dt1", "ds3": "dt2"}
+        evidence_scores = [EvidenceScore(rnd.random() * 2, datasources_to_datatypes[ds], ds, True)
+            for ds in (rnd.choice(list(datasources_to_datatypes)) for _ in range(300))]
+
+        scorer = Scorer()
+        vectorised = scorer.score("ENSG01", "EFO_1", evidence_scores, True,
+            datasources_to_datatypes)
+        with mock.patch.object(Scorer, "VECTORISED_MIN_EVIDENCE", len(evidence_scores) + 1):
+            scalar = scorer.score("ENSG01", "EFO_1", evidence_scores, True,
+                datasources_to_datatypes)
+
+        self.assertEqual(vectorised.to_json(), scalar.to_json())
+
+
+class EfoDagTestCase(unittest.TestCase):
+
+    PATHS = {
+        "EFO_1": [["EFO_1"]],
+        "EFO_2": [["EFO_1", "EFO_2"]],
+        "EFO_3": [["EFO_1", "EFO_3"]],
+        #two paths to the root
+        "EFO_4": [["EFO_1", "EFO_2", "EFO_4"], ["EFO_1", "EFO_3", "EFO_4"]],
+    }
+
+    def test_topological_order(self):
+        dag = EfoDag(self.PATHS)
+        self.assertEqual(len(dag), 4)
+        for i in range(len(dag)):
+            for ancestor in dag.ancestors(i):
+                self.assertLessEqual(ancestor, i)
+        self.assertEqual(sorted(dag.codes[a] for a in dag.ancestors(dag.index["EFO_4"])),
+            ["EFO_1", "EFO_2", "EFO_3", "EFO_4"])
+
+    def test_same_groups_as_efo_codes(self):
+        dag = EfoDag(dict(self.PATHS, EFO_5=[]))
+        evidence = EVIDENCE + [
+            make_evidence("ENSG01", "EFO_4", ["EFO_1", "EFO_2", "EFO_3", "EFO_4"], 0.3, "ds1"),
+            make_evidence("ENSG01", "EFO_4", ["EFO_1", "EFO_2", "EFO_3", "EFO_4"], 0.7, "ds2"),
+            #not in the ontology, so without path codes
+            make_evidence("ENSG02", "EFO_9", [], 0.2, "ds1"),
+            make_evidence("ENSG02", "EFO_9", [], 0.4, "ds2"),
+            #in the ontology without path codes of its own
+            make_evidence("ENSG03", "EFO_5", [], 0.6, "ds1"),
+        ]
+        #the dag mode does not read the ancestors stored in the evidence
+        without_codes = [dict((k, v) for k, v in e.items() if k != "private")
+            for e in evidence]
+        for do_not_propagate in ([], ["ds2"]):
+            expected = group_evidence(evidence, {"ds2": 0.5}, do_not_propagate,
+                DATASOURCES_TO_DATATYPES)
+            result = group_evidence(without_codes, {"ds2": 0.5}, do_not_propagate,
+                DATASOURCES_TO_DATATYPES, dag)
+            self.assertEqual(summarise(result), summarise(expected))
+        #only the evidence of the datasource that is not propagated is kept
+        self.assertEqual([(t, d, is_direct) for t, d, _, is_direct in result
+            if d in ("EFO_5", "EFO_9")], [("ENSG02", "EFO_9", True)])
+
+
+class CompactAssociationTestCase(unittest.TestCase):
+
+    #the nested shape written before the scores were kept in flat lists
+    EXPECTED = {"disease": {"id": "EFO_1"}, 
+        "evidence_count": {"datasources": {"ds1": 2.0, "ds2": 1.0, "ds3": 1.0, "ds4": 0.0}, 
+            "datatypes": {"dt1": 3.0, "dt2": 1.0, "dt3": 0.0}, "total": 4.0}, 
+        "harmonic-sum": {"datasources": {"ds1": 0.525, "ds2": 0.25, "ds3": 1, "ds4": 0.0}, 
+            "datatypes": {"dt1": 0.5875, "dt2": 1.0, "dt3": 0.0}, "overall": 1.1590277777777778}, 
+        "id": "ENSG01-EFO_1", "is_direct": True, 
+        "max": {"datasources": {"ds1": 0.0, "ds2": 0.0, "ds3": 0.0, "ds4": 0.0}, 
+            "datatypes": {"dt1": 0.0, "dt2": 0.0, "dt3": 0.0}}, 
+        "private": {"facets": {"datasource": ["ds1", "ds2", "ds3"], "datatype": ["dt1", "dt2"], 
+            "expression_tissues": [], "free_text_search": ["dt1", "ds1", "ds2", "dt2", "ds3"]}}, 
+        "sum": {"datasources": {"ds1": 0.0, "ds2": 0.0, "ds3": 0.0, "ds4": 0.0}, 
+            "datatypes": {"dt1": 0.0, "dt2": 0.0, "dt3": 0.0}}, 
+        "target": {"id": "ENSG01"}}
+
+    def test_same_json(self):
+        datasources_to_datatypes = {"ds1": "dt1", "ds2": "dt1", "ds3": "dt2", "ds4": "dt3"}
+        evidence_scores = [EvidenceScore(0.5, "dt1", "ds1", True), 
+            EvidenceScore(0.25, "dt1", "ds2", False),
+            EvidenceScore(2.0, "dt2", "ds3", True), 
+            EvidenceScore(0.1, "dt1", "ds1", True)]
+        association = Scorer().score("ENSG01", "EFO_1", evidence_scores, True, 
+            datasources_to_datatypes)
+        self.assertEqual(association.to_json(), json.dumps(self.EXPECTED, sort_keys=True))
+        self.assertFalse(hasattr(evidence_scores[0], "__dict__"))
+        self.assertFalse(hasattr(association, "__dict__"))
+        self.assertFalse(hasattr(association.get_scoring_method(ScoringMethods.HARMONIC_SUM), 
+            "__dict__"))
@@ -1,5 +1,10 @@
+import gzip
+import os
+import shutil
+import tempfile
 import unittest
-from mrtarget.common.IO import check_to_open
+
+from mrtarget.common.IO import check_to_open, make_iter_lines, make_splits, iter_split_lines
 
 
 class IOTests(unittest.TestCase):
@@ -7,6 +12,50 @@ class IOTests(unittest.TestCase):
         filename = '/false/file'
         self.assertFalse(check_to_open(filename),'file does not exist so it must return false')
 
+    def test_make_iter_lines_chunks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "lines.json")
+            with open(filename, "w") as f:
+                f.write("".join("%d\n" % i for i in range(10)))
+            chunks = list(make_iter_lines([filename], chunk_size=4))
+            self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+            self.assertEqual(chunks[2][1], (filename, (10, "9\n")))
+            chunks = list(make_iter_lines([filename], first_n=5, chunk_size=4))
+            self.assertEqual([len(c) for c in chunks], [4, 1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_splits(self):
+        directory = tempfile.mkdtemp()
+        try:
+            lines = [("%d" % i) * (i % 7 + 1) + "\n" for i in range(500)]
+            filename = os.path.join(directory, "lines.json")
+            with open(filename, "w") as f:
+                f.write("".join(lines))
+            gz_filename = os.path.join(directory, "lines.json.gz")
+            with gzip.open(gz_filename, "wt") as f:
+                f.write("".join(lines))
+
+            for split_size in (100, 1, 10000):
+                splits = make_splits([filename, gz_filename], split_size)
+                self.assertEqual(splits[-1], (gz_filename, 0, None, 1))
+                read = [l for split in splits[:-1] for l in iter_split_lines(split)]
+                self.assertEqual([line for _, (_, line) in read], 
+                    [l.encode("utf-8") for l in lines])
+                #numbered by their line in the file in every split
+                self.assertEqual([line_n for _, (line_n, _) in read], 
+                    list(range(1, len(lines) + 1)))
+            self.assertEqual(len(make_splits([filename], 1)), 500)
+            self.assertEqual(len(list(iter_split_lines(splits[-1]))), 500)
+            #a line in the second split reports its real position
+            second = list(iter_split_lines(make_splits([filename], 100)[1]))
+            filename_n, (line_n, line) = second[0]
+            self.assertEqual(line, lines[line_n - 1].encode("utf-8"))
+            self.assertGreater(line_n, 1)
+        finally:
+            shutil.rmtree(directory)
+
     def test_check_to_open_true(self):
         filename = 'https://www.google.com/robots.txt'
         self.assertTrue(check_to_open(filename),'google robots url must exist')
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import simplejson as json
+
+from mrtarget.common.esfile import FolderIndexManager, bulk, bulk_payloads, bulk_entries, \
+    iter_folder_actions, read_index_settings
+from mrtarget.common.esutil import bulk_index_line, bulk_entry
+
+
+class FolderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def actions(self, n):
+        for i in range(n):
+            yield {"_index": "index", "_id": "%d" % i, "_source": {"value": i}}
+
+    def test_actions(self):
+        for thread_count in (0, 3):
+            with FolderIndexManager(self.folder, "index", {"number_of_shards": 1}, {"a": 1}):
+                results = list(bulk(None, self.folder, self.actions(25), thread_count,
+                    queue_size=2, chunk_size=4))
+            self.assertEqual(len(results), 25)
+            self.assertTrue(all(success for success, _ in results))
+            self.assertEqual(len(os.listdir(os.path.join(self.folder, "index"))),
+                1 + max(1, thread_count))
+            actions = sorted(iter_folder_actions(self.folder, "index"), key=lambda a: int(a["_id"]))
+            self.assertEqual(actions, list(self.actions(25)))
+            self.assertEqual(read_index_settings(self.folder, "index"),
+                {"settings": {"number_of_shards": 1}, "mappings": {"a": 1}})
+
+    def test_payloads(self):
+        payloads = ["\n".join([bulk_index_line(index, "%d" % i), json.dumps({"value": i}), 
+            ""]).encode("utf-8") for i, index in enumerate(["valid", "invalid", "valid"])]
+        self.assertEqual(list(bulk_payloads(None, self.folder, payloads + [b""], 2)), [])
+        self.assertEqual([a["_id"] for a in iter_folder_actions(self.folder, "invalid")], ["1"])
+        self.assertEqual(sorted(a["_id"] for a in iter_folder_actions(self.folder, "valid")),
+            ["0", "2"])
+
+    def test_line_separators_in_documents(self):
+        #orjson writes these unescaped
+        text = u"a\u2028b\u2029c\u0085d\x1ce"
+        payload = b"".join(bulk_entry(index, "%d" % i, json.dumps({"text": text}, 
+            ensure_ascii=False)) 
+            for i, index in enumerate(["valid", "invalid", "valid"]))
+        list(bulk_payloads(None, self.folder, [payload], 0))
+        list(bulk_entries(None, self.folder, [bulk_entry("other", "3", 
+            json.dumps({"text": text}, ensure_ascii=False))]))
+        self.assertEqual([a["_source"]["text"] for a in iter_folder_actions(self.folder, "valid")],
+            [text, text])
+        self.assertEqual([a["_id"] for a in iter_folder_actions(self.folder, "invalid")], ["1"])
+        self.assertEqual([a["_source"]["text"] for a in iter_folder_actions(self.folder, "other")],
+            [text])
+
+    def test_entries(self):
+        entries = [bulk_entry("index", a["_id"], json.dumps(a["_source"])) for a in self.actions(5)]
+        results = list(bulk_entries(None, self.folder, entries, 2, chunk_size=2))
+        self.assertEqual([item["index"]["_id"] for _, item in results], 
+            ["0", "1", "2", "3", "4"])
+        actions = sorted(iter_folder_actions(self.folder, "index"), key=lambda a: int(a["_id"]))
+        self.assertEqual(actions, list(self.actions(5)))
@@ -0,0 +1,436 @@
+import unittest
+
+import elasticsearch
+import mock
+import simplejson as json
+
+from mrtarget.common.esutil import parallel_scan, send_bulk_payloads, bulk_index_line, \
+    ElasticsearchPartitionedIndexManager, partition_index_name, BulkWriter, bulk_entry, \
+    ElasticsearchBulkIndexManager, BulkLoadOptions, finalise_indices, LoadProfile
+
+
+def fake_scan(client, query, index, **kwargs):
+    slice_id = query["slice"]["id"]
+    if slice_id == 3:
+        raise RuntimeError("slice failed")
+    for i in range(100):
+        yield {"_id": "%d-%d" % (slice_id, i)}
+
+
+class ParallelScanTestCase(unittest.TestCase):
+
+    @mock.patch("elasticsearch.helpers.scan", side_effect=fake_scan)
+    def test_merges_slices(self, scan):
+        hits = list(parallel_scan(None, "index", workers=3, maxsize=10))
+        self.assertEqual(len(hits), 300)
+        self.assertEqual(len(set(hit["_id"] for hit in hits)), 300)
+        self.assertEqual(scan.call_count, 3)
+        self.assertEqual(sorted(c[1]["query"]["slice"]["id"] for c in scan.call_args_list), [0, 1, 2])
+
+    @mock.patch("elasticsearch.helpers.scan", side_effect=fake_scan)
+    def test_raises_slice_errors(self, scan):
+        with self.assertRaises(RuntimeError):
+            list(parallel_scan(None, "index", workers=4, maxsize=10))
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_single_worker(self, scan):
+        scan.return_value = iter([{"_id": "a"}])
+        self.assertEqual(list(parallel_scan(None, "index")), [{"_id": "a"}])
+        self.assertNotIn("slice", scan.call_args[1]["query"])
+
+    @mock.patch("elasticsearch.helpers.scan", side_effect=fake_scan)
+    def test_several_indices(self, scan):
+        hits = list(parallel_scan(None, ["a", "b"], workers=4, maxsize=10))
+        self.assertEqual(len(hits), 400)
+        self.assertEqual(sorted((c[1]["index"], c[1]["query"]["slice"]["id"]) 
+            for c in scan.call_args_list), [("a", 0), ("a", 1), ("b", 0), ("b", 1)])
+
+
+def fake_bulk(body):
+    docs = body.decode("utf-8").splitlines()[1::2]
+    items = [{"index": {"status": 400, "error": "bad"}} if doc == "{}" else {"index": {"status": 201}}
+        for doc in docs]
+    return {"errors": any("error" in i["index"] for i in items), "items": items}
+
+
+class SendBulkPayloadsTestCase(unittest.TestCase):
+
+    def payloads(self):
+        for i in range(20):
+            lines = [bulk_index_line("index", "%d" % i), "{}" if i % 5 == 0 else '{"a": 1}', ""]
+            yield "\n".join(lines).encode("utf-8")
+        yield b""
+
+    def test_failed_items(self):
+        for thread_count in (0, 3):
+            client = mock.Mock()
+            client.bulk.side_effect = fake_bulk
+            failed = list(send_bulk_payloads(client, self.payloads(), thread_count, queue_size=2))
+            self.assertEqual(len(failed), 4)
+            #empty payloads are not sent
+            self.assertEqual(client.bulk.call_count, 20)
+
+
+class RejectingClient(object):
+    """accepts each document the second time it is sent"""
+
+    def __init__(self, reject_whole=0):
+        self.bodies = []
+        self.seen = set()
+        self.reject_whole = reject_whole
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        if self.reject_whole:
+            self.reject_whole -= 1
+            raise elasticsearch.TransportError(429, "es_rejected_execution_exception")
+        lines = body.decode("utf-8").splitlines()
+        items = []
+        for action in lines[::2]:
+            doc_id = json.loads(action)["index"]["_id"]
+            if doc_id in self.seen:
+                items.append({"index": {"_index": "index", "_id": doc_id, "status": 201}})
+            else:
+                self.seen.add(doc_id)
+                items.append({"index": {"_index": "index", "_id": doc_id, "status": 429,
+                    "error": {"type": "es_rejected_execution_exception"}}})
+        return {"errors": True, "items": items}
+
+
+@mock.patch("time.sleep")
+class BulkWriterTestCase(unittest.TestCase):
+
+    def actions(self, n):
+        return [{"_index": "index", "_id": str(i), "_source": {"a": "x" * 100}} 
+            for i in range(n)]
+
+    def test_chunks_by_bytes(self, sleep):
+        client = mock.Mock()
+        client.bulk.side_effect = fake_bulk
+        writer = BulkWriter(client, chunk_bytes=1000)
+        results = list(writer.write_actions(self.actions(20)))
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(success for success, _ in results))
+        #each action is about 160 bytes
+        self.assertEqual(client.bulk.call_count, 4)
+        for call in client.bulk.call_args_list:
+            self.assertLessEqual(len(call[1]["body"]), 1000)
+
+    def test_entries(self, sleep):
+        client = mock.Mock()
+        client.bulk.side_effect = fake_bulk
+        entries = [bulk_entry("index", str(i), '{"a": %d}' % i) for i in range(5)]
+        results = list(BulkWriter(client, chunk_size=2).write_entries(entries))
+        self.assertEqual(len(results), 5)
+        self.assertEqual([call[1]["body"] for call in client.bulk.call_args_list],
+            [b"".join(entries[0:2]), b"".join(entries[2:4]), entries[4]])
+
+    def test_retries_rejected_items_only(self, sleep):
+        client = RejectingClient()
+        client.seen.update(["0", "2"])
+        writer = BulkWriter(client, thread_count=4)
+        results = list(writer.write_actions(self.actions(4)))
+        self.assertTrue(all(success for success, _ in results))
+        self.assertEqual(len(client.bodies), 2)
+        self.assertEqual([json.loads(l)["index"]["_id"] 
+            for l in client.bodies[1].decode("utf-8").splitlines()[::2]], ["1", "3"])
+        self.assertEqual(writer.stats["index"][0], 4)
+        self.assertEqual(writer.stats["index"][2], 2)
+        #a rejection halves the requests in flight
+        self.assertEqual(writer.concurrency, 2)
+
+    def test_retries_rejected_requests(self, sleep):
+        client = RejectingClient(reject_whole=2)
+        client.seen.update(["0", "1"])
+        payload = "".join("%s\n{}\n" % bulk_index_line("index", str(i)) for i in range(2))
+        self.assertEqual(list(BulkWriter(client).write_payloads([payload.encode("utf-8")])), [])
+        self.assertEqual(len(client.bodies), 3)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [2, 4])
+
+    def test_gives_up(self, sleep):
+        client = RejectingClient()
+        failed = list(BulkWriter(client, max_retries=0).write_actions(self.actions(2)))
+        self.assertEqual([success for success, _ in failed], [False, False])
+
+
+def finalising_client():
+    """a client whose merges complete at once and indexes are green"""
+    client = mock.Mock()
+    client.indices.forcemerge.side_effect = lambda index, **kwargs: {"task": "n:" + index}
+    client.tasks.get.return_value = {"completed": True, 
+        "task": {"running_time_in_nanos": 1000}}
+    client.cluster.health.return_value = {"timed_out": False, "number_of_data_nodes": 3}
+    client.info.return_value = {"version": {"number": "7.6.1"}}
+    return client
+
+
+@mock.patch("time.sleep")
+class FinaliseIndicesTestCase(unittest.TestCase):
+
+    def test_merges_in_requests(self, sleep):
+        client = finalising_client()
+        client.indices.forcemerge.side_effect = [None, elasticsearch.ConnectionTimeout()]
+        finalise_indices(client, {"a": "1", "b": None}, 
+            BulkLoadOptions(max_num_segments=5, finalise_timeout=60))
+        client.indices.forcemerge.assert_any_call(index="a", max_num_segments=5,
+            request_timeout=60)
+        self.assertEqual(client.indices.forcemerge.call_count, 2)
+        client.tasks.get.assert_not_called()
+        self.assertEqual(client.indices.put_settings.call_count, 2)
+
+    def test_merges_in_background(self, sleep):
+        client = finalising_client()
+        client.info.return_value = {"version": {"number": "8.1.0"}}
+        client.tasks.get.side_effect = [{"completed": False}, {"completed": False}, 
+            client.tasks.get.return_value, client.tasks.get.return_value]
+        finalise_indices(client, {"a": "1", "b": None}, BulkLoadOptions(max_num_segments=5))
+        client.indices.forcemerge.assert_any_call(index="a", max_num_segments=5,
+            params={"wait_for_completion": "false"})
+        self.assertEqual(client.tasks.get.call_count, 4)
+        self.assertEqual(sleep.call_count, 1)
+        client.indices.put_settings.assert_any_call(index="a", 
+            body={"index": {"number_of_replicas": "1"}})
+        client.indices.put_settings.assert_any_call(index="b", 
+            body={"index": {"number_of_replicas": None}})
+        self.assertEqual(client.cluster.health.call_args[1]["index"], "a,b")
+
+    def test_gives_up_after_timeout(self, sleep):
+        client = finalising_client()
+        client.info.return_value = {"version": {"number": "8.5.3"}}
+        client.tasks.get.return_value = {"completed": False}
+        finalise_indices(client, {"a": "1"}, BulkLoadOptions(replicas=2, finalise_timeout=0))
+        client.indices.put_settings.assert_called_once_with(index="a", 
+            body={"index": {"number_of_replicas": 2}})
+        self.assertTrue(client.cluster.health.called)
+
+    def test_failed_merge(self, sleep):
+        client = finalising_client()
+        client.info.return_value = {"version": {"number": "8.5.3"}}
+        client.tasks.get.return_value = {"completed": True, "error": {"type": "oops"}}
+        with self.assertRaises(RuntimeError):
+            finalise_indices(client, {"a": "1"}, BulkLoadOptions())
+
+    def test_no_merge(self, sleep):
+        client = finalising_client()
+        finalise_indices(client, {"a": "1"}, BulkLoadOptions(max_num_segments=0))
+        client.indices.forcemerge.assert_not_called()
+
+    def test_deferred(self, sleep):
+        client = finalising_client()
+        client.indices.get_settings.return_value = {}
+        load_options = BulkLoadOptions(defer_finalise=True)
+        for index in ["a", "b"]:
+            with ElasticsearchBulkIndexManager(client, index, load_options=load_options):
+                pass
+        client.indices.forcemerge.assert_not_called()
+        self.assertEqual(list(load_options.deferred), ["a", "b"])
+        load_options.finalise_deferred()
+        self.assertEqual(client.indices.forcemerge.call_count, 2)
+        waits = [c for c in client.cluster.health.call_args_list if "index" in c[1]]
+        self.assertEqual(len(waits), 1)
+        self.assertEqual(waits[0][1]["wait_for_status"], "green")
+        self.assertEqual(len(load_options.deferred), 0)
+
+    def test_single_node_waits_for_yellow(self, sleep):
+        client = finalising_client()
+        client.cluster.health.return_value = {"timed_out": False, "number_of_data_nodes": 1}
+        finalise_indices(client, {"a": "0", "b": None}, BulkLoadOptions(max_num_segments=0))
+        self.assertEqual(client.cluster.health.call_args[1]["wait_for_status"], "yellow")
+        finalise_indices(client, {"a": "0"}, BulkLoadOptions(max_num_segments=0))
+        self.assertEqual(client.cluster.health.call_args[1]["wait_for_status"], "green")
+
+    def test_configured_status(self, sleep):
+        client = finalising_client()
+        finalise_indices(client, {"a": "1"}, BulkLoadOptions(max_num_segments=0,
+            wait_for_status="yellow"))
+        client.cluster.health.assert_called_once_with(index="a", wait_for_status="yellow",
+            timeout=mock.ANY, request_timeout=mock.ANY)
+
+
+@mock.patch("time.sleep")
+class LoadProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = finalising_client()
+        self.client.indices.exists.return_value = False
+        self.client.indices.get_settings.return_value = {"ev": {"settings": {"index": {
+            "translog": {"flush_threshold_size": "512mb"}}}}}
+        self.load_options = BulkLoadOptions(profiles={"ev": LoadProfile.from_config({
+            "translog-flush-threshold": "1gb", "merge-scheduler-threads": 1,
+            "best-compression": True})})
+
+    def test_tunes_and_reverts(self, sleep):
+        with ElasticsearchBulkIndexManager(self.client, "ev", load_options=self.load_options):
+            load_settings = self.client.indices.put_settings.call_args[1]["body"]["index"]
+            self.assertEqual(load_settings["translog.flush_threshold_size"], "1gb")
+            self.assertEqual(load_settings["merge.scheduler.max_thread_count"], 1)
+        reverted = self.client.indices.put_settings.call_args_list[1][1]["body"]["index"]
+        self.assertEqual(reverted["translog.flush_threshold_size"], "512mb")
+        self.assertIsNone(reverted["merge.scheduler.max_thread_count"])
+        self.client.indices.put_settings.assert_any_call(index="ev", 
+            body={"index": {"codec": "best_compression"}})
+        self.client.indices.close.assert_called_once_with(index="ev")
+        self.client.indices.open.assert_called_once_with(index="ev")
+
+    def test_appended_index_not_compressed(self, sleep):
+        self.client.indices.exists.return_value = True
+        with ElasticsearchBulkIndexManager(self.client, "ev", append_data=True,
+                load_options=self.load_options):
+            pass
+        self.client.indices.create.assert_not_called()
+        self.client.indices.close.assert_not_called()
+
+    def test_untuned_index(self, sleep):
+        with ElasticsearchBulkIndexManager(self.client, "other", load_options=self.load_options):
+            load_settings = self.client.indices.put_settings.call_args[1]["body"]["index"]
+            self.assertNotIn("translog.flush_threshold_size", load_settings)
+        self.client.indices.close.assert_not_called()
+
+    def test_partitions(self, sleep):
+        self.client.indices.get_alias.return_value = {}
+        with ElasticsearchPartitionedIndexManager(self.client, "ev", run_id="2",
+                load_options=self.load_options) as partitions:
+            partitions.add(partitions.partition("ds1"))
+        template = self.client.indices.put_template.call_args[1]["body"]
+        self.assertEqual(template["settings"]["index"]["translog.flush_threshold_size"], "1gb")
+        self.client.indices.close.assert_called_once_with(index="ev-ds1-2")
+
+
+class PartitionedIndexManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = finalising_client()
+        self.client.indices.exists_alias.return_value = True
+        self.client.indices.exists.return_value = True
+        self.client.indices.get_alias.return_value = {"ev-ds1-1": {}, "ev-ds2-1": {}}
+
+    def test_replaces_written_partitions(self):
+        with ElasticsearchPartitionedIndexManager(self.client, "ev", 
+                {"index": {"number_of_replicas": "1"}}, run_id="2") as partitions:
+            self.assertEqual(partitions.partition("DS1"), partition_index_name("ev", "ds1", "2"))
+            partitions.add(partitions.partition("ds1"))
+        template = self.client.indices.put_template.call_args[1]["body"]
+        self.assertEqual(template["index_patterns"], ["ev-*-2"])
+        self.client.indices.delete_template.assert_called_once_with(name="ev-partitions",
+            ignore=[404])
+        self.assertEqual(template["settings"]["index"]["number_of_replicas"], 0)
+        self.client.indices.update_aliases.assert_called_once_with(body={"actions": [
+            {"add": {"index": "ev-ds1-2", "alias": "ev"}},
+            {"remove": {"index": "ev-ds1-1", "alias": "ev"}}]})
+        self.client.indices.delete.assert_called_once_with(index="ev-ds1-1", ignore=[404])
+
+    def test_failed_load(self):
+        with self.assertRaises(ValueError):
+            with ElasticsearchPartitionedIndexManager(self.client, "ev", run_id="2") as partitions:
+                partitions.add(partitions.partition("ds1"))
+                raise ValueError()
+        self.assertFalse(self.client.indices.update_aliases.called)
+        self.client.indices.delete.assert_called_once_with(index="ev-ds1-2", ignore=[404])
+        self.client.indices.delete_template.assert_called_once_with(name="ev-partitions",
+            ignore=[404])
+
+    def test_partial_load_keeps_other_datasources(self):
+        #the alias still serves the version of an unpartitioned load
+        self.client.indices.get_alias.return_value = {"ev-20200101000000": {}}
+        self.client.reindex.return_value = {"task": "n:1"}
+        self.client.tasks.get.return_value = {"completed": True, 
+            "task": {"running_time_in_nanos": 1000}, "response": {"failures": []}}
+        self.client.indices.get.return_value = {"ev-ds1-2": {}, "ev-ds2-2": {}}
+        with ElasticsearchPartitionedIndexManager(self.client, "ev", run_id="2",
+                partition_field="unique_association_fields.datasource") as partitions:
+            partitions.add(partitions.partition("ds1"))
+            #the template still creates the copied partitions
+            self.client.indices.delete_template.assert_not_called()
+        body = self.client.reindex.call_args[1]["body"]
+        self.assertEqual(body["source"], {"index": "ev-20200101000000"})
+        self.assertEqual(body["script"]["params"]["written"], ["ds1"])
+        self.assertEqual(body["script"]["params"]["path"], 
+            ["unique_association_fields", "datasource"])
+        self.client.indices.get.assert_called_once_with(index="ev-*-2")
+        self.client.indices.update_aliases.assert_called_once_with(body={"actions": [
+            {"add": {"index": "ev-ds1-2", "alias": "ev"}},
+            {"add": {"index": "ev-ds2-2", "alias": "ev"}},
+            {"remove": {"index": "ev-20200101000000", "alias": "ev"}}]})
+        self.client.indices.delete.assert_called_once_with(index="ev-20200101000000",
+            ignore=[404])
+
+    def test_failed_copy(self):
+        self.client.indices.get_alias.return_value = {"ev-20200101000000": {}}
+        self.client.reindex.return_value = {"task": "n:1"}
+        self.client.tasks.get.return_value = {"completed": True, 
+            "task": {"running_time_in_nanos": 1000}, "response": {"failures": ["full"]}}
+        with self.assertRaises(RuntimeError):
+            with ElasticsearchPartitionedIndexManager(self.client, "ev", run_id="2",
+                    partition_field="datasource") as partitions:
+                partitions.add(partitions.partition("ds1"))
+        self.assertFalse(self.client.indices.update_aliases.called)
+        self.client.indices.delete.assert_called_once_with(index="ev-ds1-2", ignore=[404])
+
+    def test_refuses_unpartitioned_without_field(self):
+        self.client.indices.exists_alias.return_value = False
+        with self.assertRaises(ValueError):
+            with ElasticsearchPartitionedIndexManager(self.client, "ev", run_id="2"):
+                pass
+        self.client.indices.put_template.assert_not_called()
+        self.client.indices.delete.assert_not_called()
+
+
+@mock.patch("time.sleep")
+class VersionedIndexManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = finalising_client()
+        self.client.indices.exists_alias.return_value = True
+        self.client.indices.exists.return_value = False
+        self.client.indices.get_alias.return_value = {"ev-20200101000000": {}}
+        self.client.indices.get_settings.return_value = {}
+        self.client.indices.get.return_value = {"ev-20190101000000": {}, 
+            "ev-20200101000000": {}, "ev-20240101000000": {}, "ev-ds1-2": {}}
+
+    def test_swaps_alias_and_keeps_versions(self, sleep):
+        with ElasticsearchBulkIndexManager(self.client, "ev", load_options=BulkLoadOptions(2),
+                version="20240101000000") as manager:
+            self.assertEqual(manager.index_name, "ev-20240101000000")
+        self.assertEqual(self.client.indices.create.call_args[1]["index"], "ev-20240101000000")
+        self.client.indices.update_aliases.assert_called_once_with(body={"actions": [
+            {"add": {"index": "ev-20240101000000", "alias": "ev"}},
+            {"remove": {"index": "ev-20200101000000", "alias": "ev"}}]})
+        self.client.indices.delete.assert_called_once_with(index="ev-20190101000000", 
+            ignore=[404])
+
+    def test_deferred_swaps_alias_before_merging(self, sleep):
+        load_options = BulkLoadOptions(2, defer_finalise=True)
+        with ElasticsearchBulkIndexManager(self.client, "ev", load_options=load_options,
+                version="20240101000000"):
+            pass
+        self.assertTrue(self.client.indices.update_aliases.called)
+        self.client.indices.forcemerge.assert_not_called()
+        self.assertEqual(list(load_options.deferred), ["ev-20240101000000"])
+
+    def test_failed_load_keeps_alias(self, sleep):
+        with self.assertRaises(RuntimeError):
+            with ElasticsearchBulkIndexManager(self.client, "ev", 
+                    load_options=BulkLoadOptions(2), version="20240101000000"):
+                raise RuntimeError("failed")
+        self.client.indices.update_aliases.assert_not_called()
+        self.client.indices.delete.assert_called_once_with(index="ev-20240101000000", 
+            ignore=[404])
+
+    def test_appends_to_current_version(self, sleep):
+        manager = ElasticsearchBulkIndexManager(self.client, "ev", append_data=True,
+            load_options=BulkLoadOptions(2))
+        self.assertEqual(manager.index_name, "ev-20200101000000")
+        self.assertIsNone(manager.version)
+
+    def test_appends_unversioned_without_current_version(self, sleep):
+        #the first versioned run over an unversioned index
+        self.client.indices.get_alias.return_value = {"ev": {}}
+        self.client.indices.exists.return_value = True
+        self.client.indices.exists_alias.return_value = False
+        with ElasticsearchBulkIndexManager(self.client, "ev", append_data=True,
+                load_options=BulkLoadOptions(2)) as manager:
+            self.assertEqual(manager.index_name, "ev")
+            self.assertIsNone(manager.version)
+        self.client.indices.create.assert_not_called()
+        self.client.indices.delete.assert_not_called()
+        self.client.indices.update_aliases.assert_not_called()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mrtarget.common.EvidenceColumns import EvidenceColumnsWriter, EvidenceColumns
+
+
+ROWS = [
+    ("ENSG2", "EFO_2", ["EFO_2", "EFO_0"], 0.25, "ds1"),
+    ("ENSG1", "EFO_1", ["EFO_1", "EFO_0"], 0.5, "ds1"),
+    ("ENSG2", "EFO_1", [], 1.0, "ds2"),
+    ("ENSG1", "EFO_3", ["EFO_3"], 0.75, "ds2"),
+]
+
+
+def as_row(evidence):
+    return (evidence['target']['id'], evidence['disease']['id'],
+        evidence['private']['efo_codes'], evidence['scores']['association_score'],
+        evidence['sourceID'])
+
+
+class EvidenceColumnsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.columns_directory = os.path.join(self.directory, "columns")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, rows):
+        writer = EvidenceColumnsWriter(self.columns_directory)
+        for row in rows:
+            writer.add(row)
+        writer.close()
+        return EvidenceColumns(self.columns_directory)
+
+    def test_grouped_by_target(self):
+        columns = self.write(ROWS)
+        self.assertEqual(len(columns), 4)
+        self.assertEqual(columns.target_count, 2)
+        groups = [[as_row(e) for e in evidences] 
+            for evidences in columns.target_evidence(0, columns.target_count)]
+        #in the order the targets were first seen, keeping the order of their evidence
+        self.assertEqual(groups, [[ROWS[0], ROWS[2]], [ROWS[1], ROWS[3]]])
+
+    def test_chunks(self):
+        columns = self.write(ROWS + [("ENSG3", "EFO_1", ["EFO_1"], 0.1, "ds1")])
+        self.assertEqual(columns.target_chunks(2), [(0, 2), (2, 3)])
+        self.assertEqual([[as_row(e) for e in evidences] for evidences in columns.target_evidence(2, 3)],
+            [[("ENSG3", "EFO_1", ["EFO_1"], 0.1, "ds1")]])
+
+    def test_replaces_previous(self):
+        self.write(ROWS)
+        columns = self.write(ROWS[:1])
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(os.listdir(self.directory), ["columns"])
+
+    def test_empty(self):
+        columns = self.write([])
+        self.assertEqual(len(columns), 0)
+        self.assertEqual(columns.target_chunks(100), [])
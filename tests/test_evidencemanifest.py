@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mrtarget.common.EvidenceManifest import EvidenceManifest
+
+
+class EvidenceManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_filename = os.path.join(self.directory, "manifest.sqlite")
+        self.input_filename = os.path.join(self.directory, "evidence.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_input(self, lines, mtime):
+        with open(self.input_filename, "wb") as f:
+            f.write(b"".join(lines))
+        os.utime(self.input_filename, (mtime, mtime))
+
+    def run_manifest(self, filenames):
+        """read the lines like the pipeline, writing each as the document named 
+        by its content, and return the new lines and the removed documents"""
+        manifest = EvidenceManifest(self.manifest_filename)
+        lines = []
+        for filename in manifest.plan(filenames):
+            with open(filename, "rb") as f:
+                lines.extend((filename, (n, l)) for n, l in enumerate(f, start=1))
+        new_lines = list(manifest.filter_lines(lines))
+        for filename, (line_n, line) in new_lines:
+            manifest.record(filename, line_n, "valid", line.strip().decode("utf-8"))
+        removed = manifest.removed_documents(filenames)
+        manifest.commit()
+        manifest.close()
+        return [l for _, (_, l) in new_lines], removed
+
+    def test_incremental(self):
+        self.write_input([b"a\n", b"b\n", b"c\n"], 1000)
+        new_lines, removed = self.run_manifest([self.input_filename])
+        self.assertEqual(new_lines, [b"a\n", b"b\n", b"c\n"])
+        self.assertEqual(removed, [])
+
+        #same file is not read again
+        new_lines, removed = self.run_manifest([self.input_filename])
+        self.assertEqual((new_lines, removed), ([], []))
+
+        #only the changed lines, and the documents of the removed ones
+        self.write_input([b"a\n", b"c\n", b"d\n"], 2000)
+        new_lines, removed = self.run_manifest([self.input_filename])
+        self.assertEqual(new_lines, [b"d\n"])
+        self.assertEqual(removed, [("valid", "b")])
+
+        #documents of files no longer in the input
+        new_lines, removed = self.run_manifest([])
+        self.assertEqual(removed, [("valid", "a"), ("valid", "c"), ("valid", "d")])
+
+    def test_not_committed(self):
+        self.write_input([b"a\n"], 1000)
+        manifest = EvidenceManifest(self.manifest_filename)
+        manifest.plan([self.input_filename])
+        lines = [(self.input_filename, (1, b"a\n"))]
+        for filename, (line_n, line) in manifest.filter_lines(lines):
+            manifest.record(filename, line_n, "valid", "a")
+        #a failed run leaves the manifest as it was
+        manifest.close()
+        new_lines, _ = self.run_manifest([self.input_filename])
+        self.assertEqual(new_lines, [b"a\n"])
+
+    def test_lines_per_file(self):
+        other_filename = os.path.join(self.directory, "other.json")
+        with open(other_filename, "wb") as f:
+            f.write(b"a\nb\n")
+        self.write_input([b"a\n", b"b\n"], 1000)
+        self.run_manifest([self.input_filename, other_filename])
+
+        #a line removed from one file is still in the other
+        self.write_input([b"b\n"], 2000)
+        manifest = EvidenceManifest(self.manifest_filename)
+        self.assertEqual(manifest.plan([self.input_filename, other_filename]),
+            [self.input_filename])
+        lines = [(self.input_filename, (1, b"b\n"))]
+        self.assertEqual(list(manifest.filter_lines(lines)), [])
+        self.assertEqual(manifest.connection.execute("SELECT COUNT(*) FROM seen").fetchone(), (1,))
+        self.assertEqual(manifest.removed_documents([self.input_filename, other_filename]), [])
+        self.assertEqual(sorted(manifest.connection.execute(
+            "SELECT filename, doc_id FROM lines")), sorted([(self.input_filename, "b"),
+                (other_filename, "a"), (other_filename, "b")]))
+        manifest.close()
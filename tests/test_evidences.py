@@ -0,0 +1,197 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import simplejson as json
+
+from mrtarget.common.DataStructure import get_json_backend, orjson
+from mrtarget.modules.Evidences import validate_evidence, fix_and_score_evidence, bulk_payload, \
+    InvalidEvidenceSink, validation_on_start
+
+DATASOURCES_TO_DATATYPES = {"ds1": "dt1"}
+
+EVIDENCE = {"label": "dt1", "sourceID": "ds1",
+    "target": {"id": "http://identifiers.org/ensembl/ENSG01"},
+    "disease": {"id": "http://www.ebi.ac.uk/efo/EFO_1"},
+    "unique_association_fields": {"study": "s1"}}
+
+
+def make_luts():
+    luts = mock.Mock()
+    luts.available_efos.get_ontology_code_from_url.side_effect = lambda url: url.split('/')[-1]
+    luts.available_efos.__contains__ = mock.Mock(return_value=True)
+    luts.available_genes.__contains__ = mock.Mock(return_value=True)
+    luts.non_reference_genes = []
+    return luts
+
+
+class ValidateEvidenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.validator = mock.Mock()
+        self.validator.iter_errors.return_value = []
+
+    def validate(self, evidence, luts=None, backend="simplejson"):
+        line = ("file.json", (1, json.dumps(evidence).encode("utf-8")))
+        return validate_evidence(line, self.logger, self.validator, luts or make_luts(),
+            DATASOURCES_TO_DATATYPES, json_backend=get_json_backend(backend))
+
+    def test_valid_keeps_the_decoded_evidence(self):
+        backend = get_json_backend()
+        with mock.patch.object(backend, "loads", wraps=backend.loads) as loads:
+            line = ("file.json", (1, json.dumps(EVIDENCE).encode("utf-8")))
+            left, right = validate_evidence(line, self.logger, self.validator, make_luts(),
+                DATASOURCES_TO_DATATYPES, json_backend=backend)
+        self.assertEqual(loads.call_count, 1)
+        self.assertIsNone(left)
+
+        evidence = right.evidence
+        self.assertEqual(evidence["type"], "dt1")
+        self.assertNotIn("label", evidence)
+        self.assertEqual(evidence["unique_association_fields"],
+            {"study": "s1", "datasource": "ds1"})
+        self.assertEqual(evidence["id"], right.hash)
+        self.assertEqual(right.hash, hashlib.md5(json.dumps(
+            {"study": "s1", "datasource": "ds1"}, sort_keys=True).encode("utf-8")).hexdigest())
+        #the id of the line is only for invalid evidence
+        self.assertIsNone(right.id)
+
+    def test_invalid_has_line_id(self):
+        luts = make_luts()
+        luts.available_genes.__contains__ = mock.Mock(return_value=False)
+        left, right = self.validate(EVIDENCE, luts)
+        self.assertIsNone(right)
+        self.assertEqual(left.explanation_type, "invalid_target")
+        self.assertEqual(left.id, hashlib.md5(json.dumps(EVIDENCE,
+            sort_keys=True).encode("utf-8")).hexdigest())
+
+    def test_unparseable(self):
+        line = ("file.json", (1, b"{not json"))
+        left, right = validate_evidence(line, self.logger, self.validator, make_luts(),
+            DATASOURCES_TO_DATATYPES)
+        self.assertEqual(left.explanation_type, "unparseable_json")
+        self.assertEqual(left.id, hashlib.md5(b"{not json").hexdigest())
+
+    def fix(self, scoring_columns):
+        left, right = self.validate(EVIDENCE)
+        evidence_manager = mock.Mock()
+        evidence_manager.fix_evidence.side_effect = lambda ev: (ev, False)
+        evidence_manager.check_is_valid_evs.return_value = (True, None)
+        def extend(ev):
+            ev.evidence["private"] = {"efo_codes": ["EFO_1", "EFO_0"]}
+            ev.evidence["scores"] = {"association_score": 0.5}
+            return ev
+        evidence_manager.get_extended_evidence.side_effect = extend
+        with mock.patch("mrtarget.common.EvidenceString.Evidence.score_evidence"):
+            return fix_and_score_evidence(right, DATASOURCES_TO_DATATYPES,
+                evidence_manager, scoring_columns=scoring_columns)
+
+    def test_fix_serialises_once(self):
+        left, right = self.fix(True)
+        self.assertIsNone(left)
+        self.assertNotIn("evidence", right)
+        self.assertEqual(json.loads(right.line)["unique_association_fields"]["datasource"], "ds1")
+        self.assertEqual(right.scoring, (EVIDENCE["target"]["id"], EVIDENCE["disease"]["id"],
+            ["EFO_1", "EFO_0"], 0.5, "ds1"))
+
+    def test_scoring_fields_only_for_columns(self):
+        left, right = self.fix(False)
+        self.assertNotIn("scoring", right)
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def test_orjson_same_document(self):
+        simple = self.validate(EVIDENCE)[1]
+        fast = self.validate(EVIDENCE, backend="orjson")[1]
+        self.assertEqual(simple.evidence, fast.evidence)
+        self.assertEqual(simple.hash, fast.hash)
+        backend = get_json_backend("orjson")
+        self.assertEqual(json.loads(backend.dumps(simple.evidence, sort_keys=True)),
+            simple.evidence)
+
+
+class BulkPayloadTestCase(unittest.TestCase):
+
+    def test_payload(self):
+        right = {"hash": "h1", "line": '{"id": "h1"}', "filename": "f", "line_n": 1}
+        left = {"id": "l1", "explanation_type": "invalid_target", "filename": "f", "line_n": 2}
+        payload, written, rejected, scored = bulk_payload([(None, right), (left, None), (None, None)],
+            "valid", "invalid", get_json_backend())
+        lines = payload.decode("utf-8").split("\n")
+        self.assertEqual(lines[-1], "")
+        self.assertEqual([json.loads(l) for l in lines[:-1]], [
+            {"index": {"_index": "valid", "_id": "h1"}}, {"id": "h1"},
+            {"index": {"_index": "invalid", "_id": "l1"}}, left])
+        self.assertEqual(written, [("f", 1, "valid", "h1"), ("f", 2, "invalid", "l1")])
+        self.assertEqual(rejected, [])
+        self.assertEqual(scored, [])
+        self.assertEqual(bulk_payload([], "valid", "invalid", get_json_backend()), (b"", [], [], []))
+
+    def test_invalid_left_out(self):
+        left = {"id": "l1", "explanation_type": "invalid_target", "filename": "f", "line_n": 2}
+        payload, written, rejected, _ = bulk_payload([(left, None)], "valid", None,
+            get_json_backend())
+        self.assertEqual(payload, b"")
+        self.assertEqual(written, [("f", 2, None, "l1")])
+        self.assertEqual(rejected, [left])
+
+    def test_partitions(self):
+        right = {"hash": "h1", "line": '{"id": "h1"}', "filename": "f", "line_n": 1,
+            "data_source": "ds1"}
+        payload, written, _, _ = bulk_payload([(None, right)], "valid", "invalid",
+            get_json_backend(), partition_run="2")
+        self.assertEqual(json.loads(payload.decode("utf-8").split("\n")[0]),
+            {"index": {"_index": "valid-ds1-2", "_id": "h1"}})
+        self.assertEqual(written, [("f", 1, "valid-ds1-2", "h1")])
+
+    def test_scoring_columns(self):
+        row = ("ENSG1", "EFO_1", ["EFO_1", "EFO_0"], 0.5, "ds1")
+        right = {"hash": "h1", "line": '{"id": "h1"}', "filename": "f", "line_n": 1,
+            "scoring": row}
+        _, _, _, scored = bulk_payload([(None, right)], "valid", "invalid",
+            get_json_backend(), scoring_columns=True)
+        self.assertEqual(scored, [row])
+
+
+class ValidationOnStartTestCase(unittest.TestCase):
+
+    @mock.patch("mrtarget.modules.Evidences.EvidenceManager")
+    @mock.patch("mrtarget.modules.Evidences.new_es_client")
+    @mock.patch("mrtarget.modules.Evidences.DatasourceValidators")
+    def test_cache_sizes(self, validators, es_client, evidence_manager):
+        start = validation_on_start(None, None, [], DATASOURCES_TO_DATATYPES, None,
+            "gene", "eco", "efo", 1001, 1002, 1003, 1004, 1005, 1006, False, None, 
+            "simplejson", None)
+        lookup_data = start[2]
+        self.assertEqual(lookup_data.available_genes.cache_gene.maxsize, 1001)
+        self.assertEqual(lookup_data.available_genes.cache_u2e.maxsize, 1002)
+        self.assertEqual(lookup_data.available_genes.cache_contains.maxsize, 1003)
+        self.assertEqual(lookup_data.available_ecos.cache.maxsize, 1004)
+        self.assertEqual(lookup_data.available_efos.cache_efo.maxsize, 1005)
+        self.assertEqual(lookup_data.available_efos.cache_contains.maxsize, 1006)
+
+
+class InvalidEvidenceSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rotates_and_summarises(self):
+        with InvalidEvidenceSink(self.directory, get_json_backend(), lines_per_file=2) as sink:
+            for i, explanation in enumerate(["invalid_target", "invalid_target", "validation_error"]):
+                sink.write({"id": str(i), "explanation_type": explanation, "data_source": "ds1"})
+        self.assertEqual(sorted(os.listdir(self.directory)), ["invalid-evidence-0000.jsonl.gz",
+            "invalid-evidence-0001.jsonl.gz", "invalid-evidence-summary.tsv"])
+        with gzip.open(os.path.join(self.directory, "invalid-evidence-0000.jsonl.gz")) as f:
+            self.assertEqual([json.loads(l)["id"] for l in f], ["0", "1"])
+        with open(os.path.join(self.directory, "invalid-evidence-summary.tsv")) as f:
+            self.assertEqual(f.read(), "explanation_type\tdatasource\tcount\n"
+                "invalid_target\tds1\t2\nvalidation_error\tds1\t1\n")
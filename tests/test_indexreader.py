@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from mrtarget.common.esfile import FolderIndexManager, bulk
+from mrtarget.common.IndexReader import FolderIndexReader, new_index_reader
+
+ASSOCIATIONS = [
+    {"target": {"id": "T1"}, "disease": {"id": "D1"}, "is_direct": True,
+        "harmonic-sum": {"overall": 0.5}},
+    {"target": {"id": "T2"}, "disease": {"id": "D1"}, "is_direct": False,
+        "harmonic-sum": {"overall": 0.1}},
+]
+
+
+class FolderIndexReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        actions = [{"_index": "assoc", "_id": "a%d" % i, "_source": a} 
+            for i, a in enumerate(ASSOCIATIONS)]
+        with FolderIndexManager(self.folder, "assoc"):
+            list(bulk(None, self.folder, actions))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_queries(self):
+        reader = FolderIndexReader(self.folder)
+        self.assertEqual([h["_id"] for h in reader.scan("assoc")], ["a0", "a1"])
+        self.assertEqual([h["_id"] for h in reader.scan("assoc", 
+            {"query": {"term": {"is_direct": True}}})], ["a0"])
+        self.assertEqual([h["_id"] for h in reader.scan("assoc",
+            {"query": {"ids": {"values": ["a1"]}}})], ["a1"])
+        hits = list(reader.scan("assoc", {"query": {"match": {"target.id": "T2"}},
+            "_source": {"includes": ["target.id", "harmonic-sum"]}}))
+        self.assertEqual(hits[0]["_source"], {"target": {"id": "T2"},
+            "harmonic-sum": {"overall": 0.1}})
+        self.assertEqual(list(reader.scan("assoc", {"_source": False}))[0]["_source"], {})
+        with self.assertRaises(ValueError):
+            list(reader.scan("assoc", {"query": {"range": {"x": {"gt": 1}}}}))
+
+    @mock.patch("mrtarget.common.IndexReader.parallel_scan")
+    def test_fallback(self, scan):
+        client = mock.Mock()
+        client.indices.exists_alias.return_value = False
+        scan.return_value = iter([{"_id": "g1", "_source": {}}])
+        reader = new_index_reader(client, self.folder)
+        self.assertIn("assoc", reader)
+        self.assertNotIn("gene", reader)
+        self.assertEqual([h["_id"] for h in reader.scan("gene")], ["g1"])
+        self.assertEqual(scan.call_args[0][:2], (client, ["gene"]))
@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from mrtarget.common.LookupTables import GeneLookUpTable, EFOLookUpTable
+from mrtarget.common.LookupTables import LookupCache, deep_getsizeof
+from mrtarget.common.LookupSnapshot import LookupSnapshot, write_snapshot
+from mrtarget.common.LookupHelpers import build_lookup_snapshots
+
+
+GENE_HITS = [
+    {"_id": "ENSG01", "_source": {"ensembl_gene_id": "ENSG01",
+        "uniprot_id": "P001", "uniprot_accessions": ["P001", "Q001"]}},
+    {"_id": "ENSG02", "_source": {"ensembl_gene_id": "ENSG02",
+        "uniprot_id": "P002", "uniprot_accessions": ["Q001"]}},
+    {"_id": "ENSG03", "_source": {"ensembl_gene_id": "ENSG03"}},
+]
+
+
+class PreloadLookUpTableTestCase(unittest.TestCase):
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_gene_preload(self, scan):
+        scan.return_value = iter(GENE_HITS)
+        genes = GeneLookUpTable(None, "genes", 0, 0, 0, preload=True)
+
+        self.assertTrue("ENSG01" in genes)
+        self.assertTrue("ENSG03" in genes)
+        self.assertFalse("ENSG04" in genes)
+        self.assertIsNone(genes.get_gene("ENSG04"))
+
+        self.assertEqual(genes.get_uniprot2ensembl("P001"), "ENSG01")
+        self.assertEqual(genes.get_uniprot2ensembl("P002"), "ENSG02")
+        self.assertIsNone(genes.get_uniprot2ensembl("P003"))
+        with self.assertRaises(ValueError):
+            genes.get_uniprot2ensembl("Q001")
+
+        self.assertEqual(genes.preload_queries, 7)
+        self.assertEqual(genes.preload_hits, 4)
+        self.assertEqual(scan.call_count, 1)
+        self.assertEqual(sorted(genes.metrics()), ["cache_gene", "preload"])
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_efo_preload(self, scan):
+        scan.return_value = iter([{"_id": "EFO_1"}, {"_id": "EFO_2"}])
+        efos = EFOLookUpTable(None, "efos", 0, 0, preload=True)
+
+        self.assertTrue("EFO_1" in efos)
+        self.assertFalse("EFO_3" in efos)
+        self.assertIsNone(efos.get_efo("EFO_3"))
+
+
+class SnapshotLookUpTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_gene_snapshot(self, scan):
+        scan.return_value = iter(GENE_HITS)
+        filename = os.path.join(self.directory, "gene.snapshot")
+        self.assertEqual(GeneLookUpTable.build_snapshot(None, "genes", filename), 3)
+
+        snapshot = LookupSnapshot(filename)
+        genes = GeneLookUpTable(None, "genes", 1024*1024, 0, 0, snapshot=snapshot)
+
+        self.assertTrue("ENSG02" in genes)
+        self.assertFalse("ENSG04" in genes)
+        self.assertEqual(genes.get_gene("ENSG01"), GENE_HITS[0]["_source"])
+        self.assertIsNone(genes.get_gene("ENSG04"))
+        self.assertEqual(genes.get_uniprot2ensembl("P002"), "ENSG02")
+        with self.assertRaises(ValueError):
+            genes.get_uniprot2ensembl("Q001")
+        snapshot.close()
+
+    def test_tables_in_file(self):
+        filename = os.path.join(self.directory, "docs.snapshot")
+        docs = [("id%d" % i, {"n": i}) for i in range(1000, 0, -7)] + [(u"\u00e9", {"n": 0})]
+        write_snapshot(filename, iter(docs), maps={"m": {"b": "2", "a": "1"}},
+            extra={"x": 1})
+
+        snapshot = LookupSnapshot(filename)
+        #the keys are looked up in the file, not decoded into dicts
+        self.assertNotIsInstance(snapshot.maps["m"], dict)
+        self.assertEqual(len(snapshot), len(docs))
+        for doc_id, doc in docs:
+            self.assertTrue(doc_id in snapshot)
+            self.assertEqual(snapshot.get(doc_id), doc)
+        self.assertFalse("id2" in snapshot)
+        self.assertIsNone(snapshot.get("id2"))
+        self.assertEqual(sorted(snapshot.ids()), sorted(doc_id for doc_id, _ in docs))
+        self.assertEqual(snapshot.maps["m"].get("a"), "1")
+        self.assertIsNone(snapshot.maps["m"].get("c"))
+        self.assertEqual(snapshot.extra, {"x": 1})
+        snapshot.close()
+
+
+class PrefetchLookUpTableTestCase(unittest.TestCase):
+
+    def test_gene_prefetch(self):
+        es = mock.Mock()
+        es.mget.return_value = {"docs": [
+            {"_id": "ENSG01", "found": True, "_source": GENE_HITS[0]["_source"]},
+            {"_id": "ENSG04", "found": False}]}
+        genes = GeneLookUpTable(es, "genes", 1024*1024, 0, 1024)
+
+        genes.prefetch(["ENSG01", "ENSG04", "ENSG01"])
+        self.assertEqual(es.mget.call_count, 1)
+        self.assertEqual(sorted(es.mget.call_args[1]["body"]["ids"]), ["ENSG01", "ENSG04"])
+
+        self.assertTrue("ENSG01" in genes)
+        self.assertFalse("ENSG04" in genes)
+        self.assertEqual(genes.get_gene("ENSG01"), GENE_HITS[0]["_source"])
+        self.assertIsNone(genes.get_gene("ENSG04"))
+
+        #already cached genes are not fetched again
+        genes.clear_prefetch()
+        genes.prefetch(["ENSG01"])
+        self.assertEqual(es.mget.call_count, 1)
+
+
+class LookupCacheTestCase(unittest.TestCase):
+
+    def test_deep_size(self):
+        doc = {"go": [{"id": "GO:%d" % i, "value": {"term": "P:term %d" % i}} for i in range(100)]}
+        shallow = {"go": None}
+        self.assertGreater(deep_getsizeof(doc), 10 * deep_getsizeof(shallow))
+
+    def test_metrics(self):
+        small = {"id": "a"}
+        cache = LookupCache(deep_getsizeof(small) * 2)
+        cache["a"] = small
+        cache["b"] = {"id": "b"}
+        cache["c"] = {"id": "c"}
+        #too large to ever fit, silently not cached
+        cache["d"] = {"id": "d" * 1000}
+
+        metrics = cache.metrics()
+        self.assertEqual(metrics["items"], 2)
+        self.assertEqual(metrics["evictions"], 1)
+        self.assertEqual(metrics["rejected"], 1)
+        self.assertTrue("d" not in cache)
+        self.assertLessEqual(metrics["currsize"], metrics["maxsize"])
+
+
+class PersistentSnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _es(self, uuid, count):
+        es = mock.Mock()
+        es.indices.get_settings.return_value = {"efos": {"settings": {"index": {"uuid": uuid}}}}
+        es.count.return_value = {"count": count}
+        return es
+
+    @mock.patch("elasticsearch.helpers.scan")
+    def test_reuse_and_invalidate(self, scan):
+        scan.side_effect = lambda **kwargs: iter([{"_id": "EFO_1", "_source": {"code": "EFO_1"}}])
+
+        first = build_lookup_snapshots(self._es("a", 1), self.directory, 
+            persistent=True, efo_index="efos")
+        again = build_lookup_snapshots(self._es("a", 1), self.directory, 
+            persistent=True, efo_index="efos")
+        self.assertEqual(first, again)
+        self.assertEqual(scan.call_count, 1)
+
+        #a rebuilt index has a new uuid, the old snapshot is replaced
+        rebuilt = build_lookup_snapshots(self._es("b", 1), self.directory, 
+            persistent=True, efo_index="efos")
+        self.assertNotEqual(first, rebuilt)
+        self.assertEqual(scan.call_count, 2)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(rebuilt["efo"])])
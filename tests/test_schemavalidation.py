@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import simplejson as json
+
+from mrtarget.common.SchemaValidation import DatasourceValidators, split_schema, \
+    compiled_schema_validators, fastjsonschema
+
+try:
+    import jsonschema
+except ImportError:
+    jsonschema = None
+
+SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+    "oneOf": [{"$ref": "genetics.json"}, {"$ref": "literature.json#/definitions/literature"}]}
+
+GENETICS = {"type": "object", "required": ["sourceID", "variant"],
+    "properties": {"sourceID": {"enum": ["gwas", "eva"]}, "variant": {"type": "string"}}}
+
+LITERATURE = {"definitions": {"literature": {"type": "object", "required": ["sourceID", "pmid"],
+    "properties": {"sourceID": {"enum": ["europepmc"]}, "pmid": {"type": "integer"}}}}}
+
+
+@unittest.skipIf(fastjsonschema is None, "fastjsonschema is not installed")
+class DatasourceValidatorsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, schema in (("schema.json", SCHEMA), ("genetics.json", GENETICS),
+                ("literature.json", LITERATURE)):
+            with open(os.path.join(self.directory, name), "w") as f:
+                json.dump(schema, f)
+        self.schema_uri = os.path.join(self.directory, "schema.json")
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_split(self):
+        schemas = split_schema({"oneOf": [GENETICS, LITERATURE["definitions"]["literature"]]})
+        self.assertEqual(sorted(k for k in schemas if k), ["europepmc", "eva", "gwas"])
+        self.assertEqual(schemas["gwas"]["oneOf"], [GENETICS])
+        self.assertEqual(len(schemas[None]["oneOf"]), 2)
+
+    def test_validates_by_datasource(self):
+        validators = DatasourceValidators(self.schema_uri)
+        self.assertEqual(list(validators.iter_errors({"sourceID": "gwas", "variant": "rs1"})), [])
+        self.assertEqual(list(validators.iter_errors({"sourceID": "europepmc", "pmid": 1})), [])
+        self.assertTrue(list(validators.iter_errors({"sourceID": "gwas", "pmid": 1})))
+        #unknown datasources use the whole schema
+        self.assertTrue(list(validators.iter_errors({"sourceID": "other", "pmid": 1})))
+        #the evidence is not changed
+        evidence = {"sourceID": "eva", "variant": "rs1"}
+        list(validators.iter_errors(evidence))
+        self.assertEqual(evidence, {"sourceID": "eva", "variant": "rs1"})
+
+    def _format_schema(self):
+        with open(self.schema_uri, "w") as f:
+            json.dump({"type": "object", "properties": {
+                "date": {"type": "string", "format": "date-time"},
+                "url": {"type": "string", "format": "uri"}}}, f)
+
+    def test_formats_not_checked(self):
+        self._format_schema()
+        validators = DatasourceValidators(self.schema_uri)
+        self.assertEqual(list(validators.iter_errors({"date": "2018-01-01", "url": "not a uri"})), [])
+        self.assertEqual(len(list(validators.iter_errors({"date": 1}))), 1)
+
+    @unittest.skipIf(jsonschema is None, "jsonschema is not installed")
+    def test_formats_as_jsonschema(self):
+        self._format_schema()
+        evidences = [{"date": "2018-01-01", "url": "not a uri"},
+            {"date": "2018-01-01T00:00:00Z", "url": "http://example.org"}, {"date": 1}]
+        compiled = DatasourceValidators(self.schema_uri)
+        with mock.patch("mrtarget.common.SchemaValidation.fastjsonschema", None):
+            fallback = DatasourceValidators(self.schema_uri)
+        for evidence in evidences:
+            self.assertEqual(bool(list(compiled.iter_errors(evidence))),
+                bool(list(fallback.iter_errors(evidence))))
+
+    def test_cache(self):
+        with compiled_schema_validators(self.schema_uri, self.cache_dir) as directory:
+            self.assertEqual(directory, self.cache_dir)
+            with mock.patch("mrtarget.common.SchemaValidation._RefResolver.load") as load:
+                validators = DatasourceValidators(self.schema_uri, directory)
+                self.assertFalse(load.called)
+            self.assertTrue(list(validators.iter_errors({"sourceID": "europepmc", "pmid": "x"})))
+        #kept when given
+        self.assertTrue(os.listdir(self.cache_dir))
+
+        with compiled_schema_validators(self.schema_uri) as directory:
+            self.assertTrue(os.listdir(directory))
+        self.assertFalse(os.path.exists(directory))
@@ -1,7 +1,8 @@
 from builtins import range
+import random
 import unittest
 
-from mrtarget.common.Scoring import HarmonicSumScorer
+from mrtarget.common.Scoring import HarmonicSumScorer, harmonic_sum_groups
 from mrtarget.common.EvidenceString import DataNormaliser, Evidence
 
 
@@ -59,6 +60,27 @@ class HarmonicSumTestCase(unittest.TestCase):
         self.assertEqual(harmonic_sum_scorer.score(scale_factor=2.), 2.1349839001848925)
         self.assertEqual(harmonic_sum_scorer.score(cap=2), 2)
 
+    def test_harmonic_sum_groups(self):
+        '''the vectorised scorer gives exactly the same values as HarmonicSumScorer'''
+        rnd = random.Random(42)
+        buffer = 100
+        for n in (1, 10, 150, 1000):
+            scores = [rnd.choice([rnd.random(), rnd.random() * 3, 1.]) for _ in range(n)]
+            groups = [rnd.randrange(4) for _ in range(n)]
+            for scale_factor, cap in ((1, None), (2, 1), (2., None), (3, .5)):
+                expected = []
+                for g in range(5):
+                    harmonic_sum_scorer = HarmonicSumScorer(buffer=buffer)
+                    for s, sg in zip(scores, groups):
+                        if sg == g:
+                            harmonic_sum_scorer.add(s)
+                    expected.append(harmonic_sum_scorer.score(scale_factor=scale_factor, cap=cap))
+                result = harmonic_sum_groups(scores, groups, 5, buffer=buffer,
+                                             scale_factor=scale_factor, cap=cap)
+                self.assertEqual(result, expected)
+
+        self.assertEqual(harmonic_sum_groups([], [], 2), [0., 0.])
+
     def test_renormalize(self):
         value = DataNormaliser.renormalize(0.2,[0.,.9],[.5,1])
         self.assertEqual(value,0.6111111111111112)